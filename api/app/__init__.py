@@ -2,51 +2,143 @@ from flask import Flask
 from config import Config
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-from flask_migrate import Migrate
 from flask_jwt_extended import JWTManager
-from supabase import create_client, Client
+from app.cache import TTLCache
+from app.compression import Compress
+from app.json_provider import create_json_provider
+from app.passwords import PasswordHasher
+from app.pool import PoolStats
+from app.replica import ReplicaRouter, RoutingSession
+from app.response_cache import ResponseCache
+from app.storage import create_storage
 
-db = SQLAlchemy()
-migrate = Migrate()
+CORS_ORIGINS = [
+    "https://insurance-claim-example-app.vercel.app",
+    "http://localhost:3000",
+]
+
+db = SQLAlchemy(session_options={"class_": RoutingSession})
 jwt = JWTManager()
+compress = Compress()
+passwords = PasswordHasher()
+pool_stats = PoolStats()
+replica = ReplicaRouter(pool_stats)
+claims_cache = ResponseCache()
 
 
-class SupabaseClient:
+class StorageClient:
     def __init__(self):
-        self.client = None
+        self.backend = None
+        self.url_cache = TTLCache()
+
+    def init_app(self, app):
+        self.backend = create_storage(app.config)
+        self.url_mode = app.config.get("IMAGE_URL_MODE")
+        self.signed_url_expires_in = app.config.get("SIGNED_URL_EXPIRES_IN")
+        self.url_cache.maxsize = app.config.get("IMAGE_URL_CACHE_SIZE")
+        self.url_cache.clear()
+
+    def image_urls(self, paths):
+        if self.url_mode == "public":
+            return self.backend.public_urls(paths)
+
+        urls = {}
+        missing = []
+        for path in paths:
+            url = self.url_cache.get(path)
+            if url is None:
+                missing.append(path)
+            else:
+                urls[path] = url
+
+        if missing:
+            signed = self.backend.signed_urls(missing, self.signed_url_expires_in)
+            # Evict cached URLs well before they expire so that clients never
+            # receive one that is about to stop working.
+            ttl = self.signed_url_expires_in * 0.8
+            for path, url in signed.items():
+                self.url_cache.set(path, url, ttl=ttl)
+            urls.update(signed)
+
+        return urls
 
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+
+storage = StorageClient()
+
+
+class IdentityCache(TTLCache):
     def init_app(self, app):
-        url = app.config.get("SUPABASE_URL")
-        key = app.config.get("SUPABASE_KEY")
-        self.client: Client = create_client(url, key)
+        self.maxsize = app.config.get("IDENTITY_CACHE_SIZE")
+        self.ttl = app.config.get("IDENTITY_CACHE_TTL")
+        self.clear()
 
 
-supabase = SupabaseClient()
+identity_cache = IdentityCache()
+
+
+class ImageQueueClient:
+    def __init__(self):
+        self.backend = None
+
+    def init_app(self, app):
+        from app.jobs import create_image_queue
+
+        self.backend = create_image_queue(app)
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+
+image_queue = ImageQueueClient()
 
 
 def create_app(config_class=Config):
     app = Flask(__name__)
-    CORS(
-        app,
-        origins=[
-            "https://insurance-claim-example-app.vercel.app",
-            "http://localhost:3000",
-        ],
-    )
+
+    from app.uploads import UploadRequest
+
+    app.request_class = UploadRequest
+    CORS(app, origins=CORS_ORIGINS)
     app.config.from_object(config_class)
+    app.json = create_json_provider(app)
 
+    pool_stats.init_app(app)
+    replica.init_app(app)
     db.init_app(app)
-    migrate.init_app(app, db)
     jwt.init_app(app)
-    supabase.init_app(app)
+    storage.init_app(app)
+    identity_cache.init_app(app)
+    claims_cache.init_app(app)
+    compress.init_app(app)
+    passwords.init_app(app)
+
+    from app import models, helpers, search
 
-    from app import models, schemas, helpers
+    image_queue.init_app(app)
 
     from app.routes import bp as main_bp
 
     app.register_blueprint(main_bp)
 
-    return app
+    from app.commands import (
+        MigrateGroup,
+        export_claims_command,
+        import_claims_command,
+        process_images_command,
+        purge_idempotency_keys_command,
+        rebuild_claim_stats_command,
+        storage_stats_command,
+    )
 
+    app.cli.add_command(MigrateGroup())
+    app.cli.add_command(export_claims_command)
+    app.cli.add_command(import_claims_command)
+    app.cli.add_command(process_images_command)
+    app.cli.add_command(purge_idempotency_keys_command)
+    app.cli.add_command(rebuild_claim_stats_command)
+    app.cli.add_command(storage_stats_command)
 
-app = create_app()
+    return app
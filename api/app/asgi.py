@@ -0,0 +1,562 @@
+from app import (
+    CORS_ORIGINS,
+    claims_cache,
+    compress,
+    create_app,
+    image_queue,
+    pool_stats,
+    replica,
+    storage,
+)
+from app.async_storage import AsyncStorageClient
+from app.claims import (
+    add_claim,
+    claims_after,
+    claims_page,
+    created_claim,
+    stored_images,
+)
+from app.helpers import (
+    claims_etag,
+    decode_cursor,
+    matching_etag,
+    parse_claim_filters,
+    parse_claim_sort,
+    validate_files,
+)
+from app.idempotency import (
+    MAX_KEY_LENGTH,
+    IdempotencyConflict,
+    finish_key,
+    in_flight,
+    release_key,
+    request_fingerprint,
+    reserve_key,
+)
+from app.pool import pool_options
+from app.models import (
+    Claim,
+    attach_image_urls,
+    claim_progress,
+    claims_version,
+    image_paths,
+    lookup_user,
+    serialize_claims,
+    token_user,
+)
+from app.schemas import ClaimCreate
+from app.uploads import prepare_uploads, upload_stream
+from asgiref.wsgi import WsgiToAsgi
+from config import Config
+from flask_jwt_extended import decode_token
+from flask_jwt_extended.exceptions import JWTExtendedException
+from jwt.exceptions import ExpiredSignatureError, InvalidTokenError
+from pydantic import ValidationError
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import joinedload
+from starlette.applications import Starlette
+from starlette.exceptions import HTTPException as StarletteHTTPException
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import Response
+from starlette.routing import Mount, Route
+from types import SimpleNamespace
+from werkzeug.datastructures import FileStorage, MultiDict
+from werkzeug.exceptions import BadRequest, HTTPException, RequestEntityTooLarge
+from werkzeug.http import (
+    http_date,
+    parse_accept_header,
+    parse_date,
+    parse_etags,
+    parse_options_header,
+)
+from werkzeug.sansio.multipart import (
+    Data,
+    Epilogue,
+    Field,
+    File,
+    MultipartDecoder,
+    NeedData,
+)
+import sqlalchemy as sa
+import asyncio
+import contextlib
+import time
+
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+
+class TokenError(Exception):
+    def __init__(self, message, status_code=401):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+def async_database_uri(uri):
+    url = sa.make_url(uri)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver for {backend}")
+    return url.set(drivername=ASYNC_DRIVERS[backend])
+
+
+def json_response(request, payload, status_code=200, etag=None, last_modified=None):
+    body = request.app.state.flask_app.json.dumps(payload).encode()
+    return body_response(request, body, status_code, etag, last_modified)
+
+
+def body_response(request, body, status_code=200, etag=None, last_modified=None):
+    headers = {}
+    if compress.encoders:
+        headers["Vary"] = "Accept-Encoding"
+        accept = parse_accept_header(request.headers.get("Accept-Encoding"))
+        body, encoding = compress.encode(body, accept)
+        if encoding is not None:
+            headers["Content-Encoding"] = encoding
+            if etag is not None:
+                etag = f"{etag}-{encoding}"
+    return Response(
+        body,
+        status_code,
+        {**headers, **validators(etag, last_modified)},
+        media_type="application/json",
+    )
+
+
+def validators(etag, last_modified):
+    if etag is None:
+        return {}
+    headers = {"ETag": f'"{etag}"', "Cache-Control": "private, no-cache"}
+    if last_modified is not None:
+        headers["Last-Modified"] = http_date(last_modified)
+    return headers
+
+
+def cached_etag(request, etag, last_modified):
+    return matching_etag(
+        compress.etag_variants(etag),
+        parse_etags(request.headers.get("If-None-Match")),
+        parse_date(request.headers.get("If-Modified-Since")),
+        last_modified,
+    )
+
+
+def not_modified(etag, last_modified):
+    return Response(status_code=304, headers=validators(etag, last_modified))
+
+
+def query_args(request):
+    return MultiDict(request.query_params.multi_items())
+
+
+def include_urls(args):
+    return args.get("include_urls", "false").lower() == "true"
+
+
+def token_claims(request):
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    if scheme != "Bearer" or not token:
+        raise TokenError("Missing Authorization Header")
+
+    try:
+        with request.app.state.flask_app.app_context():
+            claims = decode_token(token)
+    except ExpiredSignatureError:
+        raise TokenError("Token has expired")
+    except (InvalidTokenError, JWTExtendedException):
+        raise TokenError("Invalid token")
+    if claims.get("type") != "access":
+        raise TokenError("Only non-refresh tokens are allowed", 422)
+    return claims
+
+
+def token_identity(request, claims):
+    return claims[request.app.state.flask_app.config["JWT_IDENTITY_CLAIM"]]
+
+
+def read_sessions(request, claims):
+    state = request.app.state
+    if replica.use_replica(claims):
+        return state.replica_sessions
+    return state.sessions
+
+
+async def current_user(request, session, claims=None):
+    if claims is None:
+        claims = token_claims(request)
+    email = token_identity(request, claims)
+    user = token_user(email, claims)
+    if user is None:
+        user = await session.run_sync(lambda s: lookup_user(email, s))
+    return user
+
+
+async def claims_validators(session, user, scope, with_urls):
+    if with_urls and storage.url_mode == "signed":
+        return None, None
+
+    version, modified_at = await session.run_sync(
+        lambda s: claims_version(user.id, s)
+    )
+    return claims_etag(user.id, version, scope), modified_at
+
+
+async def with_image_urls(request, items):
+    state = request.app.state
+    # Local storage builds its URLs with url_for, for the host of this request.
+    # The context is copied to the thread the storage call runs on.
+    with state.flask_app.test_request_context(base_url=str(request.base_url)):
+        urls = await state.storage.image_urls(image_paths(items))
+    attach_image_urls(items, urls)
+    return items
+
+
+def cache_claims(request, user, payload, etag, last_modified):
+    body = request.app.state.flask_app.json.dumps(payload).encode()
+    claims_cache.set(user.id, etag, body)
+    return body_response(request, body, 200, etag, last_modified)
+
+
+async def get_claims(request):
+    args = query_args(request)
+    claims = token_claims(request)
+    async with read_sessions(request, claims)() as session:
+        user = await current_user(request, session, claims)
+        if user is None:
+            return json_response(request, {"error": "User not found"}, 404)
+
+        page = args.get("page", 1, type=int)
+        per_page = args.get("per_page", 10, type=int)
+
+        try:
+            filters = parse_claim_filters(args)
+            sort = parse_claim_sort(args.get("sort"))
+        except ValueError as e:
+            return json_response(request, {"error": str(e)}, 400)
+
+        with_urls = include_urls(args)
+        scope = f"{request.url.path}?{request.url.query}"
+        etag, last_modified = await claims_validators(session, user, scope, with_urls)
+        cached = etag and cached_etag(request, etag, last_modified)
+        if cached:
+            return not_modified(cached, last_modified)
+
+        body = claims_cache.get(user.id, etag)
+        if body is not None:
+            return body_response(request, body, 200, etag, last_modified)
+
+        if "cursor" in args:
+            if sort != [("id", True)]:
+                return json_response(
+                    request, {"error": "Cursor pagination only sorts by -id"}, 400
+                )
+            try:
+                after_id = decode_cursor(args.get("cursor"))
+            except ValueError as e:
+                return json_response(request, {"error": str(e)}, 400)
+            with_total = args.get("with_total", "false").lower() == "true"
+            payload = await session.run_sync(
+                claims_after, user.id, filters, after_id, per_page, with_total
+            )
+        else:
+            payload = await session.run_sync(
+                claims_page, user.id, filters, sort, page, per_page
+            )
+
+    if with_urls:
+        await with_image_urls(request, payload["claims"])
+    return cache_claims(request, user, payload, etag, last_modified)
+
+
+def load_claim(session, user_id, claim_id):
+    claim = (
+        session.execute(
+            sa.select(Claim)
+            .options(joinedload(Claim.images))
+            .where(Claim.id == claim_id, Claim.user_id == user_id)
+        )
+        .unique()
+        .scalar()
+    )
+    if claim is None:
+        return None
+    return serialize_claims([claim])[0], claim_progress(claim.id, session)
+
+
+async def serve_image(request):
+    claim_id = request.path_params["id"]
+    claims = token_claims(request)
+    async with read_sessions(request, claims)() as session:
+        user = await current_user(request, session, claims)
+        if user is None:
+            return json_response(request, {"error": "User not found"}, 404)
+
+        etag, last_modified = await claims_validators(
+            session, user, f"claim:{claim_id}", True
+        )
+        cached = etag and cached_etag(request, etag, last_modified)
+        if cached:
+            return not_modified(cached, last_modified)
+
+        loaded = await session.run_sync(load_claim, user.id, claim_id)
+
+    if loaded is None:
+        return json_response(request, {"error": "Claim not found"}, 404)
+    claim, progress = loaded
+    await with_image_urls(request, [claim])
+
+    return json_response(
+        request,
+        {
+            "claim": claim,
+            "images": [image["url"] for image in claim["images"]],
+            "progress": progress,
+        },
+        200,
+        etag,
+        last_modified,
+    )
+
+
+async def parse_form(request, config):
+    """Parse a multipart body as it arrives, with the checks of UploadRequest."""
+    fields, files = MultiDict(), MultiDict()
+    mimetype, options = parse_options_header(request.headers.get("Content-Type"))
+    if mimetype != "multipart/form-data" or "boundary" not in options:
+        return fields, files
+
+    decoder = MultipartDecoder(options["boundary"].encode("latin-1"))
+    received = 0
+    upload_count = 0
+    try:
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > config.get("MAX_CONTENT_LENGTH"):
+                raise RequestEntityTooLarge()
+            decoder.receive_data(chunk or None)
+            event = decoder.next_event()
+            while not isinstance(event, (Epilogue, NeedData)):
+                if isinstance(event, Field):
+                    part, container = event, bytearray()
+                elif isinstance(event, File):
+                    upload_count += 1
+                    part = event
+                    container = upload_stream(
+                        config,
+                        upload_count,
+                        event.filename,
+                        event.headers.get("Content-Type"),
+                    )
+                elif isinstance(event, Data):
+                    if isinstance(container, bytearray):
+                        container.extend(event.data)
+                    else:
+                        container.write(event.data)
+                    if not event.more_data and isinstance(part, Field):
+                        fields.add(part.name, container.decode("utf-8", "replace"))
+                    elif not event.more_data:
+                        container.seek(0)
+                        files.add(
+                            part.name,
+                            FileStorage(
+                                container,
+                                part.filename,
+                                part.name,
+                                headers=part.headers,
+                            ),
+                        )
+                event = decoder.next_event()
+    except Exception:
+        close_files(files)
+        raise
+    return fields, files
+
+
+def close_files(files):
+    for file in files.values():
+        file.close()
+
+
+async def submit_claim(request, session, user, form, files):
+    state = request.app.state
+    config = state.flask_app.config
+
+    try:
+        claim_data = ClaimCreate(**form.to_dict())
+    except ValidationError as e:
+        return {"error": e.errors()}, 400
+
+    valid, files_or_error = validate_files(SimpleNamespace(files=files))
+    if not valid:
+        return {"error": files_or_error}, 400
+
+    uploads = prepare_uploads(files_or_error)
+    stored, owned = await session.run_sync(stored_images, user.id, uploads)
+    own = [upload for upload in uploads if upload.content_hash in owned]
+    fresh = [upload for upload in uploads if upload.content_hash not in stored]
+
+    if image_queue.backend is None and fresh:
+        try:
+            uploaded = await state.storage.upload_files(config, fresh, session)
+        except Exception as e:
+            state.flask_app.logger.exception("Failed to store claim images")
+            return {"error": str(e)}, 500
+        stored.update(uploaded)
+
+    claim_id, status, jobs = await session.run_sync(
+        add_claim, user.id, claim_data, uploads, stored
+    )
+    if jobs:
+        image_queue.submit(jobs)
+
+    with state.flask_app.app_context():
+        return created_claim(user, claim_id, status, own), 201
+
+
+async def acquire_key(session, user_id, key, fingerprint, config):
+    deadline = time.monotonic() + config.get("IDEMPOTENCY_WAIT_TIMEOUT")
+    while True:
+        row = await session.run_sync(reserve_key, user_id, key, fingerprint, config)
+        if not in_flight(row, fingerprint, deadline):
+            return row
+        await asyncio.sleep(config.get("IDEMPOTENCY_POLL_INTERVAL"))
+
+
+async def create_claim(request):
+    state = request.app.state
+    config = state.flask_app.config
+
+    try:
+        content_length = int(request.headers.get("Content-Length") or 0)
+    except ValueError:
+        raise BadRequest("Invalid Content-Length")
+    if content_length > config.get("MAX_CONTENT_LENGTH"):
+        raise RequestEntityTooLarge()
+
+    # Reject anonymous requests before their body is read and spooled.
+    claims = token_claims(request)
+    form, files = await parse_form(request, config)
+    key = request.headers.get("Idempotency-Key")
+    try:
+        async with state.sessions() as session:
+            user = await current_user(request, session, claims)
+            if user is None:
+                return json_response(request, {"error": "User not found"}, 404)
+            if not key:
+                return json_response(
+                    request, *await submit_claim(request, session, user, form, files)
+                )
+            if len(key) > MAX_KEY_LENGTH:
+                return json_response(
+                    request, {"error": "Idempotency-Key is too long"}, 400
+                )
+
+            fingerprint = request_fingerprint(form, files)
+            row = await acquire_key(session, user.id, key, fingerprint, config)
+            if row is not None:
+                response = body_response(request, row.response, row.status_code)
+                response.headers["Idempotent-Replayed"] = "true"
+                return response
+
+            try:
+                payload, status_code = await submit_claim(
+                    request, session, user, form, files
+                )
+            except BaseException:
+                await session.rollback()
+                await session.run_sync(release_key, user.id, key)
+                raise
+            body = state.flask_app.json.dumps(payload).encode()
+            await session.run_sync(finish_key, user.id, key, status_code, body)
+            return body_response(request, body, status_code)
+    finally:
+        close_files(files)
+
+
+async def token_error(request, exc):
+    if exc.message == "Invalid token":
+        return json_response(request, {"message": exc.message}, exc.status_code)
+    return json_response(request, {"msg": exc.message}, exc.status_code)
+
+
+async def idempotency_conflict(request, exc):
+    response = await http_error(request, exc)
+    response.headers["Retry-After"] = "1"
+    return response
+
+
+async def http_error(request, exc):
+    return json_response(request, {"error": exc.description}, exc.code)
+
+
+async def starlette_http_error(request, exc):
+    return json_response(request, {"error": exc.detail}, exc.status_code)
+
+
+def async_engine(config, name, uri):
+    url = async_database_uri(uri)
+    options = pool_stats.instrument(
+        name, pool_options(config, url), async_engine=True
+    )
+    if config.get("DB_POOL_MODE") == "null" and url.get_backend_name() == "postgresql":
+        # Prepared statements do not survive a transaction pooler.
+        url = url.update_query_dict({"prepared_statement_cache_size": "0"})
+        options["connect_args"] = {"statement_cache_size": 0}
+    return create_async_engine(url, **options)
+
+
+def create_asgi_app(config_class=Config):
+    """Serve the I/O bound claim routes natively and the rest through Flask."""
+    flask_app = create_app(config_class)
+
+    config = flask_app.config
+    engine = async_engine(config, "async", config["SQLALCHEMY_DATABASE_URI"])
+    replica_engine = engine
+    if replica.enabled:
+        replica_engine = async_engine(
+            config, "async_replica", config["SQLALCHEMY_REPLICA_URI"]
+        )
+    async_storage = AsyncStorageClient()
+    async_storage.init_app(storage)
+
+    @contextlib.asynccontextmanager
+    async def lifespan(app):
+        yield
+        await engine.dispose()
+        await replica_engine.dispose()
+
+    app = Starlette(
+        routes=[
+            Route("/api/claims", get_claims, methods=["GET"]),
+            Route("/api/claims", create_claim, methods=["POST"]),
+            Route("/api/claims/{id:int}", serve_image, methods=["GET"]),
+            Mount("/", WsgiToAsgi(flask_app)),
+        ],
+        middleware=[
+            Middleware(
+                CORSMiddleware,
+                allow_origins=CORS_ORIGINS,
+                allow_methods=["*"],
+                allow_headers=["*"],
+            )
+        ],
+        exception_handlers={
+            TokenError: token_error,
+            IdempotencyConflict: idempotency_conflict,
+            HTTPException: http_error,
+            StarletteHTTPException: starlette_http_error,
+        },
+        lifespan=lifespan,
+    )
+    app.state.flask_app = flask_app
+    app.state.engine = engine
+    app.state.sessions = async_sessionmaker(engine, expire_on_commit=False)
+    app.state.replica_sessions = async_sessionmaker(
+        replica_engine, expire_on_commit=False
+    )
+    app.state.storage = async_storage
+    return app
@@ -0,0 +1,191 @@
+from app.derivatives import (
+    derivative_names,
+    render_args,
+    render_derivatives,
+    render_derivatives_async,
+)
+from app.storage import SupabaseStorage
+from app.uploads import image_source, unreferenced_paths, upload_body
+import asyncio
+
+
+class AsyncSupabaseStorage:
+    def __init__(self, url, key, bucket):
+        self.url = url
+        self.key = key
+        self.bucket = bucket
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            from storage3 import AsyncStorageClient
+
+            self._client = AsyncStorageClient(
+                f"{self.url}/storage/v1",
+                {"apiKey": self.key, "Authorization": f"Bearer {self.key}"},
+            )
+        return self._client
+
+    def _bucket(self):
+        return self.client.from_(self.bucket)
+
+    async def upload(self, path, body, content_type=None):
+        options = {"content-type": content_type} if content_type else None
+        if not isinstance(body, bytes):
+            # storage3 streams a reader in chunks instead of loading the file.
+            body.seek(0)
+        await self._bucket().upload(path, body, options)
+
+    async def delete(self, paths):
+        if paths:
+            await self._bucket().remove(list(paths))
+
+    async def exists(self, path):
+        folder, _, name = path.rpartition("/")
+        files = await self._bucket().list(folder or None, {"search": name})
+        return any(file["name"] == name for file in files)
+
+    async def public_urls(self, paths):
+        bucket = self._bucket()
+        return {path: await bucket.get_public_url(path) for path in paths}
+
+    async def signed_urls(self, paths, expires_in):
+        if not paths:
+            return {}
+        signed = await self._bucket().create_signed_urls(list(paths), expires_in)
+        return {item["path"]: item["signedURL"] for item in signed}
+
+
+class ThreadedStorage:
+    # Local and in-memory backends have no async client, their calls are run
+    # on the default executor instead.
+    def __init__(self, backend):
+        self.backend = backend
+
+    def __getattr__(self, name):
+        method = getattr(self.backend, name)
+
+        async def call(*args):
+            return await asyncio.to_thread(method, *args)
+
+        return call
+
+
+class AsyncStorageClient:
+    def __init__(self):
+        self.backend = None
+        self.storage = None
+
+    def init_app(self, storage):
+        # Shares the sync client's configuration and signed URL cache.
+        self.storage = storage
+        if isinstance(storage.backend, SupabaseStorage):
+            backend = storage.backend
+            self.backend = AsyncSupabaseStorage(
+                backend.url, backend.key, backend.bucket
+            )
+        else:
+            self.backend = ThreadedStorage(storage.backend)
+
+    async def image_urls(self, paths):
+        if self.storage.url_mode == "public":
+            return await self.backend.public_urls(paths)
+
+        cache = self.storage.url_cache
+        urls = {path: cache.get(path) for path in paths}
+        missing = [path for path, url in urls.items() if url is None]
+        if missing:
+            expires_in = self.storage.signed_url_expires_in
+            signed = await self.backend.signed_urls(missing, expires_in)
+            for path, url in signed.items():
+                cache.set(path, url, ttl=expires_in * 0.8)
+            urls.update(signed)
+        return urls
+
+    async def upload_once(self, path, body, content_type):
+        try:
+            await self.backend.upload(path, body, content_type)
+        except Exception:
+            if not await self.backend.exists(path):
+                raise
+            return False
+        return True
+
+    async def store_image(self, config, path, body, content_type, created):
+        if not config.get("IMAGE_DERIVATIVES"):
+            if await self.upload_once(path, body, content_type):
+                created.append(path)
+            return {"image_file": path}
+
+        source = image_source(body)
+        if config.get("IMAGE_DERIVATIVE_WORKERS"):
+            rendering = asyncio.wrap_future(render_derivatives_async(config, source))
+        else:
+            # Without the process pool, render in a thread, not on the event loop.
+            rendering = asyncio.ensure_future(
+                asyncio.to_thread(render_derivatives, *render_args(config, source))
+            )
+        if not isinstance(body, bytes):
+            body.seek(0)
+        if await self.upload_once(path, body, content_type):
+            created.append(path)
+        stored = {"image_file": path}
+        try:
+            rendered = await rendering
+            if rendered is not None:
+                extension = config.get("IMAGE_DERIVATIVE_FORMAT").lower()
+                names = derivative_names(path, extension)
+                wrote = await asyncio.gather(
+                    *[
+                        self.upload_once(names[kind], data, f"image/{extension}")
+                        for kind, data in rendered.items()
+                    ]
+                )
+                created.extend(
+                    names[kind] for kind, written in zip(rendered, wrote) if written
+                )
+                stored.update({f"{kind}_file": names[kind] for kind in rendered})
+        except Exception:
+            await self.backend.delete(created)
+            raise
+        return stored
+
+    async def upload_file(self, config, upload, slots, created):
+        async with slots:
+            body = upload_body(upload.file.stream)
+            try:
+                return await self.store_image(
+                    config, upload.path, body, upload.file.mimetype, created
+                )
+            finally:
+                if not isinstance(body, bytes):
+                    body.close()
+
+    async def upload_files(self, config, uploads, session):
+        # The uploads wait on the event loop instead of holding a thread each,
+        # UPLOAD_CONCURRENCY still bounds how many one request runs at once.
+        unique = list({upload.content_hash: upload for upload in uploads}.values())
+        slots = asyncio.Semaphore(config.get("UPLOAD_CONCURRENCY"))
+        created = {upload.content_hash: [] for upload in unique}
+        results = await asyncio.gather(
+            *[
+                self.upload_file(config, upload, slots, created[upload.content_hash])
+                for upload in unique
+            ],
+            return_exceptions=True,
+        )
+        uploaded = {
+            upload.content_hash: result
+            for upload, result in zip(unique, results)
+            if not isinstance(result, BaseException)
+        }
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if errors:
+            if uploaded:
+                paths = await session.run_sync(
+                    lambda s: unreferenced_paths(uploaded, created, s)
+                )
+                await self.backend.delete(paths)
+            raise errors[0]
+        return uploaded
@@ -0,0 +1,126 @@
+from app import image_queue, replica
+from app.helpers import encode_cursor
+from app.jobs import create_image_jobs
+from app.models import (
+    Claim,
+    Image,
+    claim_conditions,
+    claim_ordering,
+    find_stored_images,
+    identity_claims,
+    own_content_hashes,
+    serialize_claims,
+    touch_claims,
+)
+from app.stats import record_claim_stats
+from flask_jwt_extended import create_access_token
+import sqlalchemy as sa
+import math
+
+# Listing and creating claims, shared by the Flask routes and the ASGI server.
+# Each helper takes the session to run in, a sync one or the one behind
+# AsyncSession.run_sync.
+
+
+def user_claims(user_id, filters):
+    return sa.select(Claim).where(Claim.user_id == user_id, *claim_conditions(filters))
+
+
+def claims_page(session, user_id, filters, sort, page, per_page):
+    """A page of the user's claims, without image URLs."""
+    # Out of range values are handled like Flask-SQLAlchemy's paginate.
+    page = max(page, 1)
+    if per_page < 1:
+        per_page = 20
+    stmt = user_claims(user_id, filters)
+    total = session.scalar(sa.select(sa.func.count()).select_from(stmt.subquery()))
+    claims = session.scalars(
+        stmt.order_by(*claim_ordering(sort))
+        .limit(per_page)
+        .offset((page - 1) * per_page)
+    ).all()
+    return {
+        "claims": serialize_claims(claims, session=session),
+        "total": total,
+        "pages": math.ceil(total / per_page),
+        "current_page": page,
+    }
+
+
+def claims_after(session, user_id, filters, after_id, per_page, with_total):
+    """The user's claims after the cursor, newest first, without image URLs."""
+    per_page = max(per_page, 1)
+    stmt = user_claims(user_id, filters)
+    total = None
+    if with_total:
+        total = session.scalar(sa.select(sa.func.count()).select_from(stmt.subquery()))
+    if after_id is not None:
+        stmt = stmt.where(Claim.id < after_id)
+    # One extra row tells us whether there is a next page without a COUNT(*).
+    claims = session.scalars(
+        stmt.order_by(Claim.id.desc()).limit(per_page + 1)
+    ).all()
+    has_next = len(claims) > per_page
+    claims = claims[:per_page]
+    page = {
+        "claims": serialize_claims(claims, session=session),
+        "next_cursor": encode_cursor(claims[-1].id) if has_next else None,
+    }
+    if total is not None:
+        page["total"] = total
+    return page
+
+
+def stored_images(session, user_id, uploads):
+    """The stored content of `uploads` by hash, and the hashes the user owns."""
+    stored = find_stored_images([upload.content_hash for upload in uploads], session)
+    owned = own_content_hashes(user_id, list(stored), session)
+    # End the read transaction, so no connection is held while uploading.
+    session.commit()
+    return stored, owned
+
+
+def add_claim(session, user_id, claim_data, uploads, stored):
+    """Add the claim with an image for each upload whose content is in `stored`.
+
+    The others are queued, and everything is committed at once, so a claim is
+    only added once its images are stored or queued.
+    """
+    claim = Claim(user_id=user_id, **claim_data.model_dump())
+    session.add(claim)
+    session.flush()
+    session.add_all(
+        Image(
+            claim_id=claim.id,
+            content_hash=upload.content_hash,
+            size=upload.size,
+            **stored[upload.content_hash],
+        )
+        for upload in uploads
+        if upload.content_hash in stored
+    )
+    record_claim_stats(user_id, [claim], session)
+    touch_claims(user_id, session)
+
+    jobs = []
+    fresh = [upload for upload in uploads if upload.content_hash not in stored]
+    if fresh:
+        claim.status = "processing"
+        jobs = create_image_jobs(claim, fresh, image_queue.store_payload, session)
+    session.commit()
+    return claim.id, claim.status, jobs
+
+
+def created_claim(user, claim_id, status, own):
+    """The body of a 201 from POST /api/claims; needs an app context."""
+    return {
+        "message": "Claim created successfully",
+        "claim_id": claim_id,
+        "status": status,
+        "deduplicated": len(own),
+        "bytes_saved": sum(upload.size for upload in own),
+        "access_token": create_access_token(
+            identity=user.email,
+            additional_claims={**identity_claims(user), **replica.wrote()},
+        ),
+    }
@@ -0,0 +1,132 @@
+from app import db, image_queue
+from app.jobs import DatabaseImageQueue
+from app.export import EXPORT_FORMATS, claims_query, iter_batches
+from app.idempotency import purge_expired_keys
+from app.ingest import INGEST_FORMATS, ingest_claims
+from app.models import User, storage_stats
+from app.stats import rebuild_claim_stats
+from flask import current_app
+from flask.cli import ScriptInfo
+import click
+import json
+import sys
+import time
+
+
+@click.command("export-claims")
+@click.option(
+    "--format",
+    "export_format",
+    type=click.Choice(list(EXPORT_FORMATS)),
+    default="ndjson",
+)
+@click.option("--user", "email", help="Only export claims of this user.")
+@click.option("--output", "-o", type=click.Path(dir_okay=False, writable=True))
+@click.option("--batch-size", type=int, default=1000, show_default=True)
+def export_claims_command(export_format, email, output, batch_size):
+    """Stream claims to a file or stdout."""
+    user_id = None
+    if email is not None:
+        user = User.query.filter_by(email=email).first()
+        if user is None:
+            raise click.ClickException(f"No user with email {email}")
+        user_id = user.id
+
+    exporter, _ = EXPORT_FORMATS[export_format]
+    chunks = exporter(iter_batches(claims_query(user_id), batch_size))
+
+    binary = export_format == "parquet"
+    if output is None:
+        stream = sys.stdout.buffer if binary else sys.stdout
+        for chunk in chunks:
+            stream.write(chunk)
+        return
+
+    with open(output, "wb" if binary else "w", newline=None if binary else "") as f:
+        for chunk in chunks:
+            f.write(chunk)
+
+
+@click.command("process-images")
+@click.option("--once", is_flag=True, help="Process one batch and exit.")
+@click.option("--batch-size", type=int, default=10, show_default=True)
+@click.option("--poll-interval", type=float, default=1.0, show_default=True)
+def process_images_command(once, batch_size, poll_interval):
+    """Upload queued claim images to storage."""
+    if not isinstance(image_queue.backend, DatabaseImageQueue):
+        raise click.ClickException("IMAGE_QUEUE_BACKEND is not set to database")
+
+    while True:
+        processed = image_queue.work_once(batch_size)
+        if once:
+            click.echo(f"Processed {processed} image jobs")
+            return
+        if not processed:
+            time.sleep(poll_interval)
+
+
+@click.command("storage-stats")
+def storage_stats_command():
+    """Report how much storage content deduplication saves."""
+    for key, value in storage_stats().items():
+        click.echo(f"{key}: {value}")
+
+
+@click.command("import-claims")
+@click.argument("input_file", type=click.File("r", encoding="utf-8"))
+@click.option("--user", "email", required=True, help="Owner of the claims.")
+@click.option("--format", "ingest_format", type=click.Choice(list(INGEST_FORMATS)))
+@click.option("--chunk-size", type=int, help="Rows inserted per transaction.")
+def import_claims_command(input_file, email, ingest_format, chunk_size):
+    """Load claims from a JSON lines or CSV file and print an error report."""
+    user = User.query.filter_by(email=email).first()
+    if user is None:
+        raise click.ClickException(f"No user with email {email}")
+
+    if ingest_format is None:
+        ingest_format = "csv" if input_file.name.endswith(".csv") else "ndjson"
+
+    report = ingest_claims(
+        INGEST_FORMATS[ingest_format](input_file),
+        user.id,
+        chunk_size or current_app.config.get("INGEST_CHUNK_SIZE"),
+        current_app.config.get("INGEST_MAX_ERRORS"),
+    )
+    for error in report["errors"]:
+        click.echo(json.dumps(error), err=True)
+    click.echo(f"Inserted {report['inserted']} claims, {report['failed']} failed")
+
+
+@click.command("rebuild-claim-stats")
+def rebuild_claim_stats_command():
+    """Recompute the claim statistics summary table from the claims."""
+    buckets = rebuild_claim_stats()
+    click.echo(f"Rebuilt {buckets} claim stat buckets")
+
+
+@click.command("purge-idempotency-keys")
+def purge_idempotency_keys_command():
+    """Delete idempotency keys past their expiry."""
+    click.echo(f"Deleted {purge_expired_keys()} expired idempotency keys")
+
+
+class MigrateGroup(click.Group):
+    """`flask db`, importing Flask-Migrate and alembic only when it is used."""
+
+    def __init__(self):
+        super().__init__("db", help="Perform database migrations.")
+
+    def migrate_group(self, ctx):
+        from flask_migrate import Migrate
+        from flask_migrate.cli import db as db_group
+
+        app = ctx.ensure_object(ScriptInfo).load_app()
+        if "migrate" not in app.extensions:
+            Migrate(app, db)
+        return db_group
+
+    def list_commands(self, ctx):
+        return self.migrate_group(ctx).list_commands(ctx)
+
+    def get_command(self, ctx, name):
+        return self.migrate_group(ctx).get_command(ctx, name)
@@ -0,0 +1,80 @@
+from flask import request
+import gzip
+
+COMPRESSIBLE_MIMETYPES = {
+    "application/json",
+    "application/x-ndjson",
+    "text/csv",
+    "text/plain",
+}
+
+
+def brotli_module():
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+
+class Compress:
+    def __init__(self):
+        self.encoders = {}
+
+    def init_app(self, app):
+        self.min_size = app.config.get("COMPRESS_MIN_SIZE")
+        self.encoders = {}
+        if app.config.get("COMPRESS_ENABLED"):
+            brotli = brotli_module()
+            if brotli is not None:
+                quality = app.config.get("COMPRESS_BROTLI_QUALITY")
+                self.encoders["br"] = lambda data: brotli.compress(
+                    data, quality=quality
+                )
+            level = app.config.get("COMPRESS_GZIP_LEVEL")
+            self.encoders["gzip"] = lambda data: gzip.compress(
+                data, compresslevel=level, mtime=0
+            )
+        app.after_request(self.compress_response)
+
+    def etag_variants(self, etag):
+        return [etag] + [f"{etag}-{encoding}" for encoding in self.encoders]
+
+    def choose_encoding(self, accept_encodings):
+        # Brotli is preferred when the client accepts both.
+        for encoding in self.encoders:
+            if accept_encodings[encoding]:
+                return encoding
+        return None
+
+    def encode(self, data, accept_encodings):
+        """Return the body to send and its encoding, None if sent as is."""
+        encoding = self.choose_encoding(accept_encodings)
+        if encoding is None or len(data) < self.min_size:
+            return data, None
+        return self.encoders[encoding](data), encoding
+
+    def compress_response(self, response):
+        if (
+            not self.encoders
+            or response.direct_passthrough
+            or response.is_streamed
+            or response.status_code < 200
+            or response.status_code in (204, 304)
+            or "Content-Encoding" in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES
+        ):
+            return response
+
+        response.vary.add("Accept-Encoding")
+        data, encoding = self.encode(response.get_data(), request.accept_encodings)
+        if encoding is None:
+            return response
+
+        response.set_data(data)
+        response.headers["Content-Encoding"] = encoding
+        # Each encoding is a different representation with its own ETag.
+        etag, weak = response.get_etag()
+        if etag is not None:
+            response.set_etag(f"{etag}-{encoding}", weak)
+        return response
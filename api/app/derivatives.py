@@ -0,0 +1,100 @@
+from concurrent.futures import Future, ProcessPoolExecutor
+import io
+import math
+import multiprocessing
+import threading
+
+DERIVATIVES = {
+    "thumbnail": "thumb",
+    "display": "display",
+}
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def derivative_names(filename, extension):
+    base = filename.rsplit(".", 1)[0]
+    return {
+        kind: f"{base}.{suffix}.{extension}" for kind, suffix in DERIVATIVES.items()
+    }
+
+
+def render_derivatives(
+    source, thumbnail_size, display_size, image_format, quality, max_pixels
+):
+    """Render the derivatives of `source`, the image's bytes or its path."""
+    from PIL import Image, ImageOps, UnidentifiedImageError
+
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    try:
+        with Image.open(source) as original:
+            # JPEGs can be decoded at a fraction of their size, as long as it
+            # still covers the display derivative.
+            width, height = original.size
+            scale = display_size / max(width, height)
+            if scale < 1:
+                original.draft(
+                    "RGB", (math.ceil(width * scale), math.ceil(height * scale))
+                )
+                width, height = original.size
+            if width * height > max_pixels:
+                # Too large to decode safely; the original is kept without
+                # derivatives.
+                return None
+            # Apply the EXIF orientation before dropping the metadata, which
+            # is never copied to the derivatives.
+            image = ImageOps.exif_transpose(original).convert("RGB")
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError):
+        return None
+
+    rendered = {}
+    for kind, size in (("display", display_size), ("thumbnail", thumbnail_size)):
+        image.thumbnail((size, size))
+        buffer = io.BytesIO()
+        image.save(buffer, format=image_format, quality=quality, optimize=True)
+        rendered[kind] = buffer.getvalue()
+    return rendered
+
+
+def derivative_pool(max_workers):
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                # The pool is started from upload threads, and forking a
+                # process that runs threads can deadlock the child on a lock
+                # another thread held.
+                method = (
+                    "forkserver"
+                    if "forkserver" in multiprocessing.get_all_start_methods()
+                    else "spawn"
+                )
+                _pool = ProcessPoolExecutor(
+                    max_workers=max_workers,
+                    mp_context=multiprocessing.get_context(method),
+                )
+    return _pool
+
+
+def render_args(config, source):
+    return (
+        source,
+        config.get("IMAGE_THUMBNAIL_SIZE"),
+        config.get("IMAGE_DISPLAY_SIZE"),
+        config.get("IMAGE_DERIVATIVE_FORMAT"),
+        config.get("IMAGE_DERIVATIVE_QUALITY"),
+        config.get("MAX_IMAGE_PIXELS"),
+    )
+
+
+def render_derivatives_async(config, source):
+    args = render_args(config, source)
+    workers = config.get("IMAGE_DERIVATIVE_WORKERS")
+    if workers:
+        return derivative_pool(workers).submit(render_derivatives, *args)
+
+    future = Future()
+    future.set_result(render_derivatives(*args))
+    return future
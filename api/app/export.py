@@ -0,0 +1,124 @@
+from app import db
+from app.models import Claim
+import sqlalchemy as sa
+import csv
+import io
+import json
+
+EXPORT_FIELDS = [
+    "id",
+    "user_id",
+    "policy_number",
+    "date_of_accident",
+    "accident_type",
+    "description",
+    "injuries_reported",
+    "damage_details",
+]
+
+EXPORT_BATCH_SIZE = 1000
+
+
+def claims_query(user_id=None):
+    stmt = sa.select(*[getattr(Claim, field) for field in EXPORT_FIELDS]).order_by(
+        Claim.id
+    )
+    if user_id is not None:
+        stmt = stmt.where(Claim.user_id == user_id)
+    return stmt
+
+
+def iter_batches(stmt, batch_size=EXPORT_BATCH_SIZE):
+    # yield_per streams rows through a server-side cursor where the driver
+    # supports it, so only one batch is held in memory at a time.
+    result = db.session.execute(stmt.execution_options(yield_per=batch_size))
+    for partition in result.partitions():
+        yield [row._asdict() for row in partition]
+
+
+def export_ndjson(batches):
+    for batch in batches:
+        yield "".join(
+            json.dumps(row, default=lambda value: value.isoformat()) + "\n"
+            for row in batch
+        )
+
+
+def export_csv(batches):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS)
+    writer.writeheader()
+    for batch in batches:
+        writer.writerows(
+            {**row, "date_of_accident": row["date_of_accident"].isoformat()}
+            for row in batch
+        )
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+class _ChunkSink(io.RawIOBase):
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def export_parquet(batches):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema(
+        [
+            ("id", pa.int64()),
+            ("user_id", pa.int64()),
+            ("policy_number", pa.string()),
+            ("date_of_accident", pa.timestamp("us")),
+            ("accident_type", pa.string()),
+            ("description", pa.string()),
+            ("injuries_reported", pa.bool_()),
+            ("damage_details", pa.string()),
+        ]
+    )
+
+    # Each batch becomes one row group, flushed to the client as soon as it
+    # is written.
+    sink = _ChunkSink()
+    with pq.ParquetWriter(sink, schema) as writer:
+        for batch in batches:
+            writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+            yield sink.drain()
+    yield sink.drain()
+
+
+EXPORT_FORMATS = {
+    "ndjson": (export_ndjson, "application/x-ndjson"),
+    "csv": (export_csv, "text/csv"),
+    "parquet": (export_parquet, "application/vnd.apache.parquet"),
+}
+
+
+def parquet_available():
+    try:
+        import pyarrow.parquet  # noqa: F401
+    except ImportError:
+        return False
+    return True
@@ -1,22 +1,46 @@
 from werkzeug.datastructures import FileStorage
+from werkzeug.exceptions import BadRequest
+from datetime import datetime, timedelta, timezone
+import base64
+import hashlib
+import json
 
+ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg"}
+ALLOWED_CONTENT_TYPES = {"image/png", "image/jpeg"}
+IMAGE_SIGNATURES = {
+    b"\x89PNG\r\n\x1a\n": "image/png",
+    b"\xff\xd8\xff": "image/jpeg",
+}
+SIGNATURE_LENGTH = max(len(signature) for signature in IMAGE_SIGNATURES)
 
-def allowed_file(file):
-    ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg"}
-    ALLOWED_CONTENT_TYPES = {"image/png", "image/jpeg"}
 
+class UploadRejected(BadRequest):
+    pass
+
+
+def allowed_filename(filename, content_type):
     # Check the file extension
     has_allowed_extension = (
-        "." in file.filename
-        and file.filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
+        "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
     )
 
     # Check the content type
-    has_allowed_content_type = file.content_type in ALLOWED_CONTENT_TYPES
+    has_allowed_content_type = content_type in ALLOWED_CONTENT_TYPES
 
     return has_allowed_extension and has_allowed_content_type
 
 
+def allowed_file(file):
+    return allowed_filename(file.filename, file.content_type)
+
+
+def sniff_image(head):
+    for signature, content_type in IMAGE_SIGNATURES.items():
+        if head.startswith(signature):
+            return content_type
+    return None
+
+
 def validate_files(request):
     if "images[0]" not in request.files:
         return False, "No file part in the request"
@@ -32,4 +56,96 @@ def validate_files(request):
             return False, "No selected file"
         if not allowed_file(file):
             return False, "File type not allowed"
+        head = getattr(file.stream, "head", None)
+        if head is not None and sniff_image(head) is None:
+            return False, "File type not allowed"
     return True, files
+
+
+def encode_cursor(claim_id):
+    payload = json.dumps({"id": claim_id}, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        claim_id = json.loads(base64.urlsafe_b64decode(padded))["id"]
+    except (ValueError, TypeError, KeyError):
+        raise ValueError("Invalid cursor")
+    if not isinstance(claim_id, int):
+        raise ValueError("Invalid cursor")
+    return claim_id
+
+
+SORTABLE_FIELDS = {
+    "id",
+    "date_of_accident",
+    "accident_type",
+    "injuries_reported",
+    "policy_number",
+}
+
+
+def parse_datetime(value):
+    try:
+        parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        raise ValueError(f"Invalid date: {value}")
+    # Claims store naive UTC datetimes.
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def parse_claim_filters(args):
+    filters = {}
+    for field in ("accident_type", "policy_number"):
+        if args.get(field):
+            filters[field] = args[field]
+    if args.get("injuries_reported"):
+        value = args["injuries_reported"].lower()
+        if value not in ("true", "false"):
+            raise ValueError("injuries_reported must be true or false")
+        filters["injuries_reported"] = value == "true"
+    if args.get("date_from"):
+        filters["date_from"] = parse_datetime(args["date_from"])
+    if args.get("date_to"):
+        date_to = parse_datetime(args["date_to"])
+        if "T" in args["date_to"] or " " in args["date_to"]:
+            filters["date_to"] = date_to
+        else:
+            # A bare date includes the whole of that day.
+            filters["date_before"] = date_to + timedelta(days=1)
+    return filters
+
+
+def parse_claim_sort(value):
+    sort = []
+    for item in (value or "-id").split(","):
+        field = item.strip().lstrip("-")
+        if field not in SORTABLE_FIELDS:
+            raise ValueError(f"Cannot sort by {field}")
+        sort.append((field, item.strip().startswith("-")))
+    return sort
+
+
+def claims_etag(user_id, version, scope):
+    digest = hashlib.sha256(f"{user_id}:{version}:{scope}".encode()).hexdigest()
+    return digest[:32]
+
+
+def matching_etag(variants, if_none_match, if_modified_since, last_modified):
+    """Return the ETag of the representation the client has, if still current."""
+    if if_none_match:
+        for variant in variants:
+            if if_none_match.contains(variant):
+                return variant
+        return None
+    if if_modified_since is None or last_modified is None:
+        return None
+    if last_modified.replace(microsecond=0) <= if_modified_since.replace(tzinfo=None):
+        return variants[0]
+    return None
@@ -0,0 +1,171 @@
+from app import db
+from app.models import IdempotencyKey, load_user, utcnow
+from app.uploads import content_hash
+from datetime import timedelta
+from flask import current_app, jsonify, request
+from werkzeug.exceptions import Conflict, UnprocessableEntity
+import functools
+import hashlib
+import sqlalchemy as sa
+import time
+
+MAX_KEY_LENGTH = 255
+
+
+class IdempotencyConflict(Conflict):
+    description = "A request with this Idempotency-Key is still in progress"
+
+
+class IdempotencyKeyReused(UnprocessableEntity):
+    description = "This Idempotency-Key was used for a different request"
+
+
+def request_fingerprint(form, files):
+    sha256 = hashlib.sha256()
+    for name, value in sorted(form.items(multi=True)):
+        sha256.update(f"{name}={value}\n".encode())
+    for name, file in sorted(files.items(multi=True), key=lambda item: item[0]):
+        digest, size = content_hash(file)
+        sha256.update(f"{name}={file.filename}:{size}:{digest}\n".encode())
+    return sha256.hexdigest()
+
+
+def key_filter(user_id, key):
+    return sa.and_(IdempotencyKey.user_id == user_id, IdempotencyKey.key == key)
+
+
+def reserve_key(session, user_id, key, fingerprint, config):
+    """Hold `key` for this request, or return the row of the request holding it."""
+    while True:
+        now = utcnow()
+        lock_timeout = timedelta(seconds=config.get("IDEMPOTENCY_LOCK_TIMEOUT"))
+        # Expired keys, and keys of requests that died before finishing, are
+        # free again.
+        session.execute(
+            sa.delete(IdempotencyKey).where(
+                key_filter(user_id, key),
+                sa.or_(
+                    IdempotencyKey.expires_at <= now,
+                    sa.and_(
+                        IdempotencyKey.status_code.is_(None),
+                        IdempotencyKey.locked_at <= now - lock_timeout,
+                    ),
+                ),
+            )
+        )
+        try:
+            session.execute(
+                sa.insert(IdempotencyKey).values(
+                    user_id=user_id,
+                    key=key,
+                    fingerprint=fingerprint,
+                    locked_at=now,
+                    expires_at=now
+                    + timedelta(seconds=config.get("IDEMPOTENCY_KEY_TTL")),
+                )
+            )
+            session.commit()
+            return None
+        except sa.exc.IntegrityError:
+            session.rollback()
+
+        row = session.execute(
+            sa.select(
+                IdempotencyKey.fingerprint,
+                IdempotencyKey.status_code,
+                IdempotencyKey.response,
+            ).where(key_filter(user_id, key))
+        ).one_or_none()
+        session.commit()
+        # The row is gone if the request holding it failed in the meantime.
+        if row is not None:
+            return row
+
+
+def in_flight(row, fingerprint, deadline):
+    """Whether to wait for the request holding the key to finish."""
+    if row is None:
+        return False
+    if row.fingerprint != fingerprint:
+        raise IdempotencyKeyReused()
+    if row.status_code is not None:
+        return False
+    if time.monotonic() >= deadline:
+        raise IdempotencyConflict()
+    return True
+
+
+def acquire_key(session, user_id, key, fingerprint, config):
+    deadline = time.monotonic() + config.get("IDEMPOTENCY_WAIT_TIMEOUT")
+    while True:
+        row = reserve_key(session, user_id, key, fingerprint, config)
+        if not in_flight(row, fingerprint, deadline):
+            return row
+        time.sleep(config.get("IDEMPOTENCY_POLL_INTERVAL"))
+
+
+def finish_key(session, user_id, key, status_code, body):
+    """Keep a successful response for replay, or free the key to retry."""
+    if not 200 <= status_code < 300:
+        return release_key(session, user_id, key)
+    session.execute(
+        sa.update(IdempotencyKey)
+        .where(key_filter(user_id, key))
+        .values(status_code=status_code, response=body)
+    )
+    session.commit()
+
+
+def release_key(session, user_id, key):
+    session.execute(
+        sa.delete(IdempotencyKey).where(
+            key_filter(user_id, key), IdempotencyKey.status_code.is_(None)
+        )
+    )
+    session.commit()
+
+
+def purge_expired_keys(session=None):
+    session = session or db.session
+    result = session.execute(
+        sa.delete(IdempotencyKey).where(IdempotencyKey.expires_at <= utcnow())
+    )
+    session.commit()
+    return result.rowcount
+
+
+def idempotent(view):
+    """Replay the response of an earlier request with the same Idempotency-Key."""
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get("Idempotency-Key")
+        user = load_user() if key else None
+        if user is None:
+            return view(*args, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            return jsonify({"error": "Idempotency-Key is too long"}), 400
+
+        fingerprint = request_fingerprint(request.form, request.files)
+        config = current_app.config
+        row = acquire_key(db.session, user.id, key, fingerprint, config)
+        if row is not None:
+            return current_app.response_class(
+                row.response,
+                row.status_code,
+                {"Idempotent-Replayed": "true"},
+                mimetype="application/json",
+            )
+
+        try:
+            response = current_app.make_response(view(*args, **kwargs))
+        except BaseException:
+            db.session.rollback()
+            release_key(db.session, user.id, key)
+            raise
+        finish_key(
+            db.session, user.id, key, response.status_code, response.get_data()
+        )
+        return response
+
+    return wrapper
@@ -0,0 +1,162 @@
+from app import db
+from app.models import Claim, touch_claims
+from app.stats import record_claim_stats
+from typing import List
+import sqlalchemy as sa
+import csv
+import functools
+import io
+import itertools
+import json
+
+INGEST_FIELDS = [
+    "user_id",
+    "policy_number",
+    "date_of_accident",
+    "accident_type",
+    "description",
+    "injuries_reported",
+    "damage_details",
+]
+
+
+@functools.cache
+def claims_adapter():
+    # Building the adapter imports pydantic, which is left out of app startup.
+    from app.schemas import ClaimCreate
+    from pydantic import TypeAdapter
+
+    return TypeAdapter(List[ClaimCreate])
+
+
+class RowError(Exception):
+    pass
+
+
+def read_ndjson(stream):
+    for line_number, line in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            yield line_number, RowError(f"Invalid JSON: {e}")
+            continue
+        if not isinstance(row, dict):
+            yield line_number, RowError("Row is not an object")
+            continue
+        yield line_number, row
+
+
+def read_csv(stream):
+    reader = csv.DictReader(stream)
+    for row in reader:
+        # Line numbers count the header, like a spreadsheet does.
+        yield reader.line_num, {key: value for key, value in row.items() if key}
+
+
+INGEST_FORMATS = {
+    "ndjson": read_ndjson,
+    "csv": read_csv,
+}
+
+
+def string_lengths():
+    return {
+        column.name: column.type.length
+        for column in Claim.__table__.columns
+        if isinstance(column.type, sa.String) and column.type.length
+    }
+
+
+def validate_rows(rows):
+    """Validate a chunk of (line number, row) pairs in one pass."""
+    from pydantic import ValidationError
+
+    errors = {}
+    candidates = []
+    for line_number, row in rows:
+        if isinstance(row, RowError):
+            errors[line_number] = [{"loc": [], "msg": str(row)}]
+        else:
+            candidates.append((line_number, row))
+
+    try:
+        claims = claims_adapter().validate_python([row for _, row in candidates])
+    except ValidationError as e:
+        for error in e.errors(include_url=False):
+            index, *loc = error["loc"]
+            errors.setdefault(candidates[index][0], []).append(
+                {"loc": loc, "msg": error["msg"]}
+            )
+        # Everything left is known to be valid, so this cannot raise.
+        candidates = [item for item in candidates if item[0] not in errors]
+        claims = claims_adapter().validate_python([row for _, row in candidates])
+
+    lengths = string_lengths()
+    valid = []
+    for (line_number, _), claim in zip(candidates, claims):
+        too_long = [
+            {"loc": [field], "msg": f"String should have at most {length} characters"}
+            for field, length in lengths.items()
+            if len(getattr(claim, field, "") or "") > length
+        ]
+        if too_long:
+            errors[line_number] = too_long
+        else:
+            valid.append(claim)
+
+    return valid, [
+        {"row": line_number, "errors": row_errors}
+        for line_number, row_errors in sorted(errors.items())
+    ]
+
+
+def copy_claims(connection, rows):
+    buffer = io.StringIO()
+    # Quoting keeps empty strings apart from NULL.
+    writer = csv.writer(buffer, quoting=csv.QUOTE_NONNUMERIC)
+    writer.writerows([row[field] for field in INGEST_FIELDS] for row in rows)
+    buffer.seek(0)
+    with connection.connection.dbapi_connection.cursor() as cursor:
+        cursor.copy_expert(
+            f"COPY {Claim.__tablename__} ({', '.join(INGEST_FIELDS)}) "
+            "FROM STDIN WITH (FORMAT csv)",
+            buffer,
+        )
+
+
+def insert_claims(rows):
+    connection = db.session.connection()
+    if connection.dialect.name == "postgresql":
+        copy_claims(connection, rows)
+    else:
+        # A list of parameter sets is sent with the driver's executemany.
+        db.session.execute(sa.insert(Claim), rows)
+
+
+def ingest_claims(rows, user_id, chunk_size, max_errors):
+    """Validate and insert (line number, row) pairs, committing every chunk."""
+    report = {"inserted": 0, "failed": 0, "errors": []}
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            break
+
+        valid, errors = validate_rows(chunk)
+        if valid:
+            insert_claims(
+                [{"user_id": user_id, **claim.model_dump()} for claim in valid]
+            )
+            record_claim_stats(user_id, valid)
+            touch_claims(user_id)
+            db.session.commit()
+
+        report["inserted"] += len(valid)
+        report["failed"] += len(errors)
+        room = max(max_errors - len(report["errors"]), 0)
+        report["errors"].extend(errors[:room])
+
+    report["errors_truncated"] = report["failed"] > len(report["errors"])
+    return report
@@ -0,0 +1,252 @@
+from app import db
+from app.models import (
+    Claim,
+    Image,
+    ImageJob,
+    find_stored_images,
+    touch_claim,
+    utcnow,
+)
+from app.uploads import is_spooled_to_disk, read_body, store_image
+from concurrent.futures import ThreadPoolExecutor, wait
+from flask import current_app
+from datetime import timedelta
+import sqlalchemy as sa
+import os
+import tempfile
+import time
+
+
+def detach_body(stream):
+    # The request closes its files once the response is sent, so the job
+    # keeps either the in-memory bytes or its own descriptor on the spooled
+    # file.
+    stream.seek(0)
+    if isinstance(stream, tempfile.SpooledTemporaryFile) and not stream._rolled:
+        return stream._file.getvalue()
+    if not is_spooled_to_disk(stream):
+        return stream.read()
+    return open(os.dup(stream.fileno()), "rb")
+
+
+def close_body(body):
+    if body is not None and not isinstance(body, bytes):
+        body.close()
+
+
+def create_image_jobs(claim, uploads, store_payload, session=None):
+    jobs = []
+    for upload in uploads:
+        body = detach_body(upload.file.stream)
+        job = ImageJob(
+            claim_id=claim.id,
+            filename=upload.path,
+            content_hash=upload.content_hash,
+            size=upload.size,
+            content_type=upload.file.mimetype,
+        )
+        if store_payload:
+            job.payload = read_body(body)
+            close_body(body)
+            body = None
+        (session or db.session).add(job)
+        jobs.append((job, body))
+    return jobs
+
+
+def refresh_claim_status(claim_id):
+    stmt = (
+        sa.select(ImageJob.status, sa.func.count())
+        .where(ImageJob.claim_id == claim_id)
+        .group_by(ImageJob.status)
+    )
+    counts = dict(db.session.execute(stmt).all())
+    if counts.get("dead"):
+        status = "failed"
+    elif set(counts) <= {"done"}:
+        status = "complete"
+    else:
+        return
+    db.session.execute(
+        sa.update(Claim).where(Claim.id == claim_id).values(status=status)
+    )
+    touch_claim(claim_id)
+    db.session.commit()
+
+
+def attempt_job(job_id, body, max_attempts, retry_delay):
+    job = db.session.get(ImageJob, job_id)
+    if body is None:
+        body = job.payload
+    if body is None:
+        # Queued by a release that kept the image only in worker memory.
+        job.status = "dead"
+        job.last_error = "Image data was lost"
+        job.locked_at = None
+        db.session.commit()
+        refresh_claim_status(job.claim_id)
+        return job.status, job.run_after
+    if not isinstance(body, bytes):
+        body.seek(0)
+
+    try:
+        # An identical image may have been stored since the job was queued.
+        stored = find_stored_images([job.content_hash]).get(job.content_hash)
+        if stored is None:
+            stored = store_image(
+                current_app.config, job.filename, body, job.content_type
+            )
+    except Exception as e:
+        job.attempts += 1
+        job.last_error = str(e)[:256]
+        if job.attempts >= max_attempts:
+            job.status = "dead"
+        else:
+            job.status = "pending"
+            job.run_after = utcnow() + timedelta(
+                seconds=retry_delay * 2 ** (job.attempts - 1)
+            )
+    else:
+        job.attempts += 1
+        job.status = "done"
+        job.payload = None
+        db.session.add(
+            Image(
+                claim_id=job.claim_id,
+                content_hash=job.content_hash,
+                size=job.size,
+                **stored,
+            )
+        )
+        touch_claim(job.claim_id)
+
+    job.locked_at = None
+    status, claim_id, run_after = job.status, job.claim_id, job.run_after
+    db.session.commit()
+    refresh_claim_status(claim_id)
+    return status, run_after
+
+
+class ImageQueue:
+    store_payload = False
+
+    def __init__(self, app):
+        self.app = app
+        self.max_attempts = app.config.get("IMAGE_JOB_MAX_ATTEMPTS")
+        self.retry_delay = app.config.get("IMAGE_JOB_RETRY_DELAY")
+        self.lock_timeout = app.config.get("IMAGE_JOB_LOCK_TIMEOUT")
+
+    def submit(self, jobs):
+        raise NotImplementedError
+
+    def claim_jobs(self, limit=None, due=None):
+        """Lock pending jobs that are due, and running ones whose worker stopped."""
+        now = utcnow()
+        stale = now - timedelta(seconds=self.lock_timeout)
+        stmt = (
+            sa.select(ImageJob)
+            .where(
+                sa.or_(
+                    sa.and_(
+                        ImageJob.status == "pending", ImageJob.run_after <= (due or now)
+                    ),
+                    sa.and_(ImageJob.status == "running", ImageJob.locked_at < stale),
+                )
+            )
+            .order_by(ImageJob.id)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        )
+        jobs = db.session.execute(stmt).scalars().all()
+        for job in jobs:
+            job.status = "running"
+            job.locked_at = now
+        db.session.commit()
+        return [job.id for job in jobs]
+
+    def run(self, job_id, body=None):
+        with self.app.app_context():
+            try:
+                while True:
+                    status, run_after = attempt_job(
+                        job_id, body, self.max_attempts, self.retry_delay
+                    )
+                    if status != "pending":
+                        return status
+                    time.sleep(max((run_after - utcnow()).total_seconds(), 0))
+            finally:
+                close_body(body)
+                db.session.remove()
+
+
+class ThreadImageQueue(ImageQueue):
+    # The images are kept in the table too, so that jobs left behind by a
+    # worker that stopped can be resumed by the next one.
+    store_payload = True
+
+    def __init__(self, app):
+        super().__init__(app)
+        self.executor = ThreadPoolExecutor(
+            max_workers=app.config.get("UPLOAD_CONCURRENCY"),
+            thread_name_prefix="image-queue",
+        )
+        if not app.testing:
+            self.executor.submit(self.resume)
+
+    def submit(self, jobs):
+        return [self.executor.submit(self.run, job.id, body) for job, body in jobs]
+
+    def resume(self):
+        """Submit the jobs of workers that stopped before finishing them."""
+        with self.app.app_context():
+            try:
+                if not sa.inspect(db.engine).has_table(ImageJob.__tablename__):
+                    return []
+                # Jobs of running workers are due at most a lock timeout ago.
+                due = utcnow() - timedelta(seconds=self.lock_timeout)
+                job_ids = self.claim_jobs(due=due)
+            except Exception:
+                current_app.logger.exception("Failed to resume image jobs")
+                return []
+            finally:
+                db.session.remove()
+        return [self.executor.submit(self.run, job_id) for job_id in job_ids]
+
+
+class DatabaseImageQueue(ImageQueue):
+    store_payload = True
+
+    def submit(self, jobs):
+        # Jobs are picked up by `flask process-images`.
+        return []
+
+    def attempt(self, job_id):
+        with self.app.app_context():
+            try:
+                return attempt_job(job_id, None, self.max_attempts, self.retry_delay)
+            finally:
+                db.session.remove()
+
+    def work_once(self, limit):
+        job_ids = self.claim_jobs(limit)
+        if job_ids:
+            with ThreadPoolExecutor(
+                max_workers=self.app.config.get("UPLOAD_CONCURRENCY")
+            ) as executor:
+                wait([executor.submit(self.attempt, job_id) for job_id in job_ids])
+        return len(job_ids)
+
+
+IMAGE_QUEUES = {
+    "thread": ThreadImageQueue,
+    "database": DatabaseImageQueue,
+}
+
+
+def create_image_queue(app):
+    backend = app.config.get("IMAGE_QUEUE_BACKEND")
+    if backend == "inline":
+        return None
+    if backend not in IMAGE_QUEUES:
+        raise ValueError(f"Unknown image queue backend: {backend}")
+    return IMAGE_QUEUES[backend](app)
@@ -0,0 +1,64 @@
+from flask.json.provider import DefaultJSONProvider
+from datetime import date, datetime, timezone
+
+
+def isoformat(value):
+    # Claims store naive UTC datetimes, written with an explicit offset so
+    # that clients do not read them as local time.
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc).isoformat()
+
+
+class JSONProvider(DefaultJSONProvider):
+    @staticmethod
+    def default(o):
+        if isinstance(o, datetime):
+            return isoformat(o)
+        if isinstance(o, date):
+            return o.isoformat()
+        return DefaultJSONProvider.default(o)
+
+
+class OrjsonProvider(JSONProvider):
+    def __init__(self, app):
+        import orjson
+
+        super().__init__(app)
+        self.orjson = orjson
+        # Sorted keys keep the output identical to the stdlib provider.
+        self.options = (
+            orjson.OPT_NAIVE_UTC | orjson.OPT_NON_STR_KEYS | orjson.OPT_SORT_KEYS
+        )
+
+    def dumps(self, obj, **kwargs):
+        body = self.orjson.dumps(obj, default=self.default, option=self.options)
+        return body.decode()
+
+    def loads(self, s, **kwargs):
+        return self.orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        # Skip the round trip through str that the base class makes.
+        body = self.orjson.dumps(obj, default=self.default, option=self.options)
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+
+def orjson_available():
+    try:
+        import orjson  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def create_json_provider(app):
+    provider = app.config.get("JSON_PROVIDER")
+    if provider == "auto":
+        provider = "orjson" if orjson_available() else "json"
+    if provider == "orjson":
+        return OrjsonProvider(app)
+    if provider == "json":
+        return JSONProvider(app)
+    raise ValueError(f"Unknown JSON provider: {provider}")
@@ -1,35 +1,110 @@
-from app import db
-from typing import Optional
-from datetime import datetime
+from app import claims_cache, db, identity_cache, passwords, storage
+from typing import List, Optional
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import date, datetime, timezone
 import sqlalchemy.orm as so
 import sqlalchemy as sa
-from flask_jwt_extended import get_jwt_identity
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask_jwt_extended import get_jwt, get_jwt_identity
+
+
+def utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
 
 
 class User(db.Model):
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
     email: so.Mapped[str] = so.mapped_column(sa.String(120), index=True, unique=True)
     password_hash: so.Mapped[Optional[str]] = so.mapped_column(sa.String(256))
+    is_admin: so.Mapped[bool] = so.mapped_column(
+        sa.Boolean, default=False, server_default=sa.false()
+    )
+    # Bumped whenever any of the user's claims change, so that conditional
+    # requests are answered from this row alone.
+    claims_version: so.Mapped[int] = so.mapped_column(default=0, server_default="0")
+    claims_modified_at: so.Mapped[Optional[datetime]] = so.mapped_column(sa.DateTime)
 
     claims: so.WriteOnlyMapped["Claim"] = so.relationship(back_populates="author")
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = passwords.hash(password)
 
     def check_password(self, password):
         if self.password_hash is None:
             return False
-        return check_password_hash(self.password_hash, password)
+        return passwords.verify(self.password_hash, password)
+
+    def password_needs_rehash(self):
+        return passwords.needs_rehash(self.password_hash)
 
     def __repr__(self):
         return "<User {}>".format(self.email)
 
 
+@dataclass(frozen=True)
+class CurrentUser:
+    id: int
+    email: str
+    is_admin: bool = False
+
+
+def identity_claims(user):
+    return {"uid": user.id, "email": user.email, "is_admin": user.is_admin}
+
+
 def load_user():
     email = get_jwt_identity()
-    user = User.query.filter_by(email=email).first()
-    return user
+    return token_user(email, get_jwt()) or lookup_user(email)
+
+
+def token_user(email, claims):
+    # Access tokens carry the user id as a claim, so the common case needs no
+    # lookup at all. Refresh tokens and older access tokens fall back to the
+    # identity cache and finally the database.
+    if claims.get("uid") is not None and claims.get("email") == email:
+        return CurrentUser(claims["uid"], email, claims.get("is_admin", False))
+    return identity_cache.get(email)
+
+
+def lookup_user(email, session=None):
+    user = (
+        (session or db.session)
+        .execute(sa.select(User).where(User.email == email))
+        .scalar()
+    )
+    if user is None:
+        return None
+
+    current_user = CurrentUser(user.id, user.email, user.is_admin)
+    identity_cache.set(email, current_user)
+    return current_user
+
+
+def invalidate_user(email):
+    identity_cache.invalidate(email)
+
+
+def touch_claims(user_id, session=None):
+    """Mark the user's claims as changed, in the caller's transaction."""
+    (session or db.session).execute(
+        sa.update(User)
+        .where(User.id == user_id)
+        .values(claims_version=User.claims_version + 1, claims_modified_at=utcnow())
+    )
+    claims_cache.invalidate(user_id)
+
+
+def touch_claim(claim_id):
+    user_id = db.session.scalar(sa.select(Claim.user_id).where(Claim.id == claim_id))
+    touch_claims(user_id)
+
+
+def claims_version(user_id, session=None):
+    return (session or db.session).execute(
+        sa.select(User.claims_version, User.claims_modified_at).where(
+            User.id == user_id
+        )
+    ).one()
 
 
 class Claim(db.Model):
@@ -41,40 +116,265 @@ class Claim(db.Model):
     description: so.Mapped[str] = so.mapped_column(sa.String(256))
     injuries_reported: so.Mapped[bool] = so.mapped_column(sa.Boolean)
     damage_details: so.Mapped[str] = so.mapped_column(sa.String(256))
+    status: so.Mapped[str] = so.mapped_column(
+        sa.String(16), default="complete", server_default="complete"
+    )
 
     author: so.Mapped[User] = so.relationship(back_populates="claims")
-    images: so.Mapped["Image"] = so.relationship(back_populates="claim")
+    images: so.Mapped[List["Image"]] = so.relationship(back_populates="claim")
+
+    # Filtering and sorting a user's claims are range scans on these.
+    __table_args__ = (
+        sa.Index("ix_claim_user_id_date_of_accident", "user_id", "date_of_accident"),
+        sa.Index("ix_claim_user_id_accident_type", "user_id", "accident_type"),
+        sa.Index("ix_claim_user_id_policy_number", "user_id", "policy_number"),
+    )
 
     def __repr__(self):
         return "<Claim {}>".format(self.id)
 
     def to_dict(self):
-        session = so.Session.object_session(self)
-        stmt = sa.select(Image).where(Image.claim_id == self.id)
-        images = session.execute(stmt).scalars().all()
-
-        return {
-            "id": self.id,
-            "policy_number": self.policy_number,
-            "user_id": self.user_id,
-            "date_of_accident": self.date_of_accident,
-            "accident_type": self.accident_type,
-            "description": self.description,
-            "injuries_reported": self.injuries_reported,
-            "damage_details": self.damage_details,
-            "author": self.author.id if self.author else None,
-            "images": [
-                {"id": image.id, "image_file": image.image_file} for image in images
-            ],
-        }
+        return serialize_claims([self])[0]
 
 
 class Image(db.Model):
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
     claim_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(Claim.id), index=True)
     image_file: so.Mapped[str] = so.mapped_column(sa.String(256))
+    thumbnail_file: so.Mapped[Optional[str]] = so.mapped_column(sa.String(256))
+    display_file: so.Mapped[Optional[str]] = so.mapped_column(sa.String(256))
+    content_hash: so.Mapped[Optional[str]] = so.mapped_column(sa.String(64), index=True)
+    size: so.Mapped[Optional[int]] = so.mapped_column(sa.BigInteger)
 
     claim: so.Mapped[Claim] = so.relationship(back_populates="images")
 
     def __repr__(self):
         return "<Image {}>".format(self.id)
+
+
+def serialize_claims(claims, include_urls=False, session=None):
+    claims = list(claims)
+
+    # Claims loaded with joinedload/selectinload already carry their images,
+    # the rest are fetched together in a single IN query.
+    missing = {claim.id for claim in claims if "images" in sa.inspect(claim).unloaded}
+    images_by_claim = defaultdict(list)
+    if missing:
+        stmt = (
+            sa.select(Image)
+            .where(Image.claim_id.in_(missing))
+            .order_by(Image.claim_id, Image.id)
+        )
+        for image in (session or db.session).execute(stmt).scalars():
+            images_by_claim[image.claim_id].append(image)
+
+    items = []
+    for claim in claims:
+        images = images_by_claim[claim.id] if claim.id in missing else claim.images
+        items.append(
+            {
+                "id": claim.id,
+                "policy_number": claim.policy_number,
+                "user_id": claim.user_id,
+                "date_of_accident": claim.date_of_accident,
+                "accident_type": claim.accident_type,
+                "description": claim.description,
+                "injuries_reported": claim.injuries_reported,
+                "damage_details": claim.damage_details,
+                "status": claim.status,
+                "author": claim.user_id,
+                "images": [
+                    {
+                        "id": image.id,
+                        "image_file": image.image_file,
+                        "thumbnail_file": image.thumbnail_file,
+                        "display_file": image.display_file,
+                    }
+                    for image in images
+                ],
+            }
+        )
+
+    if include_urls:
+        attach_image_urls(items, storage.image_urls(image_paths(items)))
+
+    return items
+
+
+def image_paths(items):
+    # Images without derivatives fall back to the original.
+    return list(
+        {
+            image[key] or image["image_file"]
+            for item in items
+            for image in item["images"]
+            for key in ("image_file", "thumbnail_file", "display_file")
+        }
+    )
+
+
+def attach_image_urls(items, urls):
+    for item in items:
+        for image in item["images"]:
+            original = image["image_file"]
+            image["url"] = urls[original]
+            image["thumbnail_url"] = urls[image["thumbnail_file"] or original]
+            image["display_url"] = urls[image["display_file"] or original]
+
+
+def claim_conditions(filters):
+    conditions = [
+        getattr(Claim, field) == filters[field]
+        for field in ("accident_type", "policy_number", "injuries_reported")
+        if field in filters
+    ]
+    if "date_from" in filters:
+        conditions.append(Claim.date_of_accident >= filters["date_from"])
+    if "date_to" in filters:
+        conditions.append(Claim.date_of_accident <= filters["date_to"])
+    if "date_before" in filters:
+        conditions.append(Claim.date_of_accident < filters["date_before"])
+    return conditions
+
+
+def claim_ordering(sort):
+    order_by = [
+        getattr(Claim, field).desc() if descending else getattr(Claim, field)
+        for field, descending in sort
+    ]
+    # Break ties by id so that pages never overlap.
+    if "id" not in [field for field, _ in sort]:
+        order_by.append(Claim.id.desc())
+    return order_by
+
+
+def find_stored_images(content_hashes, session=None):
+    # Every Image row is a reference to its content, so any row with the same
+    # hash points at objects that are already in storage.
+    if not content_hashes:
+        return {}
+    stmt = sa.select(
+        Image.content_hash, Image.image_file, Image.thumbnail_file, Image.display_file
+    ).where(Image.content_hash.in_(set(content_hashes)))
+    stored = {}
+    rows = (session or db.session).execute(stmt)
+    for content_hash, image_file, thumbnail_file, display_file in rows:
+        stored.setdefault(
+            content_hash,
+            {
+                "image_file": image_file,
+                "thumbnail_file": thumbnail_file,
+                "display_file": display_file,
+            },
+        )
+    return stored
+
+
+def own_content_hashes(user_id, content_hashes, session=None):
+    """The hashes in `content_hashes` of images on the user's own claims.
+
+    Reuse of other users' content stays internal, so that a response never
+    tells a user that someone else uploaded the same file.
+    """
+    if not content_hashes:
+        return set()
+    stmt = (
+        sa.select(Image.content_hash)
+        .join(Claim, Claim.id == Image.claim_id)
+        .where(Claim.user_id == user_id, Image.content_hash.in_(set(content_hashes)))
+        .distinct()
+    )
+    return set((session or db.session).scalars(stmt))
+
+
+def storage_stats():
+    references = sa.select(
+        sa.func.count(Image.id), sa.func.coalesce(sa.func.sum(Image.size), 0)
+    ).where(Image.content_hash.is_not(None))
+    unique = (
+        sa.select(Image.content_hash, sa.func.max(Image.size).label("size"))
+        .where(Image.content_hash.is_not(None))
+        .group_by(Image.content_hash)
+        .subquery()
+    )
+    stored = sa.select(
+        sa.func.count(), sa.func.coalesce(sa.func.sum(unique.c.size), 0)
+    ).select_from(unique)
+    image_count, referenced_bytes = db.session.execute(references).one()
+    object_count, stored_bytes = db.session.execute(stored).one()
+    return {
+        "images": image_count,
+        "objects": object_count,
+        "referenced_bytes": referenced_bytes,
+        "stored_bytes": stored_bytes,
+        "saved_bytes": referenced_bytes - stored_bytes,
+    }
+
+
+class ImageJob(db.Model):
+    id: so.Mapped[int] = so.mapped_column(primary_key=True)
+    claim_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(Claim.id), index=True)
+    filename: so.Mapped[str] = so.mapped_column(sa.String(256))
+    content_hash: so.Mapped[Optional[str]] = so.mapped_column(sa.String(64))
+    size: so.Mapped[Optional[int]] = so.mapped_column(sa.BigInteger)
+    content_type: so.Mapped[Optional[str]] = so.mapped_column(sa.String(64))
+    payload: so.Mapped[Optional[bytes]] = so.mapped_column(sa.LargeBinary)
+    status: so.Mapped[str] = so.mapped_column(
+        sa.String(16), default="pending", index=True
+    )
+    attempts: so.Mapped[int] = so.mapped_column(default=0)
+    last_error: so.Mapped[Optional[str]] = so.mapped_column(sa.String(256))
+    run_after: so.Mapped[datetime] = so.mapped_column(sa.DateTime, default=utcnow)
+    locked_at: so.Mapped[Optional[datetime]] = so.mapped_column(sa.DateTime)
+
+    def __repr__(self):
+        return "<ImageJob {}>".format(self.id)
+
+
+def claim_progress(claim_id, session=None):
+    stmt = (
+        sa.select(ImageJob.status, sa.func.count())
+        .where(ImageJob.claim_id == claim_id)
+        .group_by(ImageJob.status)
+    )
+    counts = dict((session or db.session).execute(stmt).all())
+    return {
+        "total": sum(counts.values()),
+        "done": counts.get("done", 0),
+        "pending": counts.get("pending", 0) + counts.get("running", 0),
+        "failed": counts.get("dead", 0),
+    }
+
+
+class ClaimStat(db.Model):
+    # One row per user, accident type and month, kept current by the writes
+    # that insert claims.
+    user_id: so.Mapped[int] = so.mapped_column(
+        sa.ForeignKey(User.id), primary_key=True
+    )
+    accident_type: so.Mapped[str] = so.mapped_column(sa.String(64), primary_key=True)
+    month: so.Mapped[date] = so.mapped_column(sa.Date, primary_key=True)
+    claims: so.Mapped[int] = so.mapped_column(default=0)
+    injuries: so.Mapped[int] = so.mapped_column(default=0)
+
+    def __repr__(self):
+        return "<ClaimStat {} {} {}>".format(
+            self.user_id, self.accident_type, self.month
+        )
+
+
+class IdempotencyKey(db.Model):
+    # The response to replay when a client retries a request with the same
+    # Idempotency-Key; status_code is NULL while the first request runs.
+    user_id: so.Mapped[int] = so.mapped_column(
+        sa.ForeignKey(User.id), primary_key=True
+    )
+    key: so.Mapped[str] = so.mapped_column(sa.String(255), primary_key=True)
+    fingerprint: so.Mapped[str] = so.mapped_column(sa.String(64))
+    status_code: so.Mapped[Optional[int]] = so.mapped_column()
+    response: so.Mapped[Optional[bytes]] = so.mapped_column(sa.LargeBinary)
+    locked_at: so.Mapped[datetime] = so.mapped_column(sa.DateTime)
+    expires_at: so.Mapped[datetime] = so.mapped_column(sa.DateTime, index=True)
+
+    def __repr__(self):
+        return "<IdempotencyKey {} {}>".format(self.user_id, self.key)
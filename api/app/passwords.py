@@ -0,0 +1,60 @@
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.security import check_password_hash, generate_password_hash
+import threading
+
+
+class PasswordHasherBusy(ServiceUnavailable):
+    description = "Too many password checks in progress, retry shortly"
+
+
+class PasswordHasher:
+    def __init__(self):
+        self.executor = None
+        self.method = "scrypt"
+        self.salt_length = 16
+        self.method_prefix = None
+
+    def init_app(self, app):
+        self.method = app.config.get("PASSWORD_HASH_METHOD")
+        self.salt_length = app.config.get("PASSWORD_HASH_SALT_LENGTH")
+        self.wait_timeout = app.config.get("PASSWORD_HASH_WAIT_TIMEOUT")
+        self.method_prefix = None
+        workers = app.config.get("PASSWORD_HASH_WORKERS")
+        # The KDF is CPU bound, so at most `workers` hashes run at once and
+        # at most PASSWORD_HASH_MAX_PENDING requests are in flight; the rest
+        # wait up to PASSWORD_HASH_WAIT_TIMEOUT and are then turned away,
+        # instead of stalling every other endpoint.
+        self.slots = threading.BoundedSemaphore(
+            app.config.get("PASSWORD_HASH_MAX_PENDING")
+        )
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="password-hash"
+        )
+
+    def run(self, fn, *args):
+        if not self.slots.acquire(timeout=self.wait_timeout):
+            raise PasswordHasherBusy()
+        try:
+            return self.executor.submit(fn, *args).result()
+        finally:
+            self.slots.release()
+
+    def hash(self, password):
+        password_hash = self.run(
+            generate_password_hash, password, self.method, self.salt_length
+        )
+        self.method_prefix = password_hash.split("$", 1)[0]
+        return password_hash
+
+    def verify(self, password_hash, password):
+        return self.run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        # werkzeug expands the configured method with its default cost
+        # parameters, so the prefix is taken from a real hash.
+        if self.method_prefix is None:
+            self.hash("")
+        return password_hash.split("$", 1)[0] != self.method_prefix
@@ -0,0 +1,136 @@
+from collections import deque
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool, QueuePool
+import sqlalchemy as sa
+import threading
+import time
+
+
+def is_memory_sqlite(url):
+    return url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:")
+
+
+def pool_options(config, uri):
+    """Engine options for `uri` from the DB_POOL_* settings."""
+    if is_memory_sqlite(sa.make_url(uri)):
+        # Flask-SQLAlchemy shares a single connection for in-memory databases.
+        return {}
+
+    mode = config.get("DB_POOL_MODE")
+    pre_ping = config.get("DB_POOL_PRE_PING")
+    if mode == "null":
+        # A transaction pooler such as PgBouncer does the pooling, so every
+        # checkout opens a connection to it and checkin closes it.
+        return {"poolclass": NullPool, "pool_pre_ping": pre_ping}
+    if mode != "queue":
+        raise ValueError(f"Unknown pool mode: {mode}")
+    return {
+        "poolclass": QueuePool,
+        "pool_size": config.get("DB_POOL_SIZE"),
+        "max_overflow": config.get("DB_MAX_OVERFLOW"),
+        "pool_timeout": config.get("DB_POOL_TIMEOUT"),
+        "pool_recycle": config.get("DB_POOL_RECYCLE"),
+        "pool_pre_ping": pre_ping,
+    }
+
+
+class EngineStats:
+    def __init__(self, capacity, window=1000):
+        self.capacity = capacity
+        self.checkouts = 0
+        self.timeouts = 0
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.waits = deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def checked_out(self, wait):
+        with self.lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            self.waits.append(wait)
+
+    def checked_in(self):
+        with self.lock:
+            self.in_use -= 1
+
+    def timed_out(self):
+        with self.lock:
+            self.timeouts += 1
+
+    def snapshot(self):
+        with self.lock:
+            waits = sorted(self.waits)
+            stats = {
+                "capacity": self.capacity,
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "in_use": self.in_use,
+                "peak_in_use": self.peak_in_use,
+                "wait_ms_mean": 0.0,
+                "wait_ms_p95": 0.0,
+                "wait_ms_max": self.max_wait * 1000,
+            }
+            if waits:
+                stats["wait_ms_mean"] = self.total_wait / self.checkouts * 1000
+                stats["wait_ms_p95"] = waits[int(len(waits) * 0.95)] * 1000
+        # Saturation near 1 means requests queue for connections. NullPool and
+        # unbounded overflow have no capacity to saturate.
+        if self.capacity:
+            stats["saturation"] = stats["in_use"] / self.capacity
+            stats["peak_saturation"] = stats["peak_in_use"] / self.capacity
+        return stats
+
+
+class InstrumentedPool:
+    stats = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        sa.event.listen(self, "checkin", lambda *args: self.stats.checked_in())
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            connection = super().connect()
+        except sa.exc.TimeoutError:
+            self.stats.timed_out()
+            raise
+        self.stats.checked_out(time.perf_counter() - start)
+        return connection
+
+
+class PoolStats:
+    def __init__(self):
+        self.engines = {}
+
+    def init_app(self, app):
+        self.engines = {}
+        config = app.config
+        options = pool_options(config, config["SQLALCHEMY_DATABASE_URI"])
+        config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+            **self.instrument("default", options),
+            **config.get("SQLALCHEMY_ENGINE_OPTIONS", {}),
+        }
+
+    def instrument(self, name, options, async_engine=False):
+        """Swap the pool class in `options` for one that records its checkouts."""
+        if "poolclass" not in options:
+            return options
+        base = options["poolclass"]
+        if base is QueuePool and async_engine:
+            base = AsyncAdaptedQueuePool
+        capacity = None
+        if base is not NullPool and options["max_overflow"] >= 0:
+            capacity = options["pool_size"] + options["max_overflow"]
+        stats = EngineStats(capacity)
+        self.engines[name] = stats
+        poolclass = type(base.__name__, (InstrumentedPool, base), {"stats": stats})
+        return {**options, "poolclass": poolclass}
+
+    def snapshot(self):
+        return {name: stats.snapshot() for name, stats in self.engines.items()}
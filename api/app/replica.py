@@ -0,0 +1,72 @@
+from flask import current_app, has_request_context, request
+from flask_jwt_extended import get_jwt
+from flask_sqlalchemy.session import Session
+from app.pool import pool_options
+import functools
+import sqlalchemy as sa
+import time
+
+
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (
+            bind is None
+            and has_request_context()
+            and getattr(request, "read_replica", False)
+        ):
+            return current_app.extensions["replica"].engine
+        return super().get_bind(mapper, clause, bind, **kwargs)
+
+
+class ReplicaRouter:
+    """Routes read-only requests to the replica, except just after a write.
+
+    The time of a user's last write travels in their access token, so every
+    worker and machine keeps their reads on the primary for the same window.
+    """
+
+    def __init__(self, pool_stats, timer=time.time):
+        self.pool_stats = pool_stats
+        self.engine = None
+        self.sticky_seconds = 0
+        self.timer = timer
+
+    @property
+    def enabled(self):
+        return self.engine is not None
+
+    def init_app(self, app):
+        self.sticky_seconds = app.config.get("REPLICA_STICKY_SECONDS")
+        if self.engine is not None:
+            self.engine.dispose()
+            self.engine = None
+        uri = app.config.get("SQLALCHEMY_REPLICA_URI")
+        if uri:
+            # Not a Flask-SQLAlchemy bind: no model lives only on the replica.
+            options = pool_options(app.config, uri)
+            self.engine = sa.create_engine(
+                uri, **self.pool_stats.instrument("replica", options)
+            )
+        app.extensions["replica"] = self
+
+    def wrote(self):
+        """Claims for a token whose holder just wrote, to read from the primary."""
+        return {"wrote_at": self.timer()} if self.enabled else {}
+
+    def use_replica(self, claims):
+        if not self.enabled:
+            return False
+        wrote_at = claims.get("wrote_at")
+        return wrote_at is None or self.timer() - wrote_at >= self.sticky_seconds
+
+    def read_only(self, view):
+        """Run a view that only reads on the replica, after `jwt_required`."""
+
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            # Set on the request, so that streamed responses keep reading from
+            # the replica after the view returns.
+            request.read_replica = self.use_replica(get_jwt())
+            return view(*args, **kwargs)
+
+        return wrapper
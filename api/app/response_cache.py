@@ -0,0 +1,140 @@
+from collections import OrderedDict
+import threading
+import time
+
+
+class MemoryCacheBackend:
+    """An LRU of response bodies per process, bounded by entries and bytes.
+
+    A shared backend (e.g. Redis) implements the same get, set, invalidate,
+    clear and stats methods and is added to CACHE_BACKENDS.
+    """
+
+    def __init__(self, maxsize, max_bytes, ttl, timer=time.monotonic):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.timer = timer
+        self._data = OrderedDict()
+        self._keys_by_user = {}
+        self._bytes = 0
+        self._evictions = 0
+        self._expirations = 0
+        self._lock = threading.Lock()
+
+    def get(self, user_id, key):
+        with self._lock:
+            item = self._data.get((user_id, key))
+            if item is None:
+                return None
+            body, expires_at = item
+            if expires_at <= self.timer():
+                self._expirations += 1
+                self._remove((user_id, key))
+                return None
+            self._data.move_to_end((user_id, key))
+            return body
+
+    def set(self, user_id, key, body):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            if (user_id, key) in self._data:
+                self._remove((user_id, key))
+            self._data[(user_id, key)] = (body, self.timer() + self.ttl)
+            self._keys_by_user.setdefault(user_id, set()).add(key)
+            self._bytes += len(body)
+            while len(self._data) > self.maxsize or self._bytes > self.max_bytes:
+                self._evictions += 1
+                self._remove(next(iter(self._data)))
+
+    def invalidate(self, user_id):
+        with self._lock:
+            for key in list(self._keys_by_user.get(user_id, ())):
+                self._remove((user_id, key))
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._keys_by_user.clear()
+            self._bytes = 0
+
+    def stats(self):
+        return {
+            "entries": len(self._data),
+            "bytes": self._bytes,
+            "evictions": self._evictions,
+            "expirations": self._expirations,
+        }
+
+    def _remove(self, entry):
+        user_id, key = entry
+        body, _ = self._data.pop(entry)
+        self._bytes -= len(body)
+        keys = self._keys_by_user[user_id]
+        keys.discard(key)
+        if not keys:
+            del self._keys_by_user[user_id]
+
+
+def memory_backend(config):
+    return MemoryCacheBackend(
+        config.get("CLAIMS_CACHE_SIZE"),
+        config.get("CLAIMS_CACHE_MAX_BYTES"),
+        config.get("CLAIMS_CACHE_TTL"),
+    )
+
+
+CACHE_BACKENDS = {"memory": memory_backend}
+
+
+class ResponseCache:
+    """Serialized claim pages, keyed by user and by the ETag of the page.
+
+    The ETag covers the user's claims version, so a page cached before a write
+    is never served after it, even by a worker that missed the invalidation.
+    """
+
+    def __init__(self):
+        self.backend = None
+        self.hits = 0
+        self.misses = 0
+
+    def init_app(self, app):
+        backend = app.config.get("CLAIMS_CACHE_BACKEND")
+        self.hits = self.misses = 0
+        if backend == "none":
+            self.backend = None
+            return
+        if backend not in CACHE_BACKENDS:
+            raise ValueError(f"Unknown claims cache backend: {backend}")
+        self.backend = CACHE_BACKENDS[backend](app.config)
+
+    def get(self, user_id, etag):
+        if self.backend is None or etag is None:
+            return None
+        body = self.backend.get(user_id, etag)
+        if body is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return body
+
+    def set(self, user_id, etag, body):
+        if self.backend is not None and etag is not None:
+            self.backend.set(user_id, etag, body)
+
+    def invalidate(self, user_id):
+        if self.backend is not None:
+            self.backend.invalidate(user_id)
+
+    def stats(self):
+        if self.backend is None:
+            return None
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            **self.backend.stats(),
+        }
@@ -1,20 +1,66 @@
-from app import db, jwt, supabase
-from app.helpers import validate_files
-from app.schemas import ClaimCreate
+from app import (
+    claims_cache,
+    compress,
+    db,
+    image_queue,
+    jwt,
+    pool_stats,
+    replica,
+    storage,
+)
+from app.helpers import (
+    UploadRejected,
+    validate_files,
+    decode_cursor,
+    claims_etag,
+    matching_etag,
+    parse_claim_filters,
+    parse_claim_sort,
+)
+from app.claims import (
+    add_claim,
+    claims_after,
+    claims_page,
+    created_claim,
+    stored_images,
+)
+from app.idempotency import IdempotencyConflict, IdempotencyKeyReused, idempotent
+from app.passwords import PasswordHasherBusy
+from app.storage import LocalStorage
+from app.uploads import prepare_uploads, upload_files, upload_footprint
 from sqlalchemy import and_
-from flask import request, jsonify, Blueprint, current_app as app, send_from_directory
-from sqlalchemy import desc
+from flask import (
+    request,
+    jsonify,
+    Blueprint,
+    Response,
+    current_app as app,
+    send_from_directory,
+    stream_with_context,
+)
 from sqlalchemy.orm import joinedload
 from flask_jwt_extended import (
     create_access_token,
     create_refresh_token,
     jwt_required,
 )
-from werkzeug.utils import secure_filename
-from app.models import User, Image, Claim, load_user
-from pydantic import ValidationError
-import os
-import tempfile
+from app.models import (
+    User,
+    Claim,
+    attach_image_urls,
+    claim_progress,
+    claims_version,
+    identity_claims,
+    image_paths,
+    load_user,
+    serialize_claims,
+)
+from app.export import EXPORT_FORMATS, claims_query, iter_batches, parquet_available
+from app.ingest import INGEST_FORMATS, ingest_claims
+from app.search import search_query, search_terms
+from app.stats import claim_stats
+from werkzeug.exceptions import RequestEntityTooLarge
+import io
 
 
 bp = Blueprint("main", __name__)
@@ -36,7 +82,10 @@ def register():
     db.session.add(user)
     db.session.commit()
 
-    access_token = create_access_token(identity=user.email)
+    access_token = create_access_token(
+        identity=user.email,
+        additional_claims={**identity_claims(user), **replica.wrote()},
+    )
     refresh_token = create_refresh_token(identity=user.email)
 
     return (
@@ -51,6 +100,24 @@ def register():
     )
 
 
+@bp.app_errorhandler(UploadRejected)
+@bp.app_errorhandler(RequestEntityTooLarge)
+def upload_rejected(e):
+    return jsonify({"error": e.description}), e.code
+
+
+@bp.app_errorhandler(PasswordHasherBusy)
+def password_hasher_busy(e):
+    return jsonify({"error": e.description}), e.code, {"Retry-After": "1"}
+
+
+@bp.app_errorhandler(IdempotencyConflict)
+@bp.app_errorhandler(IdempotencyKeyReused)
+def idempotency_error(e):
+    headers = {"Retry-After": "1"} if isinstance(e, IdempotencyConflict) else {}
+    return jsonify({"error": e.description}), e.code, headers
+
+
 @jwt.invalid_token_loader
 def invalid_token_callback(jwt_header, jwt_payload=None):
     return jsonify({"message": "Invalid token"}), 401
@@ -60,7 +127,9 @@ def invalid_token_callback(jwt_header, jwt_payload=None):
 @jwt_required(refresh=True)
 def refresh():
     current_user = load_user()
-    new_token = create_access_token(identity=current_user.email)
+    new_token = create_access_token(
+        identity=current_user.email, additional_claims=identity_claims(current_user)
+    )
     return jsonify({"access_token": new_token}), 200
 
 
@@ -74,7 +143,15 @@ def login():
     if user is None or not user.check_password(password):
         return jsonify({"error": "Invalid credentials"}), 401
 
-    access_token = create_access_token(identity=user.email)
+    # Hashes made with an older method or cost are upgraded while the
+    # plaintext is at hand.
+    if user.password_needs_rehash():
+        user.set_password(password)
+        db.session.commit()
+
+    access_token = create_access_token(
+        identity=user.email, additional_claims=identity_claims(user)
+    )
     refresh_token = create_refresh_token(identity=user.email)
 
     if access_token:
@@ -93,6 +170,7 @@ def login():
 
 @bp.route("/api/auth/whoami", methods=["GET"])
 @jwt_required()
+@replica.read_only
 def whoami():
     user = load_user()
     return jsonify({"email": user.email}), 200
@@ -100,7 +178,12 @@ def whoami():
 
 @bp.route("/api/claims", methods=["POST"])
 @jwt_required()
+@idempotent
 def create_claim():
+    # pydantic is only needed here, so it is not imported with the app.
+    from app.schemas import ClaimCreate
+    from pydantic import ValidationError
+
     claim_data = {key: request.form.get(key) for key in request.form.keys()}
     file_data = {key: request.files.get(key) for key in request.files.keys()}
 
@@ -110,7 +193,7 @@ def create_claim():
         return jsonify({"error": "User not found"}), 404
 
     try:
-        claim = ClaimCreate(**claim_data)
+        claim_data = ClaimCreate(**claim_data)
     except ValidationError as e:
         return jsonify({"error": e.errors()}), 400
 
@@ -119,58 +202,33 @@ def create_claim():
     if not valid:
         return jsonify({"error": files_or_error}), 400
 
-    claim = Claim(
-        user_id=user.id,
-        date_of_accident=claim.date_of_accident,
-        accident_type=claim.accident_type,
-        description=claim.description,
-        injuries_reported=claim.injuries_reported,
-        damage_details=claim.damage_details,
-        policy_number=claim.policy_number,
-    )
+    app.logger.debug("Upload footprint: %s", upload_footprint(files_or_error))
 
-    db.session.add(claim)
-    db.session.commit()
+    uploads = prepare_uploads(files_or_error)
+    stored, owned = stored_images(db.session, user.id, uploads)
+    own = [upload for upload in uploads if upload.content_hash in owned]
+    fresh = [upload for upload in uploads if upload.content_hash not in stored]
 
-    images = []
-    for file in files_or_error:
+    if image_queue.backend is None and fresh:
         try:
-            with tempfile.NamedTemporaryFile(delete=False) as temp:
-                file.save(temp.name)
-                filename = secure_filename(file.filename.replace(" ", "_"))
-                supabase.client.storage.from_(
-                    app.config.get("SUPABASE_STORAGE_BUCKET")
-                ).upload(filename, temp.name)
-                os.unlink(temp.name)
-            # file.save(os.path.join(app.config["UPLOAD_FOLDER"], filename))
-            image = Image(claim_id=claim.id, image_file=filename)
-            images.append(image)
+            stored.update(upload_files(fresh, app.config.get("UPLOAD_CONCURRENCY")))
         except Exception as e:
-            print(f"Exception while handling file: {e}")
+            app.logger.exception("Failed to store claim images")
             db.session.rollback()
             return jsonify({"error": str(e)}), 500
 
-    if len(images) > 0:
-        db.session.bulk_save_objects(images)
-
-    db.session.commit()
-
-    access_token = create_access_token(identity=user.id)
-
-    return (
-        jsonify(
-            {
-                "message": "Claim created successfully",
-                "claim_id": claim.id,
-                "access_token": access_token,
-            }
-        ),
-        201,
+    claim_id, status, jobs = add_claim(
+        db.session, user.id, claim_data, uploads, stored
     )
+    if jobs:
+        image_queue.submit(jobs)
+
+    return jsonify(created_claim(user, claim_id, status, own)), 201
 
 
 @bp.route("/api/claims", methods=["GET"])
 @jwt_required()
+@replica.read_only
 def get_claims():
     user = load_user()
 
@@ -180,22 +238,68 @@ def get_claims():
     page = request.args.get("page", 1, type=int)
     per_page = request.args.get("per_page", 10, type=int)
 
-    claims = (
-        Claim.query.options(joinedload(Claim.images))
-        .filter_by(user_id=user.id)
-        .order_by(desc(Claim.id))
-        .paginate(page=page, per_page=per_page, error_out=False)
-    )
+    try:
+        filters = parse_claim_filters(request.args)
+        sort = parse_claim_sort(request.args.get("sort"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    etag, last_modified = claims_validators(user, request.full_path)
+    cached = etag and cached_etag(etag, last_modified)
+    if cached:
+        return not_modified(cached, last_modified)
+
+    body = claims_cache.get(user.id, etag)
+    if body is not None:
+        response = app.response_class(body, mimetype="application/json")
+        return with_validators(response, etag, last_modified), 200
+
+    if "cursor" in request.args:
+        if sort != [("id", True)]:
+            return jsonify({"error": "Cursor pagination only sorts by -id"}), 400
+        try:
+            after_id = decode_cursor(request.args.get("cursor"))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        with_total = request.args.get("with_total", "false").lower() == "true"
+        payload = claims_after(
+            db.session, user.id, filters, after_id, per_page, with_total
+        )
+    else:
+        payload = claims_page(db.session, user.id, filters, sort, page, per_page)
+
+    if include_urls():
+        claims = payload["claims"]
+        attach_image_urls(claims, storage.image_urls(image_paths(claims)))
+    response = jsonify(payload)
+    claims_cache.set(user.id, etag, response.get_data())
+    return with_validators(response, etag, last_modified), 200
+
+
+@bp.route("/api/claims/search", methods=["GET"])
+@jwt_required()
+@replica.read_only
+def search_claims():
+    user = load_user()
+
+    if user is None:
+        return jsonify({"error": "User not found"}), 404
+
+    terms = search_terms(request.args.get("q"))
+    if not terms:
+        return jsonify({"error": "Missing search query"}), 400
 
-    if claims is None:
-        return jsonify({"error": "Claims not found"}), 404
+    page = request.args.get("page", 1, type=int)
+    per_page = request.args.get("per_page", 10, type=int)
 
-    claims_items = [claim.to_dict() for claim in claims.items]
+    claims = db.paginate(
+        search_query(user.id, terms), page=page, per_page=per_page, error_out=False
+    )
 
     return (
         jsonify(
             {
-                "claims": claims_items,
+                "claims": serialize_claims(claims.items, include_urls=include_urls()),
                 "total": claims.total,
                 "pages": claims.pages,
                 "current_page": claims.page,
@@ -205,11 +309,160 @@ def get_claims():
     )
 
 
+@bp.route("/api/claims/stats", methods=["GET"])
+@jwt_required()
+@replica.read_only
+def get_claim_stats():
+    user = load_user()
+
+    if user is None:
+        return jsonify({"error": "User not found"}), 404
+
+    # Admins see every user's claims unless they ask for one user.
+    user_id = user.id
+    if user.is_admin:
+        user_id = request.args.get("user_id", type=int)
+
+    return jsonify(claim_stats(user_id)), 200
+
+
+@bp.route("/api/admin/metrics", methods=["GET"])
+@jwt_required()
+def get_metrics():
+    user = load_user()
+
+    if user is None or not user.is_admin:
+        return jsonify({"error": "Admin only"}), 403
+
+    return (
+        jsonify(
+            {"db_pool": pool_stats.snapshot(), "claims_cache": claims_cache.stats()}
+        ),
+        200,
+    )
+
+
+@bp.route("/api/claims/export", methods=["GET"])
+@jwt_required()
+@replica.read_only
+def export_claims():
+    user = load_user()
+
+    if user is None:
+        return jsonify({"error": "User not found"}), 404
+
+    export_format = request.args.get("format", "ndjson")
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({"error": "Unsupported export format"}), 400
+    if export_format == "parquet" and not parquet_available():
+        return jsonify({"error": "Parquet export requires pyarrow"}), 400
+
+    user_id = user.id
+    if user.is_admin:
+        user_id = request.args.get("user_id", type=int)
+
+    exporter, mimetype = EXPORT_FORMATS[export_format]
+    body = exporter(iter_batches(claims_query(user_id)))
+
+    return Response(
+        stream_with_context(body),
+        mimetype=mimetype,
+        headers={
+            "Content-Disposition": f"attachment; filename=claims.{export_format}"
+        },
+    )
+
+
+@bp.route("/api/claims/bulk", methods=["POST"])
+@jwt_required()
+def bulk_create_claims():
+    user = load_user()
+
+    if user is None:
+        return jsonify({"error": "User not found"}), 404
+
+    default_format = "csv" if request.mimetype == "text/csv" else "ndjson"
+    ingest_format = request.args.get("format", default_format)
+    if ingest_format not in INGEST_FORMATS:
+        return jsonify({"error": "Unsupported ingest format"}), 400
+
+    user_id = user.id
+    if user.is_admin:
+        user_id = request.args.get("user_id", user.id, type=int)
+        if user_id != user.id and db.session.get(User, user_id) is None:
+            return jsonify({"error": "User not found"}), 400
+
+    # The body is parsed as it is read, so it is never held in memory whole.
+    stream = io.TextIOWrapper(request.stream, encoding="utf-8", newline="")
+    try:
+        report = ingest_claims(
+            INGEST_FORMATS[ingest_format](stream),
+            user_id,
+            app.config.get("INGEST_CHUNK_SIZE"),
+            app.config.get("INGEST_MAX_ERRORS"),
+        )
+    except UnicodeDecodeError:
+        return jsonify({"error": "Body is not valid UTF-8"}), 400
+
+    if user_id == user.id:
+        # Only the importing client can carry the write, so an admin importing
+        # for another user leaves that user's reads on the replica.
+        report["access_token"] = create_access_token(
+            identity=user.email,
+            additional_claims={**identity_claims(user), **replica.wrote()},
+        )
+    return jsonify(report), 200
+
+
+def include_urls():
+    return request.args.get("include_urls", "false").lower() == "true"
+
+
+def claims_validators(user, scope, with_urls=None):
+    # Signed URLs expire, so a response carrying them cannot be revalidated.
+    if with_urls is None:
+        with_urls = include_urls()
+    if with_urls and storage.url_mode == "signed":
+        return None, None
+
+    version, modified_at = claims_version(user.id)
+    return claims_etag(user.id, version, scope), modified_at
+
+
+def cached_etag(etag, last_modified):
+    return matching_etag(
+        compress.etag_variants(etag),
+        request.if_none_match,
+        request.if_modified_since,
+        last_modified,
+    )
+
+
+def with_validators(response, etag, last_modified):
+    if etag is not None:
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        # Browsers may keep the response but have to revalidate it each time.
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    return response
+
+
+def not_modified(etag, last_modified):
+    return with_validators(Response(status=304), etag, last_modified)
+
+
 @bp.route("/api/claims/<id>", methods=["GET"])
 @jwt_required()
+@replica.read_only
 def serve_image(id):
     current_user = load_user()
 
+    etag, last_modified = claims_validators(current_user, f"claim:{id}", True)
+    cached = etag and cached_etag(etag, last_modified)
+    if cached:
+        return not_modified(cached, last_modified)
+
     claim = (
         Claim.query.options(joinedload(Claim.images))
         .filter(and_(Claim.id == id, Claim.user_id == current_user.id))
@@ -218,13 +471,34 @@ def serve_image(id):
 
     if claim is None:
         return jsonify({"error": "Claim not found"}), 404
-    claimDict = claim.to_dict()
+    claimDict = serialize_claims([claim], include_urls=True)[0]
+    images = [image["url"] for image in claimDict["images"]]
 
-    images = []
-    for image in claimDict["images"]:
-        res = supabase.client.storage.from_("uploads").get_public_url(
-            image["image_file"]
-        )
-        images.append(res)
+    return (
+        with_validators(
+            jsonify(
+                {
+                    "claim": claimDict,
+                    "images": images,
+                    "progress": claim_progress(claim.id),
+                }
+            ),
+            etag,
+            last_modified,
+        ),
+        200,
+    )
+
+
+@bp.route("/uploads/<path:filename>", methods=["GET"])
+def uploaded_file(filename):
+    if not isinstance(storage.backend, LocalStorage):
+        return jsonify({"error": "Not found"}), 404
+
+    token = request.args.get("token")
+    if token is None and storage.url_mode == "signed":
+        return jsonify({"error": "Missing token"}), 403
+    if token is not None and not storage.verify_token(filename, token):
+        return jsonify({"error": "Invalid token"}), 403
 
-    return jsonify({"claim": claim.to_dict(), "images": images}), 200
+    return send_from_directory(storage.root, filename)
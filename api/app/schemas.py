@@ -1,6 +1,6 @@
 from typing import List
-from pydantic import BaseModel
-from datetime import datetime
+from pydantic import BaseModel, field_validator
+from datetime import datetime, timezone
 
 
 class ClaimBase(BaseModel):
@@ -13,7 +13,14 @@ class ClaimBase(BaseModel):
 
 
 class ClaimCreate(ClaimBase):
-    pass
+    @field_validator("date_of_accident")
+    @classmethod
+    def to_utc(cls, value):
+        # Neither SQLite nor a Postgres timestamp column keeps the offset, so
+        # claims are stored in naive UTC, as the date filters expect.
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value
 
 
 class ImageBase(BaseModel):
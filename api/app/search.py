@@ -0,0 +1,85 @@
+from app import db
+from app.models import Claim
+import sqlalchemy as sa
+import re
+
+SEARCH_TABLE = "claim_search"
+SEARCH_INDEX = "ix_claim_search"
+
+# Postgres matches the query against this expression, so it has to stay
+# identical to the one the GIN index is built on.
+SEARCH_VECTOR = (
+    "to_tsvector('english', "
+    "coalesce(description, '') || ' ' || coalesce(damage_details, ''))"
+)
+
+SEARCH_DDL = {
+    "sqlite": [
+        # An external content table indexes the claim rows without storing
+        # a second copy of them, and the triggers keep it current.
+        f"CREATE VIRTUAL TABLE {SEARCH_TABLE} USING fts5("
+        "description, damage_details, content='claim', content_rowid='id', "
+        "tokenize='porter unicode61')",
+        f"CREATE TRIGGER {SEARCH_TABLE}_ai AFTER INSERT ON claim BEGIN "
+        f"INSERT INTO {SEARCH_TABLE}(rowid, description, damage_details) "
+        "VALUES (new.id, new.description, new.damage_details); END",
+        f"CREATE TRIGGER {SEARCH_TABLE}_ad AFTER DELETE ON claim BEGIN "
+        f"INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}, rowid, description, "
+        "damage_details) VALUES "
+        "('delete', old.id, old.description, old.damage_details); END",
+        f"CREATE TRIGGER {SEARCH_TABLE}_au AFTER UPDATE ON claim BEGIN "
+        f"INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}, rowid, description, "
+        "damage_details) VALUES "
+        "('delete', old.id, old.description, old.damage_details); "
+        f"INSERT INTO {SEARCH_TABLE}(rowid, description, damage_details) "
+        "VALUES (new.id, new.description, new.damage_details); END",
+    ],
+    "postgresql": [
+        f"CREATE INDEX {SEARCH_INDEX} ON claim USING gin ({SEARCH_VECTOR})",
+    ],
+}
+
+SEARCH_DROP_DDL = {
+    "sqlite": [f"DROP TABLE IF EXISTS {SEARCH_TABLE}"],
+    "postgresql": [f"DROP INDEX IF EXISTS {SEARCH_INDEX}"],
+}
+
+
+def is_search_object(name):
+    return name.startswith(SEARCH_TABLE) or name == SEARCH_INDEX
+
+
+@sa.event.listens_for(Claim.__table__, "after_create")
+def create_search_index(target, connection, **kw):
+    for statement in SEARCH_DDL.get(connection.dialect.name, []):
+        connection.exec_driver_sql(statement)
+
+
+@sa.event.listens_for(Claim.__table__, "before_drop")
+def drop_search_index(target, connection, **kw):
+    for statement in SEARCH_DROP_DDL.get(connection.dialect.name, []):
+        connection.exec_driver_sql(statement)
+
+
+def search_terms(q):
+    return re.findall(r"\w+", q or "")
+
+
+def search_query(user_id, terms):
+    stmt = sa.select(Claim).where(Claim.user_id == user_id)
+
+    if db.engine.dialect.name == "postgresql":
+        query = sa.func.plainto_tsquery("english", " ".join(terms))
+        vector = sa.literal_column(SEARCH_VECTOR)
+        return stmt.where(vector.op("@@")(query)).order_by(
+            sa.func.ts_rank(vector, query).desc(), Claim.id.desc()
+        )
+
+    # Each term is quoted so that FTS5 syntax in the input is matched as text.
+    search = sa.table(SEARCH_TABLE, sa.column("rowid"))
+    match = " ".join(f'"{term}"' for term in terms)
+    return (
+        stmt.join(search, search.c.rowid == Claim.id)
+        .where(sa.literal_column(SEARCH_TABLE).op("MATCH")(match))
+        .order_by(sa.func.bm25(sa.literal_column(SEARCH_TABLE)), Claim.id.desc())
+    )
@@ -0,0 +1,107 @@
+from app import db
+from app.models import Claim, ClaimStat
+from collections import Counter
+from datetime import date, timezone
+from sqlalchemy.dialects import postgresql, sqlite
+import sqlalchemy as sa
+
+UPSERTS = {
+    "postgresql": postgresql.insert,
+    "sqlite": sqlite.insert,
+}
+
+
+def claim_month(value):
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc)
+    return date(value.year, value.month, 1)
+
+
+def record_claim_stats(user_id, claims, session=None):
+    """Add a user's new claims to the summary table, in the caller's transaction."""
+    claims_count = Counter()
+    injuries_count = Counter()
+    for claim in claims:
+        key = (claim.accident_type, claim_month(claim.date_of_accident))
+        claims_count[key] += 1
+        injuries_count[key] += int(bool(claim.injuries_reported))
+    if not claims_count:
+        return
+
+    rows = [
+        {
+            "user_id": user_id,
+            "accident_type": accident_type,
+            "month": month,
+            "claims": count,
+            "injuries": injuries_count[(accident_type, month)],
+        }
+        for (accident_type, month), count in claims_count.items()
+    ]
+    # Concurrent writers add to the same bucket atomically.
+    session = session or db.session
+    insert = UPSERTS[session.get_bind().dialect.name](ClaimStat)
+    session.execute(
+        insert.on_conflict_do_update(
+            index_elements=["user_id", "accident_type", "month"],
+            set_={
+                "claims": ClaimStat.claims + insert.excluded.claims,
+                "injuries": ClaimStat.injuries + insert.excluded.injuries,
+            },
+        ),
+        rows,
+    )
+
+
+def month_expression(dialect):
+    if dialect == "postgresql":
+        return sa.cast(sa.func.date_trunc("month", Claim.date_of_accident), sa.Date)
+    return sa.func.date(Claim.date_of_accident, "start of month")
+
+
+def rebuild_claim_stats():
+    month = month_expression(db.session.get_bind().dialect.name)
+    stmt = sa.select(
+        Claim.user_id,
+        Claim.accident_type,
+        month,
+        sa.func.count(),
+        sa.func.sum(sa.case((Claim.injuries_reported, 1), else_=0)),
+    ).group_by(Claim.user_id, Claim.accident_type, month)
+
+    db.session.execute(sa.delete(ClaimStat))
+    db.session.execute(
+        sa.insert(ClaimStat).from_select(
+            ["user_id", "accident_type", "month", "claims", "injuries"], stmt
+        )
+    )
+    db.session.commit()
+    return db.session.scalar(sa.select(sa.func.count()).select_from(ClaimStat))
+
+
+def claim_stats(user_id=None):
+    stmt = sa.select(
+        ClaimStat.accident_type,
+        ClaimStat.month,
+        ClaimStat.claims,
+        ClaimStat.injuries,
+    )
+    if user_id is not None:
+        stmt = stmt.where(ClaimStat.user_id == user_id)
+
+    total = injuries = 0
+    by_accident_type = Counter()
+    by_month = Counter()
+    for row in db.session.execute(stmt):
+        total += row.claims
+        injuries += row.injuries
+        by_accident_type[row.accident_type] += row.claims
+        by_month[row.month.strftime("%Y-%m")] += row.claims
+
+    return {
+        "total": total,
+        "injuries": injuries,
+        "injury_rate": injuries / total if total else 0.0,
+        "by_accident_type": dict(sorted(by_accident_type.items())),
+        "by_month": dict(sorted(by_month.items())),
+    }
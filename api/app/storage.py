@@ -0,0 +1,205 @@
+from itsdangerous import BadSignature, URLSafeSerializer
+from flask import url_for
+import os
+import posixpath
+import shutil
+import threading
+import time
+
+
+class Storage:
+    def upload(self, path, body, content_type=None):
+        raise NotImplementedError
+
+    def download(self, path):
+        raise NotImplementedError
+
+    def delete(self, paths):
+        raise NotImplementedError
+
+    def exists(self, path):
+        raise NotImplementedError
+
+    def public_urls(self, paths):
+        raise NotImplementedError
+
+    def signed_urls(self, paths, expires_in):
+        raise NotImplementedError
+
+    def empty(self):
+        raise NotImplementedError
+
+
+class SupabaseStorage(Storage):
+    def __init__(self, url, key, bucket):
+        self.url = url
+        self.key = key
+        self.bucket = bucket
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        # The client is built on first use so that importing the app does not
+        # require Supabase credentials.
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    from supabase import create_client
+
+                    self._client = create_client(self.url, self.key)
+        return self._client
+
+    def _bucket(self):
+        return self.client.storage.from_(self.bucket)
+
+    def upload(self, path, body, content_type=None):
+        options = {"content-type": content_type} if content_type else None
+        self._bucket().upload(path, body, options)
+
+    def download(self, path):
+        return self._bucket().download(path)
+
+    def delete(self, paths):
+        if paths:
+            self._bucket().remove(list(paths))
+
+    def exists(self, path):
+        folder, name = posixpath.split(path)
+        files = self._bucket().list(folder or None, {"search": name})
+        return any(file["name"] == name for file in files)
+
+    def public_urls(self, paths):
+        # Public URLs are derived from the bucket's base URL, no request is
+        # made to storage.
+        bucket = self._bucket()
+        return {path: bucket.get_public_url(path) for path in paths}
+
+    def signed_urls(self, paths, expires_in):
+        if not paths:
+            return {}
+        signed = self._bucket().create_signed_urls(list(paths), expires_in)
+        return {item["path"]: item["signedURL"] for item in signed}
+
+    def empty(self):
+        self.client.storage.empty_bucket(self.bucket)
+
+
+class LocalStorage(Storage):
+    def __init__(self, root, secret_key):
+        self.root = root
+        self.serializer = URLSafeSerializer(secret_key, salt="uploads")
+
+    def _path(self, path):
+        full_path = os.path.abspath(os.path.join(self.root, path))
+        if os.path.commonpath([full_path, os.path.abspath(self.root)]) != (
+            os.path.abspath(self.root)
+        ):
+            raise ValueError("Invalid storage path")
+        return full_path
+
+    def upload(self, path, body, content_type=None):
+        full_path = self._path(path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, "xb") as f:
+            if isinstance(body, bytes):
+                f.write(body)
+            else:
+                shutil.copyfileobj(body, f)
+
+    def download(self, path):
+        with open(self._path(path), "rb") as f:
+            return f.read()
+
+    def delete(self, paths):
+        for path in paths:
+            try:
+                os.remove(self._path(path))
+            except FileNotFoundError:
+                pass
+
+    def exists(self, path):
+        return os.path.isfile(self._path(path))
+
+    def public_urls(self, paths):
+        return {
+            path: url_for("main.uploaded_file", filename=path, _external=True)
+            for path in paths
+        }
+
+    def signed_urls(self, paths, expires_in):
+        return {
+            path: url_for(
+                "main.uploaded_file",
+                filename=path,
+                token=self.serializer.dumps(
+                    {"path": path, "expires_at": int(time.time()) + expires_in}
+                ),
+                _external=True,
+            )
+            for path in paths
+        }
+
+    def verify_token(self, path, token):
+        try:
+            data = self.serializer.loads(token)
+        except BadSignature:
+            return False
+        return data["path"] == path and data["expires_at"] > time.time()
+
+    def empty(self):
+        if os.path.isdir(self.root):
+            shutil.rmtree(self.root)
+
+
+class MemoryStorage(Storage):
+    def __init__(self, bucket="uploads"):
+        self.bucket = bucket
+        self.files = {}
+        self.lock = threading.Lock()
+
+    def upload(self, path, body, content_type=None):
+        data = body if isinstance(body, bytes) else body.read()
+        with self.lock:
+            if path in self.files:
+                raise FileExistsError(path)
+            self.files[path] = (data, content_type)
+
+    def download(self, path):
+        return self.files[path][0]
+
+    def delete(self, paths):
+        with self.lock:
+            for path in paths:
+                self.files.pop(path, None)
+
+    def exists(self, path):
+        return path in self.files
+
+    def public_urls(self, paths):
+        return {path: f"memory://{self.bucket}/{path}" for path in paths}
+
+    def signed_urls(self, paths, expires_in):
+        return {
+            path: f"memory://{self.bucket}/{path}?expires_in={expires_in}"
+            for path in paths
+        }
+
+    def empty(self):
+        with self.lock:
+            self.files.clear()
+
+
+def create_storage(config):
+    backend = config.get("STORAGE_BACKEND")
+    if backend == "supabase":
+        return SupabaseStorage(
+            config.get("SUPABASE_URL"),
+            config.get("SUPABASE_KEY"),
+            config.get("SUPABASE_STORAGE_BUCKET"),
+        )
+    if backend == "local":
+        return LocalStorage(config.get("UPLOAD_FOLDER"), config.get("SECRET_KEY"))
+    if backend == "memory":
+        return MemoryStorage(config.get("SUPABASE_STORAGE_BUCKET"))
+    raise ValueError(f"Unknown storage backend: {backend}")
@@ -0,0 +1,272 @@
+from app import storage
+from app.models import find_stored_images
+from app.derivatives import derivative_names, render_derivatives_async
+from app.helpers import (
+    SIGNATURE_LENGTH,
+    UploadRejected,
+    allowed_filename,
+    sniff_image,
+)
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from flask import Request, current_app
+from werkzeug.datastructures import FileStorage
+from werkzeug.exceptions import RequestEntityTooLarge
+import hashlib
+import io
+import os
+import tempfile
+
+
+class HashingSpooledFile(tempfile.SpooledTemporaryFile):
+    def __init__(self, *args, max_file_size=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self.head = b""
+        self.max_file_size = max_file_size
+
+    def write(self, s):
+        # Reject the part as soon as it is known to be invalid, instead of
+        # after werkzeug has read the whole request body.
+        self.size += len(s)
+        if self.max_file_size is not None and self.size > self.max_file_size:
+            raise RequestEntityTooLarge("File too large")
+        if len(self.head) < SIGNATURE_LENGTH:
+            self.head += s[: SIGNATURE_LENGTH - len(self.head)]
+            if len(self.head) == SIGNATURE_LENGTH and sniff_image(self.head) is None:
+                raise UploadRejected("File type not allowed")
+        self.sha256.update(s)
+        return super().write(s)
+
+    def rollover(self):
+        # Spill to a named file, so derivatives are rendered by path instead
+        # of from a copy of the upload in memory.
+        if self._rolled:
+            return
+        spooled = self._file
+        self._file = tempfile.NamedTemporaryFile(**self._TemporaryFileArgs)
+        del self._TemporaryFileArgs
+        position = spooled.tell()
+        self._file.write(spooled.getvalue())
+        self._file.seek(position)
+        self._rolled = True
+
+
+def upload_stream(config, upload_count, filename, content_type):
+    if upload_count > config.get("MAX_UPLOAD_FILES"):
+        raise UploadRejected("Too many files")
+    if filename and not allowed_filename(filename, content_type):
+        raise UploadRejected("File type not allowed")
+
+    # Keep uploads in memory up to the threshold and only spill larger
+    # ones to disk, instead of werkzeug's unconditional temp file for any
+    # request above 500KB. The content hash is computed as werkzeug
+    # writes the part, so it costs no extra pass over the data.
+    return HashingSpooledFile(
+        max_size=config.get("UPLOAD_SPOOL_THRESHOLD"),
+        max_file_size=config.get("MAX_UPLOAD_FILE_SIZE"),
+    )
+
+
+class UploadRequest(Request):
+    def _get_file_stream(
+        self, total_content_length, content_type, filename=None, content_length=None
+    ):
+        self.upload_count = getattr(self, "upload_count", 0) + 1
+        return upload_stream(
+            current_app.config, self.upload_count, filename, content_type
+        )
+
+
+@dataclass
+class PreparedUpload:
+    file: FileStorage
+    content_hash: str
+    path: str
+    size: int
+
+
+def content_hash(file):
+    stream = file.stream
+    if isinstance(stream, HashingSpooledFile):
+        return stream.sha256.hexdigest(), stream.size
+    stream.seek(0)
+    sha256 = hashlib.sha256()
+    size = 0
+    for chunk in iter(lambda: stream.read(64 * 1024), b""):
+        sha256.update(chunk)
+        size += len(chunk)
+    stream.seek(0)
+    return sha256.hexdigest(), size
+
+
+def content_address(file):
+    digest, size = content_hash(file)
+    extension = file.filename.rsplit(".", 1)[1].lower()
+    return digest, f"{digest}.{extension}", size
+
+
+def prepare_uploads(files):
+    return [PreparedUpload(file, *content_address(file)) for file in files]
+
+
+def is_spooled_to_disk(stream):
+    if isinstance(stream, tempfile.SpooledTemporaryFile):
+        return stream._rolled
+    return not isinstance(stream, io.BytesIO)
+
+
+def upload_footprint(files):
+    footprint = {"memory_bytes": 0, "disk_bytes": 0}
+    for file in files:
+        stream = file.stream
+        size = stream.seek(0, 2)
+        stream.seek(0)
+        if is_spooled_to_disk(stream):
+            footprint["disk_bytes"] += size
+        else:
+            footprint["memory_bytes"] += size
+    return footprint
+
+
+def upload_body(stream):
+    stream.seek(0)
+    if isinstance(stream, tempfile.SpooledTemporaryFile) and not stream._rolled:
+        return stream._file.getvalue()
+    if isinstance(getattr(stream, "name", None), str):
+        return open(stream.name, "rb")
+    try:
+        fileno = stream.fileno()
+    except (AttributeError, OSError, ValueError):
+        return stream.read()
+    # Hand the spooled file to the storage client as a reader over the same
+    # descriptor, so it is streamed from where it already is on disk.
+    return open(fileno, "rb", closefd=False)
+
+
+def read_body(body):
+    if isinstance(body, bytes):
+        return body
+    body.seek(0)
+    return body.read()
+
+
+def image_source(body):
+    """The path of a body that is a file on disk, or else its bytes."""
+    name = getattr(body, "name", None)
+    if isinstance(name, str) and os.path.isfile(name):
+        return name
+    return read_body(body)
+
+
+def upload_once(path, body, content_type):
+    """Upload `path` unless it exists, and return whether this call wrote it."""
+    try:
+        storage.upload(path, body, content_type)
+    except Exception:
+        # Content addressed paths are immutable, so losing a race against an
+        # identical upload is not an error.
+        if not storage.exists(path):
+            raise
+        return False
+    return True
+
+
+def store_image(config, path, body, content_type, created=None):
+    """Store an image and its derivatives, adding the paths it wrote to `created`."""
+    if created is None:
+        created = []
+    if not config.get("IMAGE_DERIVATIVES"):
+        if upload_once(path, body, content_type):
+            created.append(path)
+        return {"image_file": path}
+
+    # Start rendering the derivatives before uploading the original, so the
+    # two overlap when the pipeline runs in the process pool.
+    rendering = render_derivatives_async(config, image_source(body))
+    if not isinstance(body, bytes):
+        body.seek(0)
+    if upload_once(path, body, content_type):
+        created.append(path)
+    stored = {"image_file": path}
+    try:
+        rendered = rendering.result()
+        if rendered is not None:
+            extension = config.get("IMAGE_DERIVATIVE_FORMAT").lower()
+            names = derivative_names(path, extension)
+            for kind, data in rendered.items():
+                if upload_once(names[kind], data, f"image/{extension}"):
+                    created.append(names[kind])
+                stored[f"{kind}_file"] = names[kind]
+    except Exception:
+        # Objects that already existed may belong to another claim.
+        storage.delete(created)
+        raise
+    return stored
+
+
+def upload_file(config, upload, created):
+    body = upload_body(upload.file.stream)
+    try:
+        return store_image(
+            config, upload.path, body, upload.file.mimetype, created
+        )
+    finally:
+        if not isinstance(body, bytes):
+            body.close()
+
+
+def unreferenced_paths(uploaded, created, session=None):
+    """The paths in `created` for content that no Image row references yet."""
+    referenced = find_stored_images(list(uploaded), session)
+    return [
+        path
+        for content_hash in uploaded
+        if content_hash not in referenced
+        for path in created[content_hash]
+    ]
+
+
+def upload_files(uploads, max_workers):
+    # Identical files within one request are only uploaded once.
+    unique = list({upload.content_hash: upload for upload in uploads}.values())
+    if not unique:
+        return {}
+
+    config = current_app.config
+    created = {upload.content_hash: [] for upload in unique}
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(unique))) as executor:
+        futures = {
+            upload.content_hash: executor.submit(
+                upload_file, config, upload, created[upload.content_hash]
+            )
+            for upload in unique
+        }
+        done, pending = wait(futures.values(), return_when=FIRST_EXCEPTION)
+        # Uploads that have not started yet are skipped once one has failed,
+        # the ones already running are allowed to finish so they can be
+        # cleaned up below.
+        for future in pending:
+            future.cancel()
+
+    uploaded = {
+        content_hash: future.result()
+        for content_hash, future in futures.items()
+        if not future.cancelled() and future.exception() is None
+    }
+    errors = [
+        future.exception()
+        for future in futures.values()
+        if not future.cancelled() and future.exception() is not None
+    ]
+
+    if errors:
+        if uploaded:
+            try:
+                storage.delete(unreferenced_paths(uploaded, created))
+            except Exception:
+                current_app.logger.exception("Failed to clean up uploads")
+        raise errors[0]
+
+    return uploaded
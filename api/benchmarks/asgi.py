@@ -0,0 +1,158 @@
+"""Concurrent throughput of the sync (WSGI) and async (ASGI) claim routes.
+
+Storage calls are given a fixed latency to stand in for Supabase, blocking
+the worker in the sync app and yielding to the event loop in the async one.
+
+Run from the api directory: python -m benchmarks.asgi
+"""
+from benchmarks.common import auth_headers, report
+from config import TestConfig
+from app import db, storage
+from app.asgi import create_asgi_app
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import httpx
+import io
+import os
+import sqlalchemy as sa
+import tempfile
+import time
+
+
+def claim_request(n, images):
+    data = {
+        "policy_number": "bench",
+        "date_of_accident": "2024-03-24T22:00:00.000Z",
+        "accident_type": "Car accident",
+        "description": "benchmark",
+        "damage_details": "benchmark",
+        "injuries_reported": "false",
+    }
+    files = {
+        f"images[{i}]": (
+            f"{i}.jpg",
+            b"\xff\xd8\xff" + f"{n}-{i}".encode() * 1024,
+            "image/jpeg",
+        )
+        for i in range(images)
+    }
+    return data, files
+
+
+def slow_storage(asgi_app, latency):
+    backend = storage.backend
+    upload, signed_urls = backend.upload, backend.signed_urls
+
+    def sync_upload(*args):
+        time.sleep(latency)
+        return upload(*args)
+
+    def sync_signed_urls(*args):
+        time.sleep(latency)
+        return signed_urls(*args)
+
+    async def async_upload(*args):
+        await asyncio.sleep(latency)
+        return upload(*args)
+
+    async def async_signed_urls(*args):
+        await asyncio.sleep(latency)
+        return signed_urls(*args)
+
+    backend.upload, backend.signed_urls = sync_upload, sync_signed_urls
+    async_backend = asgi_app.state.storage.backend
+    async_backend.upload, async_backend.signed_urls = async_upload, async_signed_urls
+
+
+def run_sync(app, headers, requests, workers):
+    def worker(chunk):
+        client = app.test_client()
+        for method, url, data, files in chunk:
+            if method == "POST":
+                form = dict(data)
+                for key, (filename, body, content_type) in files.items():
+                    form[key] = (io.BytesIO(body), filename, content_type)
+                response = client.post(url, data=form, headers=headers)
+            else:
+                response = client.get(url, headers=headers)
+            assert response.status_code < 300, response.get_json()
+
+    chunks = [requests[i::workers] for i in range(workers)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(worker, chunks))
+    return time.perf_counter() - start
+
+
+async def run_async(asgi_app, headers, requests, concurrency):
+    transport = httpx.ASGITransport(app=asgi_app)
+    slots = asyncio.Semaphore(concurrency)
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://bench", headers=headers
+    ) as client:
+
+        async def send(method, url, data, files):
+            async with slots:
+                response = await client.request(method, url, data=data, files=files)
+            assert response.status_code < 300, response.text
+
+        start = time.perf_counter()
+        await asyncio.gather(*[send(*request) for request in requests])
+        return time.perf_counter() - start
+
+
+def main(requests=200, workers=4, concurrency=64, images=2, latency=0.05):
+    directory = tempfile.mkdtemp()
+    config = type(
+        "BenchConfig",
+        (TestConfig,),
+        {
+            "SQLALCHEMY_DATABASE_URI": "sqlite:///"
+            + os.path.join(directory, "bench.db"),
+            "IMAGE_DERIVATIVES": False,
+            "IMAGE_URL_MODE": "signed",
+            "IMAGE_URL_CACHE_SIZE": 0,
+        },
+    )
+    asgi_app = create_asgi_app(config)
+    app = asgi_app.state.flask_app
+    with app.app_context():
+        db.create_all()
+        # SQLite stands in for Postgres here; in WAL mode concurrent writers
+        # wait for each other instead of failing with "database is locked".
+        db.session.execute(sa.text("PRAGMA journal_mode=WAL"))
+        headers = auth_headers(app)
+        slow_storage(asgi_app, latency)
+
+        counter = iter(range(10**9))
+        creates = [
+            ("POST", "/api/claims", *claim_request(next(counter), images))
+            for _ in range(requests)
+        ]
+        print(f"{workers} sync workers vs {concurrency} concurrent async requests")
+        for name, scenario in (("create_claim", creates), ("serve_image", None)):
+            if scenario is None:
+                scenario = [
+                    ("GET", f"/api/claims/{claim_id % requests + 1}", None, None)
+                    for claim_id in range(requests)
+                ]
+            sync_elapsed = run_sync(app, headers, scenario, workers)
+            if name == "create_claim":
+                scenario = [
+                    ("POST", "/api/claims", *claim_request(next(counter), images))
+                    for _ in range(requests)
+                ]
+            async_elapsed = asyncio.run(
+                run_async(asgi_app, headers, scenario, concurrency)
+            )
+            report(
+                name,
+                {
+                    "sync_rps": requests / sync_elapsed,
+                    "async_rps": requests / async_elapsed,
+                },
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+"""GET /api/claims with and without the claims response cache.
+
+Run from the api directory: python -m benchmarks.claims_cache
+"""
+from benchmarks.common import auth_headers, bench_app, report, timeit
+from app import claims_cache, db
+from app.models import Claim, User
+from datetime import datetime
+
+
+def main(claims=500):
+    for backend in ("none", "memory"):
+        app = bench_app(CLAIMS_CACHE_BACKEND=backend)
+        with app.app_context():
+            db.create_all()
+            headers = auth_headers(app)
+            user = User.query.first()
+            db.session.add_all(
+                Claim(
+                    user_id=user.id,
+                    policy_number=f"policy-{i}",
+                    date_of_accident=datetime(2024, 3, 24, 22, 0),
+                    accident_type="Car accident",
+                    description="Rear bumper dented while parked",
+                    injuries_reported=i % 2 == 0,
+                    damage_details="Bumper and tail light",
+                )
+                for i in range(claims)
+            )
+            db.session.commit()
+
+            client = app.test_client()
+            for per_page in (10, 100):
+                url = f"/api/claims?per_page={per_page}"
+                result = timeit(lambda: client.get(url, headers=headers), repeat=200)
+                report(f"get_claims cache={backend} per_page={per_page}", result)
+            if backend != "none":
+                report("cache", claims_cache.stats())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+from config import TestConfig
+from app import create_app, db
+from app.models import User, identity_claims
+from flask_jwt_extended import create_access_token
+import statistics
+import time
+
+
+def bench_app(config_class=TestConfig, **overrides):
+    # Overrides go on a subclass so that extensions see them in init_app.
+    return create_app(type("BenchConfig", (config_class,), overrides))
+
+
+def auth_headers(app, email="bench@example.com"):
+    with app.app_context():
+        user = User.query.filter_by(email=email).first()
+        if user is None:
+            user = User(email=email)
+            db.session.add(user)
+            db.session.commit()
+        token = create_access_token(
+            identity=user.email, additional_claims=identity_claims(user)
+        )
+    return {"Authorization": f"Bearer {token}"}
+
+
+def timeit(fn, repeat=20):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return {
+        "mean_ms": statistics.mean(timings) * 1000,
+        "p95_ms": sorted(timings)[int(len(timings) * 0.95) - 1] * 1000,
+    }
+
+
+def report(name, result):
+    values = ", ".join(f"{key}={value:.2f}" for key, value in result.items())
+    print(f"{name}: {values}")
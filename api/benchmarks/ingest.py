@@ -0,0 +1,48 @@
+"""Offline benchmark of POST /api/claims/bulk.
+
+Run from the api directory: python -m benchmarks.ingest
+"""
+from benchmarks.common import auth_headers, bench_app, report, timeit
+from app import db
+import json
+
+
+def main(rows=100_000):
+    app = bench_app()
+    with app.app_context():
+        db.create_all()
+        headers = auth_headers(app)
+        client = app.test_client()
+        body = "\n".join(
+            json.dumps(
+                {
+                    "policy_number": f"policy-{i}",
+                    "date_of_accident": "2024-03-24T22:00:00.000Z",
+                    "accident_type": "Car accident",
+                    "description": "benchmark",
+                    "injuries_reported": i % 2 == 0,
+                    "damage_details": "benchmark",
+                }
+            )
+            for i in range(rows)
+        )
+
+        def ingest():
+            response = client.post(
+                "/api/claims/bulk",
+                data=body,
+                headers=headers,
+                content_type="application/x-ndjson",
+            )
+            assert response.get_json()["inserted"] == rows, response.get_json()
+
+        for chunk_size in (500, app.config["INGEST_CHUNK_SIZE"], 20_000):
+            app.config["INGEST_CHUNK_SIZE"] = chunk_size
+            report(
+                f"bulk_create_claims rows={rows} chunk_size={chunk_size}",
+                timeit(ingest, repeat=3),
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""Offline benchmark of POST /api/auth/login under a burst of logins.
+
+Reports login throughput, how many logins were turned away, and the latency of
+a cheap endpoint served while the burst runs.
+
+Run from the api directory: python -m benchmarks.login
+"""
+from benchmarks.common import auth_headers, bench_app, report, timeit
+from concurrent.futures import ThreadPoolExecutor
+from app import db
+from app.models import User
+import time
+
+
+def main(method="scrypt", concurrency=16, logins=64):
+    for workers, max_pending in ((concurrency, concurrency), (1, 8), (2, 8)):
+        app = bench_app(
+            PASSWORD_HASH_METHOD=method,
+            PASSWORD_HASH_WORKERS=workers,
+            PASSWORD_HASH_MAX_PENDING=max_pending,
+            PASSWORD_HASH_WAIT_TIMEOUT=5,
+        )
+        with app.app_context():
+            db.create_all()
+            headers = auth_headers(app)
+            user = User(email="login@example.com")
+            user.set_password("secret")
+            db.session.add(user)
+            db.session.commit()
+
+        credentials = {"email": "login@example.com", "password": "secret"}
+
+        def login(_):
+            return app.test_client().post("/api/auth/login", json=credentials)
+
+        def whoami():
+            app.test_client().get("/api/auth/whoami", headers=headers)
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            start = time.perf_counter()
+            burst = executor.map(login, range(logins))
+            latency = timeit(whoami, repeat=20)
+            statuses = [response.status_code for response in burst]
+            elapsed = time.perf_counter() - start
+
+        report(
+            f"login method={method} workers={workers} max_pending={max_pending}",
+            {
+                "logins_per_s": statuses.count(200) / elapsed,
+                "rejected": statuses.count(503),
+                "whoami_mean_ms": latency["mean_ms"],
+                "whoami_p95_ms": latency["p95_ms"],
+            },
+        )
+
+
+if __name__ == "__main__":
+    main()
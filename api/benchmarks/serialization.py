@@ -0,0 +1,53 @@
+"""Offline benchmark of JSON serialization and compression of GET /api/claims.
+
+Run from the api directory: python -m benchmarks.serialization
+"""
+from benchmarks.common import auth_headers, bench_app, report, timeit
+from app import db
+from app.json_provider import JSONProvider, OrjsonProvider, orjson_available
+from app.models import Claim, User, serialize_claims
+from datetime import datetime
+
+
+def main(claims=1000):
+    app = bench_app()
+    with app.app_context():
+        db.create_all()
+        headers = auth_headers(app)
+        user = User.query.first()
+        db.session.add_all(
+            Claim(
+                user_id=user.id,
+                policy_number=f"policy-{i}",
+                date_of_accident=datetime(2024, 3, 24, 22, 0),
+                accident_type="Car accident",
+                description="Rear bumper dented while parked " * 4,
+                injuries_reported=i % 2 == 0,
+                damage_details="Bumper, tail light and trunk lid " * 4,
+            )
+            for i in range(claims)
+        )
+        db.session.commit()
+
+        payload = {"claims": serialize_claims(Claim.query.all())}
+        providers = {"json": JSONProvider(app)}
+        if orjson_available():
+            providers["orjson"] = OrjsonProvider(app)
+        for name, provider in providers.items():
+            report(
+                f"{name} serialize claims={claims}",
+                timeit(lambda: provider.response(payload)),
+            )
+
+        client = app.test_client()
+        url = f"/api/claims?per_page={claims}"
+        for encoding in ("identity", "gzip", "br"):
+            request_headers = {**headers, "Accept-Encoding": encoding}
+            response = client.get(url, headers=request_headers)
+            result = timeit(lambda: client.get(url, headers=request_headers))
+            result["bytes"] = len(response.data)
+            report(f"get_claims claims={claims} encoding={encoding}", result)
+
+
+if __name__ == "__main__":
+    main()
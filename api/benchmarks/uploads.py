@@ -0,0 +1,58 @@
+"""Offline benchmark of POST /api/claims against the in-memory storage backend.
+
+Run from the api directory: python -m benchmarks.uploads
+"""
+from benchmarks.common import auth_headers, bench_app, report, timeit
+from app import db, storage
+from werkzeug.datastructures import FileStorage
+import io
+import time
+
+
+def main(images=8, image_size=512 * 1024, latency=0.05):
+    app = bench_app()
+    with app.app_context():
+        db.create_all()
+        headers = auth_headers(app)
+
+        # Simulate the network latency of a remote storage backend.
+        upload = storage.backend.upload
+        storage.backend.upload = lambda *args: (time.sleep(latency), upload(*args))
+
+        client = app.test_client()
+        counter = iter(range(10**9))
+
+        def create_claim():
+            n = next(counter)
+            data = {
+                "policy_number": "bench",
+                "date_of_accident": "2024-03-24T22:00:00.000Z",
+                "accident_type": "Car accident",
+                "description": "benchmark",
+                "damage_details": "benchmark",
+                "injuries_reported": "false",
+            }
+            for i in range(images):
+                data[f"images[{i}]"] = FileStorage(
+                    stream=io.BytesIO(b"\xff\xd8\xff" + b"\x00" * image_size),
+                    filename=f"{n}-{i}.jpg",
+                    content_type="image/jpeg",
+                )
+            response = client.post(
+                "/api/claims",
+                data=data,
+                headers=headers,
+                content_type="multipart/form-data",
+            )
+            assert response.status_code == 201, response.get_json()
+
+        for concurrency in (1, app.config["UPLOAD_CONCURRENCY"], images):
+            app.config["UPLOAD_CONCURRENCY"] = concurrency
+            report(
+                f"create_claim images={images} concurrency={concurrency}",
+                timeit(create_claim, repeat=10),
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -12,10 +12,79 @@ class Config:
     SQLALCHEMY_DATABASE_URI = (
         os.environ.get("DATABASE_URL")
     ) or "sqlite:///" + os.path.join(basedir, "app.db")
+    # "queue" keeps a pool of connections per process, "null" opens one per
+    # checkout for use behind a transaction pooler such as PgBouncer.
+    DB_POOL_MODE = os.environ.get("DB_POOL_MODE", "queue")
+    DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 5))
+    DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 10))
+    DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 30))
+    DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 1800))
+    DB_POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "true").lower() == "true"
+    # An optional read replica of SQLALCHEMY_DATABASE_URI for read-only routes.
+    # Tokens issued after a write read from the primary for this many seconds.
+    SQLALCHEMY_REPLICA_URI = os.environ.get("DATABASE_REPLICA_URL")
+    REPLICA_STICKY_SECONDS = float(os.environ.get("REPLICA_STICKY_SECONDS", 5))
     UPLOAD_FOLDER = os.path.join(basedir, "uploads")
     SUPABASE_KEY = os.environ.get("SUPABASE_KEY")
     SUPABASE_URL = os.environ.get("SUPABASE_URL")
-    SUPABASE_STORAGE_BUCKET = os.environ.get("SUPABASE_STORAGE_BUCKET")
+    SUPABASE_STORAGE_BUCKET = os.environ.get("SUPABASE_STORAGE_BUCKET", "uploads")
+    STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "supabase")
+    IMAGE_URL_MODE = os.environ.get("IMAGE_URL_MODE", "public")
+    SIGNED_URL_EXPIRES_IN = int(os.environ.get("SIGNED_URL_EXPIRES_IN", 3600))
+    IMAGE_URL_CACHE_SIZE = int(os.environ.get("IMAGE_URL_CACHE_SIZE", 10000))
+    MAX_CONTENT_LENGTH = int(os.environ.get("MAX_CONTENT_LENGTH", 50 * 1024 * 1024))
+    MAX_UPLOAD_FILE_SIZE = int(
+        os.environ.get("MAX_UPLOAD_FILE_SIZE", 10 * 1024 * 1024)
+    )
+    MAX_UPLOAD_FILES = int(os.environ.get("MAX_UPLOAD_FILES", 10))
+    UPLOAD_SPOOL_THRESHOLD = int(os.environ.get("UPLOAD_SPOOL_THRESHOLD", 1024 * 1024))
+    IMAGE_DERIVATIVES = os.environ.get("IMAGE_DERIVATIVES", "true").lower() == "true"
+    IMAGE_DERIVATIVE_FORMAT = os.environ.get("IMAGE_DERIVATIVE_FORMAT", "WEBP")
+    IMAGE_DERIVATIVE_QUALITY = int(os.environ.get("IMAGE_DERIVATIVE_QUALITY", 80))
+    IMAGE_DERIVATIVE_WORKERS = int(os.environ.get("IMAGE_DERIVATIVE_WORKERS", 1))
+    IMAGE_THUMBNAIL_SIZE = int(os.environ.get("IMAGE_THUMBNAIL_SIZE", 320))
+    IMAGE_DISPLAY_SIZE = int(os.environ.get("IMAGE_DISPLAY_SIZE", 1600))
+    # Larger images are stored without derivatives; decoding one takes three
+    # bytes per pixel.
+    MAX_IMAGE_PIXELS = int(os.environ.get("MAX_IMAGE_PIXELS", 40_000_000))
+    UPLOAD_CONCURRENCY = int(os.environ.get("UPLOAD_CONCURRENCY", 4))
+    IMAGE_QUEUE_BACKEND = os.environ.get("IMAGE_QUEUE_BACKEND", "thread")
+    IMAGE_JOB_MAX_ATTEMPTS = int(os.environ.get("IMAGE_JOB_MAX_ATTEMPTS", 3))
+    IMAGE_JOB_RETRY_DELAY = float(os.environ.get("IMAGE_JOB_RETRY_DELAY", 2))
+    IMAGE_JOB_LOCK_TIMEOUT = int(os.environ.get("IMAGE_JOB_LOCK_TIMEOUT", 300))
+    IDENTITY_CACHE_SIZE = int(os.environ.get("IDENTITY_CACHE_SIZE", 1024))
+    IDENTITY_CACHE_TTL = int(os.environ.get("IDENTITY_CACHE_TTL", 300))
+    INGEST_CHUNK_SIZE = int(os.environ.get("INGEST_CHUNK_SIZE", 5000))
+    INGEST_MAX_ERRORS = int(os.environ.get("INGEST_MAX_ERRORS", 1000))
+    # "memory" caches claim pages per process, "none" turns the cache off.
+    CLAIMS_CACHE_BACKEND = os.environ.get("CLAIMS_CACHE_BACKEND", "memory")
+    CLAIMS_CACHE_SIZE = int(os.environ.get("CLAIMS_CACHE_SIZE", 10000))
+    CLAIMS_CACHE_MAX_BYTES = int(
+        os.environ.get("CLAIMS_CACHE_MAX_BYTES", 64 * 1024 * 1024)
+    )
+    CLAIMS_CACHE_TTL = int(os.environ.get("CLAIMS_CACHE_TTL", 60))
+    # Responses to POST /api/claims with an Idempotency-Key are replayed for
+    # IDEMPOTENCY_KEY_TTL seconds. A retry waits up to IDEMPOTENCY_WAIT_TIMEOUT
+    # for the first request, which holds the key for IDEMPOTENCY_LOCK_TIMEOUT.
+    IDEMPOTENCY_KEY_TTL = int(os.environ.get("IDEMPOTENCY_KEY_TTL", 24 * 3600))
+    IDEMPOTENCY_WAIT_TIMEOUT = float(os.environ.get("IDEMPOTENCY_WAIT_TIMEOUT", 10))
+    IDEMPOTENCY_LOCK_TIMEOUT = int(os.environ.get("IDEMPOTENCY_LOCK_TIMEOUT", 300))
+    IDEMPOTENCY_POLL_INTERVAL = float(
+        os.environ.get("IDEMPOTENCY_POLL_INTERVAL", 0.1)
+    )
+    JSON_PROVIDER = os.environ.get("JSON_PROVIDER", "auto")
+    # Any werkzeug method, e.g. "scrypt:32768:8:1" or "pbkdf2:sha256:600000".
+    PASSWORD_HASH_METHOD = os.environ.get("PASSWORD_HASH_METHOD", "scrypt")
+    PASSWORD_HASH_SALT_LENGTH = int(os.environ.get("PASSWORD_HASH_SALT_LENGTH", 16))
+    PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", 1))
+    PASSWORD_HASH_MAX_PENDING = int(os.environ.get("PASSWORD_HASH_MAX_PENDING", 8))
+    PASSWORD_HASH_WAIT_TIMEOUT = float(
+        os.environ.get("PASSWORD_HASH_WAIT_TIMEOUT", 2)
+    )
+    COMPRESS_ENABLED = os.environ.get("COMPRESS_ENABLED", "true").lower() == "true"
+    COMPRESS_MIN_SIZE = int(os.environ.get("COMPRESS_MIN_SIZE", 1024))
+    COMPRESS_GZIP_LEVEL = int(os.environ.get("COMPRESS_GZIP_LEVEL", 6))
+    COMPRESS_BROTLI_QUALITY = int(os.environ.get("COMPRESS_BROTLI_QUALITY", 4))
 
 
 class TestConfig(Config):
@@ -23,4 +92,9 @@ class TestConfig(Config):
     SQLALCHEMY_DATABASE_URI = "sqlite:///:memory:"
     SUPABASE_KEY = os.environ.get("SUPABASE_KEY")
     SUPABASE_URL = os.environ.get("SUPABASE_URL")
-    SUPABASE_STORAGE_BUCKET = os.environ.get("SUPABASE_TEST_STORAGE_BUCKET")
+    SUPABASE_STORAGE_BUCKET = os.environ.get("SUPABASE_TEST_STORAGE_BUCKET", "test")
+    STORAGE_BACKEND = os.environ.get("TEST_STORAGE_BACKEND", "memory")
+    IMAGE_QUEUE_BACKEND = "inline"
+    IMAGE_JOB_RETRY_DELAY = 0
+    IMAGE_DERIVATIVE_WORKERS = 0
+    PASSWORD_HASH_METHOD = "pbkdf2:sha256:1000"
@@ -0,0 +1,66 @@
+"""add claim search index
+
+Revision ID: d8e4a1b7c392
+Revises: c5b7e2f90a13
+Create Date: 2026-10-18 14:02:37.514208
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd8e4a1b7c392'
+down_revision = 'c5b7e2f90a13'
+branch_labels = None
+depends_on = None
+
+
+SEARCH_VECTOR = (
+    "to_tsvector('english', "
+    "coalesce(description, '') || ' ' || coalesce(damage_details, ''))"
+)
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        op.execute(f"CREATE INDEX ix_claim_search ON claim USING gin ({SEARCH_VECTOR})")
+    elif dialect == 'sqlite':
+        op.execute(
+            "CREATE VIRTUAL TABLE claim_search USING fts5("
+            "description, damage_details, content='claim', content_rowid='id', "
+            "tokenize='porter unicode61')"
+        )
+        op.execute(
+            "CREATE TRIGGER claim_search_ai AFTER INSERT ON claim BEGIN "
+            "INSERT INTO claim_search(rowid, description, damage_details) "
+            "VALUES (new.id, new.description, new.damage_details); END"
+        )
+        op.execute(
+            "CREATE TRIGGER claim_search_ad AFTER DELETE ON claim BEGIN "
+            "INSERT INTO claim_search(claim_search, rowid, description, "
+            "damage_details) VALUES "
+            "('delete', old.id, old.description, old.damage_details); END"
+        )
+        op.execute(
+            "CREATE TRIGGER claim_search_au AFTER UPDATE ON claim BEGIN "
+            "INSERT INTO claim_search(claim_search, rowid, description, "
+            "damage_details) VALUES "
+            "('delete', old.id, old.description, old.damage_details); "
+            "INSERT INTO claim_search(rowid, description, damage_details) "
+            "VALUES (new.id, new.description, new.damage_details); END"
+        )
+        # Index the claims that already exist.
+        op.execute("INSERT INTO claim_search(claim_search) VALUES ('rebuild')")
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        op.execute("DROP INDEX ix_claim_search")
+    elif dialect == 'sqlite':
+        op.execute("DROP TRIGGER claim_search_au")
+        op.execute("DROP TRIGGER claim_search_ad")
+        op.execute("DROP TRIGGER claim_search_ai")
+        op.execute("DROP TABLE claim_search")
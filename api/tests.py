@@ -2,10 +2,57 @@ import pytest
 from flask_jwt_extended import create_refresh_token, create_access_token
 from flask import jsonify
 from config import TestConfig
-from app import create_app, db, supabase
-from app.models import User, Claim
+from app import (
+    create_app,
+    db,
+    image_queue,
+    passwords,
+    pool_stats,
+    replica,
+    storage,
+)
+from app.async_storage import AsyncStorageClient, AsyncSupabaseStorage
+from app.cache import TTLCache
+from app.derivatives import render_derivatives, render_derivatives_async
+from app.idempotency import finish_key
+from app.json_provider import JSONProvider, OrjsonProvider
+from app.response_cache import MemoryCacheBackend
+from app.stats import claim_stats
+from app.storage import LocalStorage
+from app.uploads import prepare_uploads, upload_body, upload_files
+from app.models import (
+    User,
+    Claim,
+    ClaimStat,
+    IdempotencyKey,
+    Image,
+    ImageJob,
+    invalidate_user,
+    serialize_claims,
+    storage_stats,
+    utcnow,
+)
 from werkzeug.datastructures import FileStorage
+from werkzeug.security import generate_password_hash
+from werkzeug.test import EnvironBuilder
+from PIL import Image as PILImage
+from concurrent.futures import wait
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from sqlalchemy import event, exc, select, text, update
+from sqlalchemy.pool import NullPool, QueuePool
+import asyncio
+import csv
+import gzip
+import hashlib
 import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 
 
 @pytest.fixture
@@ -18,9 +65,53 @@ def client():
             yield client, app
             db.session.remove()
             db.drop_all()
-            supabase.client.storage.empty_bucket(
-                app.config.get("SUPABASE_STORAGE_BUCKET")
-            )
+            storage.empty()
+
+
+def jpeg(data):
+    return b"\xff\xd8\xff" + data
+
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+@contextmanager
+def count_queries():
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+
+
+def create_claims(user, count, images_per_claim=0):
+    claims = [
+        Claim(
+            user_id=user.id,
+            policy_number=f"policy-{i}",
+            date_of_accident=datetime(2024, 3, 24, 22, 0),
+            accident_type="Car accident",
+            description="description",
+            injuries_reported=i % 2 == 0,
+            damage_details="damage",
+        )
+        for i in range(count)
+    ]
+    db.session.add_all(claims)
+    db.session.commit()
+    db.session.add_all(
+        Image(claim_id=claim.id, image_file=f"{claim.id}-{n}.jpg")
+        for claim in claims
+        for n in range(images_per_claim)
+    )
+    db.session.commit()
+    return claims
 
 
 def test_register_new_user(client):
@@ -185,7 +276,7 @@ def test_create_claim(mocker, client):
     mocker.patch("app.routes.load_user", return_value=mock_user)
 
     image_name = "none-image.jpg"
-    image_contents = b"some data"
+    image_contents = jpeg(b"some data")
     mocker.patch("flask_jwt_extended.get_jwt_identity", return_value=mock_user.email)
     access_token = create_access_token(identity=mock_user.email)
     data = {
@@ -220,9 +311,7 @@ def test_create_claim(mocker, client):
     assert claim.accident_type == data["accident_type"]
     assert claim.description == data["description"]
 
-    image = supabase.client.storage.from_(
-        app.config.get("SUPABASE_STORAGE_BUCKET")
-    ).download(image_name)
+    image = storage.download(f"{sha256(image_contents)}.jpg")
 
     assert image is not None
     assert image == image_contents
@@ -232,7 +321,7 @@ def test_create_claim_no_auth(mocker, client):
     client, app = client
     # Arrange
     image_name = "none-image.jpg"
-    image_contents = b"some data"
+    image_contents = jpeg(b"some data")
     data = {
         "policy_number": "who",
         "date_of_accident": "2024-03-24T22:00:00.000Z",
@@ -265,7 +354,7 @@ def test_create_claim_wrong_file_type(mocker, client):
     mocker.patch("app.routes.load_user", return_value=mock_user)
 
     image_name = "none-image.jpg"
-    image_contents = b"some data"
+    image_contents = jpeg(b"some data")
     mocker.patch("flask_jwt_extended.get_jwt_identity", return_value=mock_user.email)
     access_token = create_access_token(identity=mock_user.email)
     data = {
@@ -332,7 +421,7 @@ def test_create_claim_missing_property(mocker, client):
     mocker.patch("app.routes.load_user", return_value=mock_user)
 
     image_name = "none-image.jpg"
-    image_contents = b"some data"
+    image_contents = jpeg(b"some data")
     mocker.patch("flask_jwt_extended.get_jwt_identity", return_value=mock_user.email)
     access_token = create_access_token(identity=mock_user.email)
     data = {
@@ -356,3 +445,2384 @@ def test_create_claim_missing_property(mocker, client):
 
     # Assert
     assert response.status_code == 400
+
+
+def test_serialize_claims_single_query(client):
+    client, app = client
+    # Arrange
+    user = User(email="test@example.com")
+    db.session.add(user)
+    db.session.commit()
+    create_claims(user, 50, images_per_claim=2)
+    db.session.expire_all()
+    claims = Claim.query.filter_by(user_id=user.id).all()
+
+    # Act
+    with count_queries() as statements:
+        items = serialize_claims(claims)
+
+    # Assert
+    assert len(statements) == 1
+    assert len(items) == 50
+    assert all(len(item["images"]) == 2 for item in items)
+    assert all(item["author"] == user.id for item in items)
+
+
+def test_get_claims_query_count_independent_of_page_size(mocker, client):
+    client, app = client
+    # Arrange
+    user = User(email="test@example.com")
+    db.session.add(user)
+    db.session.commit()
+    create_claims(user, 30, images_per_claim=1)
+    mocker.patch("app.routes.load_user", return_value=user)
+    access_token = create_access_token(identity=user.email)
+    headers = {"Authorization": f"Bearer {access_token}"}
+
+    # Act
+    with count_queries() as small_page:
+        client.get("/api/claims?per_page=2", headers=headers)
+    with count_queries() as large_page:
+        response = client.get("/api/claims?per_page=30", headers=headers)
+
+    # Assert
+    assert response.status_code == 200
+    assert len(response.get_json()["claims"]) == 30
+    assert len(small_page) == len(large_page)
+
+
+def test_get_claims_cursor_pagination(mocker, client):
+    client, app = client
+    # Arrange
+    user = User(email="test@example.com")
+    db.session.add(user)
+    db.session.commit()
+    claims = create_claims(user, 7)
+    mocker.patch("app.routes.load_user", return_value=user)
+    access_token = create_access_token(identity=user.email)
+    headers = {"Authorization": f"Bearer {access_token}"}
+
+    # Act
+    seen = []
+    cursor = ""
+    while cursor is not None:
+        response = client.get(
+            "/api/claims",
+            query_string={"cursor": cursor, "per_page": 3},
+            headers=headers,
+        )
+        assert response.status_code == 200
+        json_data = response.get_json()
+        assert "total" not in json_data
+        seen.extend(claim["id"] for claim in json_data["claims"])
+        cursor = json_data["next_cursor"]
+
+    # Assert
+    assert seen == sorted((claim.id for claim in claims), reverse=True)
+
+
+def test_get_claims_cursor_with_total(mocker, client):
+    client, app = client
+    # Arrange
+    user = User(email="test@example.com")
+    db.session.add(user)
+    db.session.commit()
+    create_claims(user, 4)
+    mocker.patch("app.routes.load_user", return_value=user)
+    access_token = create_access_token(identity=user.email)
+    headers = {"Authorization": f"Bearer {access_token}"}
+
+    # Act
+    response = client.get(
+        "/api/claims?cursor=&per_page=2&with_total=true", headers=headers
+    )
+
+    # Assert
+    assert response.status_code == 200
+    assert response.get_json()["total"] == 4
+    assert len(response.get_json()["claims"]) == 2
+
+
+def test_get_claims_invalid_cursor(mocker, client):
+    client, app = client
+    # Arrange
+    user = User(email="test@example.com")
+    db.session.add(user)
+    db.session.commit()
+    mocker.patch("app.routes.load_user", return_value=user)
+    access_token = create_access_token(identity=user.email)
+    headers = {"Authorization": f"Bearer {access_token}"}
+
+    # Act
+    response = client.get("/api/claims?cursor=not-a-cursor", headers=headers)
+
+    # Assert
+    assert response.status_code == 400
+    assert response.get_json()["error"] == "Invalid cursor"
+
+
+def test_export_claims_ndjson(mocker, client):
+    client, app = client
+    # Arrange
+    user = User(email="test@example.com")
+    other = User(email="other@example.com")
+    db.session.add_all([user, other])
+    db.session.commit()
+    create_claims(user, 3)
+    create_claims(other, 2)
+    mocker.patch("app.routes.load_user", return_value=user)
+    access_token = create_access_token(identity=user.email)
+    headers = {"Authorization": f"Bearer {access_token}"}
+
+    # Act
+    response = client.get("/api/claims/export?format=ndjson", headers=headers)
+
+    # Assert
+    assert response.status_code == 200
+    assert response.mimetype == "application/x-ndjson"
+    rows = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert len(rows) == 3
+    assert all(row["user_id"] == user.id for row in rows)
+    assert rows[0]["date_of_accident"] == "2024-03-24T22:00:00"
+
+
+def test_export_claims_csv_admin_sees_all(mocker, client):
+    client, app = client
+    # Arrange
+    admin = User(email="admin@example.com", is_admin=True)
+    other = User(email="other@example.com")
+    db.session.add_all([admin, other])
+    db.session.commit()
+    create_claims(other, 4)
+    mocker.patch("app.routes.load_user", return_value=admin)
+    access_token = create_access_token(identity=admin.email)
+    headers = {"Authorization": f"Bearer {access_token}"}
+
+    # Act
+    response = client.get("/api/claims/export?format=csv", headers=headers)
+
+    # Assert
+    assert response.status_code == 200
+    rows = list(csv.DictReader(io.StringIO(response.get_data(as_text=True))))
+    assert len(rows) == 4
+    assert rows[0]["policy_number"] == "policy-0"
+
+
+def test_export_claims_parquet(mocker, client):
+    pq = pytest.importorskip("pyarrow.parquet")
+    client, app = client
+    # Arrange
+    user = User(email="test@example.com")
+    db.session.add(user)
+    db.session.commit()
+    create_claims(user, 5)
+    mocker.patch("app.routes.load_user", return_value=user)
+    access_token = create_access_token(identity=user.email)
+    headers = {"Authorization": f"Bearer {access_token}"}
+
+    # Act
+    response = client.get("/api/claims/export?format=parquet", headers=headers)
+
+    # Assert
+    assert response.status_code == 200
+    table = pq.read_table(io.BytesIO(response.get_data()))
+    assert table.num_rows == 5
+
+
+def test_export_claims_unsupported_format(mocker, client):
+    client, app = client
+    # Arrange
+    user = User(email="test@example.com")
+    db.session.add(user)
+    db.session.commit()
+    mocker.patch("app.routes.load_user", return_value=user)
+    access_token = create_access_token(identity=user.email)
+    headers = {"Authorization": f"Bearer {access_token}"}
+
+    # Act
+    response = client.get("/api/claims/export?format=xml", headers=headers)
+
+    # Assert
+    assert response.status_code == 400
+
+
+def test_export_claims_command(client, tmp_path):
+    client, app = client
+    # Arrange
+    user = User(email="test@example.com")
+    db.session.add(user)
+    db.session.commit()
+    create_claims(user, 3)
+    output = tmp_path / "claims.csv"
+
+    # Act
+    result = app.test_cli_runner().invoke(
+        args=["export-claims", "--format", "csv", "--batch-size", "2", "-o", output]
+    )
+
+    # Assert
+    assert result.exit_code == 0
+    assert len(output.read_text().splitlines()) == 4
+
+
+def test_whoami_uses_token_claims(client):
+    client, app = client
+    # Arrange
+    user = User(email="test@example.com")
+    user.set_password("testpassword")
+    db.session.add(user)
+    db.session.commit()
+    response = client.post(
+        "/api/auth/login",
+        json={"email": "test@example.com", "password": "testpassword"},
+    )
+    access_token = response.get_json()["access_token"]
+
+    # Act
+    with count_queries() as statements:
+        response = client.get(
+            "/api/auth/whoami", headers={"Authorization": f"Bearer {access_token}"}
+        )
+
+    # Assert
+    assert response.status_code == 200
+    assert response.get_json() == {"email": "test@example.com"}
+    assert statements == []
+
+
+def test_load_user_caches_identity(client):
+    client, app = client
+    # Arrange
+    user = User(email="test@example.com")
+    db.session.add(user)
+    db.session.commit()
+    access_token = create_access_token(identity=user.email)
+    headers = {"Authorization": f"Bearer {access_token}"}
+
+    # Act
+    with count_queries() as first:
+        client.get("/api/auth/whoami", headers=headers)
+    with count_queries() as second:
+        response = client.get("/api/auth/whoami", headers=headers)
+    invalidate_user(user.email)
+    with count_queries() as after_invalidate:
+        client.get("/api/auth/whoami", headers=headers)
+
+    # Assert
+    assert response.get_json() == {"email": "test@example.com"}
+    assert len(first) == 1
+    assert second == []
+    assert len(after_invalidate) == 1
+
+
+def test_ttl_cache_expiry_and_eviction():
+    # Arrange
+    now = [0]
+    cache = TTLCache(maxsize=2, ttl=10, timer=lambda: now[0])
+
+    # Act
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+
+    # Assert
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    now[0] = 10
+    assert cache.get("a") is None
+    assert cache.get("c") is None
+
+
+def test_memory_cache_backend_bounds_and_invalidation():
+    # Arrange
+    now = [0]
+    cache = MemoryCacheBackend(maxsize=3, max_bytes=10, ttl=10, timer=lambda: now[0])
+
+    # Act
+    cache.set(1, "a", b"1234")
+    cache.set(1, "b", b"1234")
+    cache.get(1, "a")
+    cache.set(2, "c", b"1234")
+    cache.set(2, "d", b"x" * 11)
+
+    # Assert
+    assert cache.get(1, "b") is None
+    assert cache.get(1, "a") == b"1234"
+    assert cache.stats() == {
+        "entries": 2,
+        "bytes": 8,
+        "evictions": 1,
+        "expirations": 0,
+    }
+    cache.invalidate(1)
+    assert cache.get(1, "a") is None
+    now[0] = 10
+    assert cache.get(2, "c") is None
+    assert cache.stats()["expirations"] == 1
+    assert cache.stats()["bytes"] == 0
+
+
+def test_get_claims_cached_until_claims_change(mocker, client):
+    client, app = client
+    # Arrange
+    user = User(email="test@example.com", is_admin=True)
+    db.session.add(user)
+    db.session.commit()
+    create_claims(user, 3)
+    mocker.patch("app.routes.load_user", return_value=user)
+    headers = {"Authorization": f"Bearer {create_access_token(identity=user.email)}"}
+
+    # Act
+    first = client.get("/api/claims?per_page=2", headers=headers)
+    with count_queries() as statements:
+        second = client.get("/api/claims?per_page=2", headers=headers)
+    cursor = client.get("/api/claims?cursor=", headers=headers)
+    client.post(
+        "/api/claims", data=claim_form(("a.jpg", jpeg(b"a"))), headers=headers
+    )
+    after_write = client.get("/api/claims?per_page=2", headers=headers)
+    metrics = client.get("/api/admin/metrics", headers=headers)
+
+    # Assert
+    assert second.get_json() == first.get_json()
+    assert second.headers["ETag"] == first.headers["ETag"]
+    # Only the claims version is read to check that the page is current.
+    assert len(statements) == 1
+    assert len(cursor.get_json()["claims"]) == 3
+    assert after_write.get_json()["total"] == 4
+    cache = metrics.get_json()["claims_cache"]
+    assert cache["hits"] == 1
+    assert cache["misses"] == 3
+    assert cache["hit_ratio"] == 0.25
+    # The write dropped the two pages cached before it.
+    assert cache["entries"] == 1
+    assert cache["bytes"] > 0
+
+
+def test_upload_files_runs_concurrently(mocker, client):
+    client, app = client
+    # Arrange
+    backend = mocker.patch.object(storage, "backend")
+    backend.upload.side_effect = lambda *args: time.sleep(0.2)
+    files = [
+        FileStorage(
+            stream=io.BytesIO(bytes([i])),
+            filename=f"{i}.jpg",
+            content_type="image/jpeg",
+        )
+        for i in range(4)
+    ]
+
+    # Act
+    start = time.perf_counter()
+    uploaded = upload_files(prepare_uploads(files), max_workers=4)
+    elapsed = time.perf_counter() - start
+
+    # Assert
+    assert [stored["image_file"] for stored in uploaded.values()] == [
+        f"{sha256(bytes([i]))}.jpg" for i in range(4)
+    ]
+    assert backend.upload.call_count == 4
+    assert elapsed < 0.6
+
+
+def test_upload_files_cleans_up_on_failure(mocker, client):
+    client, app = client
+    # Arrange
+    backend = mocker.patch.object(storage, "backend")
+    backend.exists.return_value = False
+    bad = f"{sha256(b'bad')}.jpg"
+
+    def upload(filename, body, options=None):
+        if filename == bad:
+            raise RuntimeError("upload failed")
+
+    backend.upload.side_effect = upload
+    files = [
+        FileStorage(
+            stream=io.BytesIO(contents), filename="image.jpg", content_type="image/jpeg"
+        )
+        for contents in [b"good", b"bad"]
+    ]
+
+    # Act
+    with pytest.raises(RuntimeError):
+        upload_files(prepare_uploads(files), max_workers=1)
+
+    # Assert
+    backend.delete.assert_called_once_with([f"{sha256(b'good')}.jpg"])
+
+
+def test_upload_files_cleanup_keeps_objects_of_other_claims(mocker, client):
+    client, app = client
+    # Arrange
+    user = User(email="test@example.com")
+    db.session.add(user)
+    db.session.commit()
+    (claim,) = create_claims(user, 1)
+    db.session.add(
+        Image(
+            claim_id=claim.id,
+            content_hash=sha256(b"referenced"),
+            image_file=f"{sha256(b'referenced')}.jpg",
+        )
+    )
+    db.session.commit()
+    backend = mocker.patch.object(storage, "backend")
+    existing = f"{sha256(b'existing')}.jpg"
+    backend.exists.side_effect = lambda path: path == existing
+
+    def upload(filename, body, options=None):
+        if filename in (existing, f"{sha256(b'bad')}.jpg"):
+            raise RuntimeError("upload failed")
+
+    backend.upload.side_effect = upload
+    files = [
+        FileStorage(
+            stream=io.BytesIO(contents), filename="image.jpg", content_type="image/jpeg"
+        )
+        for contents in [b"existing", b"referenced", b"fresh", b"bad"]
+    ]
+
+    # Act
+    with pytest.raises(RuntimeError):
+        upload_files(prepare_uploads(files), max_workers=1)
+
+    # Assert
+    backend.delete.assert_called_once_with([f"{sha256(b'fresh')}.jpg"])
+
+
+def test_upload_files_logs_failed_cleanup(mocker, client):
+    client, app = client
+    # Arrange
+    backend = mocker.patch.object(storage, "backend")
+    backend.exists.return_value = False
+    backend.upload.side_effect = [None, RuntimeError("upload failed")]
+    backend.delete.side_effect = RuntimeError("delete failed")
+    log = mocker.patch.object(app.logger, "exception")
+    files = [
+        FileStorage(
+            stream=io.BytesIO(contents), filename="image.jpg", content_type="image/jpeg"
+        )
+        for contents in [b"good", b"bad"]
+    ]
+
+    # Act
+    with pytest.raises(RuntimeError, match="upload failed"):
+        upload_files(prepare_uploads(files), max_workers=1)
+
+    # Assert
+    log.assert_called_once()
+
+
+def test_create_claim_streams_uploads_without_temp_files(mocker, client):
+    client, app = client
+    # Arrange
+    app.config["UPLOAD_SPOOL_THRESHOLD"] = 1024
+    user = User(email="test@example.com")
+    db.session.add(user)
+    db.session.commit()
+    mocker.patch("app.routes.load_user", return_value=user)
+    backend = mocker.patch.object(storage, "backend")
+    bodies = {}
+    backend.upload.side_effect = lambda filename, body, content_type: bodies.update(
+        {filename: (type(body), body if isinstance(body, bytes) else body.read())}
+    )
+    named_temporary_file = mocker.spy(tempfile, "NamedTemporaryFile")
+    access_token = create_access_token(identity=user.email)
+    data = {
+        "policy_number": "who",
+        "date_of_accident": "2024-03-24T22:00:00.000Z",
+        "accident_type": "an",
+        "description": "i",
+        "damage_details": "lol",
+        "injuries_reported": True,
+        "images[0]": FileStorage(
+            stream=io.BytesIO(jpeg(b"small")),
+            filename="small.jpg",
+            content_type="image/jpeg",
+        ),
+        "images[1]": FileStorage(
+            stream=io.BytesIO(jpeg(b"x" * 4096)),
+            filename="large.jpg",
+            content_type="image/jpeg",
+        ),
+    }
+
+    # Act
+    response = client.post(
+        "/api/claims",
+        data=data,
+        headers={"Authorization": f"Bearer {access_token}"},
+        content_type="multipart/form-data",
+    )
+
+    # Assert
+    assert response.status_code == 201
+    small = f"{sha256(jpeg(b'small'))}.jpg"
+    large = f"{sha256(jpeg(b'x' * 4096))}.jpg"
+    assert bodies[small] == (bytes, jpeg(b"small"))
+    assert bodies[large][0] is not bytes
+    assert bodies[large][1] == jpeg(b"x" * 4096)
+    # Only the part above the threshold spills to disk, and not for longer
+    # than the request.
+    assert named_temporary_file.call_count == 1
+    assert not os.path.exists(named_temporary_file.spy_return.name)
+
+
+def test_serve_image_returns_storage_urls(mocker, client):
+    client, app = client
+    # Arrange
+    user = User(email="test@example.com")
+    db.session.add(user)
+    db.session.commit()
+    claim = create_claims(user, 1, images_per_claim=2)[0]
+    mocker.patch("app.routes.load_user", return_value=user)
+    access_token = create_access_token(identity=user.email)
+
+    # Act
+    response = client.get(
+        f"/api/claims/{claim.id}", headers={"Authorization": f"Bearer {access_token}"}
+    )
+
+    # Assert
+    assert response.status_code == 200
+    assert response.get_json()["images"] == [
+        f"memory://test/{claim.id}-0.jpg",
+        f"memory://test/{claim.id}-1.jpg",
+    ]
+
+
+def test_local_storage_roundtrip(mocker, client, tmp_path):
+    client, app = client
+    # Arrange
+    local = LocalStorage(str(tmp_path), "secret")
+    previous_backend = storage.backend
+    storage.backend = local
+
+    try:
+        # Act
+        local.upload("a.jpg", b"data", "image/jpeg")
+        local.upload("b.jpg", io.BufferedReader(io.BytesIO(b"more")), "image/jpeg")
+        with app.test_request_context():
+            signed = local.signed_urls(["a.jpg"], 60)["a.jpg"]
+            expired = local.signed_urls(["a.jpg"], -1)["a.jpg"]
+        ok = client.get(signed.replace("http://localhost", ""))
+        forbidden = client.get(expired.replace("http://localhost", ""))
+        public = client.get("/uploads/a.jpg")
+        mocker.patch.object(storage, "url_mode", "signed")
+        unsigned = client.get("/uploads/a.jpg")
+        local.delete(["b.jpg"])
+
+        # Assert
+        assert local.download("a.jpg") == b"data"
+        assert ok.status_code == 200
+        assert ok.data == b"data"
+        assert forbidden.status_code == 403
+        assert public.status_code == 200
+        assert unsigned.status_code == 403
+        assert local.exists("a.jpg")
+        assert not local.exists("b.jpg")
+        with pytest.raises(ValueError):
+            local.upload("../escape.jpg", b"data")
+    finally:
+        storage.backend = previous_backend
+
+
+def claim_form(*images):
+    data = {
+        "policy_number": "who",
+        "date_of_accident": "2024-03-24T22:00:00.000Z",
+        "accident_type": "an",
+        "description": "i",
+        "damage_details": "lol",
+        "injuries_reported": True,
+    }
+    for i, (name, contents) in enumerate(images):
+        data[f"images[{i}]"] = FileStorage(
+            stream=io.BytesIO(contents), filename=name, content_type="image/jpeg"
+        )
+    return data
+
+
+def use_image_queue(app, backend):
+    app.config["IMAGE_QUEUE_BACKEND"] = backend
+    app.config["UPLOAD_CONCURRENCY"] = 1
+    image_queue.init_app(app)
+
+
+def test_create_claim_database_queue(mocker, client):
+    client, app = client
+    # Arrange
+    use_image_queue(app, "database")
+    user = User(email="test@example.com")
+    db.session.add(user)
+    db.session.commit()
+    mocker.patch("app.routes.load_user", return_value=user)
+    access_token = create_access_token(identity=user.email)
+    headers = {"Authorization": f"Bearer {access_token}"}
+
+    # Act
+    response = client.post(
+        "/api/claims",
+        data=claim_form(("a.jpg", jpeg(b"a")), ("b.jpg", jpeg(b"b"))),
+        headers=headers,
+        content_type="multipart/form-data",
+    )
+    claim_id = response.get_json()["claim_id"]
+    before = client.get(f"/api/claims/{claim_id}", headers=headers).get_json()
+    uploaded_before = storage.exists(f"{sha256(jpeg(b'a'))}.jpg")
+    result = app.test_cli_runner().invoke(args=["process-images", "--once"])
+    after = client.get(f"/api/claims/{claim_id}", headers=headers).get_json()
+
+    # Assert
+    assert response.status_code == 201
+    assert response.get_json()["status"] == "processing"
+    assert before["claim"]["status"] == "processing"
+    assert before["progress"] == {"total": 2, "done": 0, "pending": 2, "failed": 0}
+    assert not uploaded_before
+    assert result.exit_code == 0
+    assert after["claim"]["status"] == "complete"
+    assert after["progress"] == {"total": 2, "done": 2, "pending": 0, "failed": 0}
+    assert storage.download(f"{sha256(jpeg(b'a'))}.jpg") == jpeg(b"a")
+    assert storage.download(f"{sha256(jpeg(b'b'))}.jpg") == jpeg(b"b")
+    assert ImageJob.query.filter(ImageJob.payload.is_not(None)).count() == 0
+
+
+def test_image_queue_dead_letters_after_retries(mocker, client):
+    client, app = client
+    # Arrange
+    use_image_queue(app, "database")
+    app.config["IMAGE_JOB_MAX_ATTEMPTS"] = 2
+    image_queue.init_app(app)
+    user = User(email="test@example.com")
+    db.session.add(user)
+    db.session.commit()
+    mocker.patch("app.routes.load_user", return_value=user)
+    backend = mocker.patch.object(storage, "backend")
+    backend.upload.side_effect = RuntimeError("storage unavailable")
+    backend.exists.return_value = False
+    access_token = create_access_token(identity=user.email)
+    headers = {"Authorization": f"Bearer {access_token}"}
+    response = client.post(
+        "/api/claims",
+        data=claim_form(("a.jpg", jpeg(b"a"))),
+        headers=headers,
+        content_type="multipart/form-data",
+    )
+    claim_id = response.get_json()["claim_id"]
+
+    # Act
+    image_queue.work_once(10)
+    image_queue.work_once(10)
+
+    # Assert
+    job = ImageJob.query.filter_by(claim_id=claim_id).one()
+    assert job.status == "dead"
+    assert job.attempts == 2
+    assert job.last_error == "storage unavailable"
+    assert db.session.get(Claim, claim_id).status == "failed"
+
+
+def test_create_claim_thread_queue(mocker, client):
+    client, app = client
+    # Arrange
+    use_image_queue(app, "thread")
+    user = User(email="test@example.com")
+    db.session.add(user)
+    db.session.commit()
+    mocker.patch("app.routes.load_user", return_value=user)
+    submit = mocker.spy(image_queue.backend, "submit")
+    access_token = create_access_token(identity=user.email)
+
+    # Act
+    response = client.post(
+        "/api/claims",
+        data=claim_form(("a.jpg", jpeg(b"a"))),
+        headers={"Authorization": f"Bearer {access_token}"},
+        content_type="multipart/form-data",
+    )
+    wait(submit.spy_return)
+
+    # Assert
+    assert response.status_code == 201
+    claim = db.session.get(Claim, response.get_json()["claim_id"])
+    db.session.refresh(claim)
+    assert claim.status == "complete"
+    assert storage.download(f"{sha256(jpeg(b'a'))}.jpg") == jpeg(b"a")
+
+
+def test_thread_queue_resumes_jobs_of_stopped_workers(client):
+    client, app = client
+    # Arrange
+    use_image_queue(app, "thread")
+    user = User(email="test@example.com")
+    db.session.add(user)
+    db.session.commit()
+    stopped, lost, recent = create_claims(user, 3)
+    long_ago = utcnow() - timedelta(hours=1)
+    db.session.add_all(
+        [
+            ImageJob(
+                claim_id=stopped.id,
+                filename=f"{sha256(jpeg(b'a'))}.jpg",
+                content_hash=sha256(jpeg(b"a")),
+                content_type="image/jpeg",
+                payload=jpeg(b"a"),
+                run_after=long_ago,
+            ),
+            ImageJob(
+                claim_id=lost.id,
+                filename=f"{sha256(jpeg(b'b'))}.jpg",
+                content_hash=sha256(jpeg(b"b")),
+                content_type="image/jpeg",
+                run_after=long_ago,
+            ),
+            # Still queued on a running worker.
+            ImageJob(
+                claim_id=recent.id,
+                filename=f"{sha256(jpeg(b'c'))}.jpg",
+                content_hash=sha256(jpeg(b"c")),
+                content_type="image/jpeg",
+                payload=jpeg(b"c"),
+            ),
+        ]
+    )
+    db.session.commit()
+
+    # Act
+    wait(image_queue.resume())
+
+    # Assert
+    db.session.expire_all()
+    assert db.session.get(Claim, stopped.id).status == "complete"
+    assert storage.download(f"{sha256(jpeg(b'a'))}.jpg") == jpeg(b"a")
+    assert db.session.get(Claim, lost.id).status == "failed"
+    assert ImageJob.query.filter_by(claim_id=lost.id).one().last_error == (
+        "Image data was lost"
+    )
+    assert ImageJob.query.filter_by(claim_id=recent.id).one().status == "pending"
+
+
+def test_get_claims_include_urls(mocker, client):
+    client, app = client
+    # Arrange
+    user = User(email="test@example.com")
+    db.session.add(user)
+    db.session.commit()
+    create_claims(user, 3, images_per_claim=2)
+    mocker.patch("app.routes.load_user", return_value=user)
+    public_urls = mocker.spy(storage.backend, "public_urls")
+    access_token = create_access_token(identity=user.email)
+
+    # Act
+    response = client.get(
+        "/api/claims?include_urls=true",
+        headers={"Authorization": f"Bearer {access_token}"},
+    )
+
+    # Assert
+    assert response.status_code == 200
+    images = [i for c in response.get_json()["claims"] for i in c["images"]]
+    assert len(images) == 6
+    assert all(i["url"] == f"memory://test/{i['image_file']}" for i in images)
+    assert public_urls.call_count == 1
+
+
+def test_signed_image_urls_are_cached(mocker, client):
+    client, app = client
+    # Arrange
+    app.config["IMAGE_URL_MODE"] = "signed"
+    app.config["SIGNED_URL_EXPIRES_IN"] = 100
+    storage.init_app(app)
+    signed_urls = mocker.spy(storage.backend, "signed_urls")
+    now = [0]
+    mocker.patch.object(storage.url_cache, "timer", lambda: now[0])
+
+    # Act
+    first = storage.image_urls(["a.jpg", "b.jpg"])
+    second = storage.image_urls(["a.jpg", "b.jpg", "c.jpg"])
+    now[0] = 90
+    third = storage.image_urls(["a.jpg"])
+
+    # Assert
+    assert first == {
+        "a.jpg": "memory://test/a.jpg?expires_in=100",
+        "b.jpg": "memory://test/b.jpg?expires_in=100",
+    }
+    assert second["c.jpg"] == "memory://test/c.jpg?expires_in=100"
+    assert third == {"a.jpg": "memory://test/a.jpg?expires_in=100"}
+    assert [call.args[0] for call in signed_urls.call_args_list] == [
+        ["a.jpg", "b.jpg"],
+        ["c.jpg"],
+        ["a.jpg"],
+    ]
+
+
+def jpeg_bytes(width, height, orientation=None):
+    image = PILImage.new("RGB", (width, height), "red")
+    exif = PILImage.Exif()
+    exif[0x010F] = "Phone maker"
+    if orientation is not None:
+        exif[0x0112] = orientation
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", exif=exif)
+    return buffer.getvalue()
+
+
+def test_create_claim_stores_derivatives(mocker, client):
+    client, app = client
+    # Arrange
+    user = User(email="test@example.com")
+    db.session.add(user)
+    db.session.commit()
+    mocker.patch("app.routes.load_user", return_value=user)
+    access_token = create_access_token(identity=user.email)
+    headers = {"Authorization": f"Bearer {access_token}"}
+    photo = jpeg_bytes(3000, 2000, orientation=6)
+
+    # Act
+    response = client.post(
+        "/api/claims",
+        data=claim_form(("photo.jpg", photo)),
+        headers=headers,
+        content_type="multipart/form-data",
+    )
+    claim_id = response.get_json()["claim_id"]
+    detail = client.get(f"/api/claims/{claim_id}", headers=headers).get_json()
+
+    # Assert
+    digest = sha256(photo)
+    image = detail["claim"]["images"][0]
+    assert image["thumbnail_file"] == f"{digest}.thumb.webp"
+    assert image["display_file"] == f"{digest}.display.webp"
+    assert image["thumbnail_url"] == f"memory://test/{digest}.thumb.webp"
+    assert detail["images"] == [f"memory://test/{digest}.jpg"]
+    thumbnail = PILImage.open(io.BytesIO(storage.download(f"{digest}.thumb.webp")))
+    display = PILImage.open(io.BytesIO(storage.download(f"{digest}.display.webp")))
+    assert thumbnail.size == (213, 320)
+    assert display.size == (1067, 1600)
+    assert not display.getexif()
+    assert len(storage.download(f"{digest}.display.webp")) < len(photo)
+
+
+def test_create_claim_renders_spooled_uploads_from_disk(mocker, client):
+    client, app = client
+    # Arrange
+    app.config["UPLOAD_SPOOL_THRESHOLD"] = 1024
+    user = User(email="test@example.com")
+    db.session.add(user)
+    db.session.commit()
+    mocker.patch("app.routes.load_user", return_value=user)
+    headers = {"Authorization": f"Bearer {create_access_token(identity=user.email)}"}
+    rendering = mocker.patch(
+        "app.uploads.render_derivatives_async", wraps=render_derivatives_async
+    )
+    photo = jpeg_bytes(800, 600)
+
+    # Act
+    response = client.post(
+        "/api/claims", data=claim_form(("photo.jpg", photo)), headers=headers
+    )
+
+    # Assert
+    assert response.status_code == 201
+    config, source = rendering.call_args.args
+    assert isinstance(source, str)
+    assert Image.query.one().display_file == f"{sha256(photo)}.display.webp"
+
+
+def test_create_claim_stores_decompression_bomb_without_derivatives(mocker, client):
+    client, app = client
+    # Arrange
+    user = User(email="test@example.com")
+    db.session.add(user)
+    db.session.commit()
+    mocker.patch("app.routes.load_user", return_value=user)
+    headers = {"Authorization": f"Bearer {create_access_token(identity=user.email)}"}
+    buffer = io.BytesIO()
+    PILImage.new("1", (20000, 10000)).save(buffer, format="PNG")
+    bomb = buffer.getvalue()
+
+    # Act
+    response = client.post(
+        "/api/claims", data=claim_form(("bomb.png", bomb)), headers=headers
+    )
+
+    # Assert
+    assert response.status_code == 201
+    image = Image.query.one()
+    assert image.image_file == f"{sha256(bomb)}.png"
+    assert image.thumbnail_file is None
+    assert storage.download(image.image_file) == bomb
+
+
+def test_render_derivatives_limits_decoded_pixels():
+    # Arrange
+    photo = jpeg_bytes(4000, 3000)
+
+    # Act
+    # A JPEG is decoded at the smallest scale that still covers the display
+    # size, 2000x1500 here.
+    drafted = render_derivatives(photo, 320, 1600, "WEBP", 80, 3_000_000)
+    too_large = render_derivatives(photo, 320, 1600, "WEBP", 80, 2_999_999)
+
+    # Assert
+    assert PILImage.open(io.BytesIO(drafted["display"])).size == (1600, 1200)
+    assert too_large is None
+
+
+def test_render_derivatives_in_process_pool(client):
+    client, app = client
+    # Arrange
+    app.config["IMAGE_DERIVATIVE_WORKERS"] = 1
+
+    # Act
+    rendered = render_derivatives_async(app.config, jpeg_bytes(800, 600)).result()
+    unreadable = render_derivatives_async(app.config, b"not an image").result()
+
+    # Assert
+    assert PILImage.open(io.BytesIO(rendered["thumbnail"])).size == (320, 240)
+    assert PILImage.open(io.BytesIO(rendered["display"])).size == (800, 600)
+    assert unreadable is None
+
+
+def test_create_claim_deduplicates_images(mocker, client):
+    client, app = client
+    # Arrange
+    user = User(email="test@example.com")
+    other = User(email="other@example.com")
+    db.session.add_all([user, other])
+    db.session.commit()
+    mocker.patch("app.routes.load_user", return_value=user)
+    upload = mocker.spy(storage.backend, "upload")
+    access_token = create_access_token(identity=user.email)
+    headers = {"Authorization": f"Bearer {access_token}"}
+
+    # Act
+    first = client.post(
+        "/api/claims",
+        data=claim_form(
+            ("IMG_0001.jpg", jpeg(b"photo")), ("copy.jpg", jpeg(b"photo"))
+        ),
+        headers=headers,
+        content_type="multipart/form-data",
+    )
+    second = client.post(
+        "/api/claims",
+        data=claim_form(
+            ("IMG_0001.jpg", jpeg(b"photo")), ("IMG_0002.jpg", jpeg(b"other"))
+        ),
+        headers=headers,
+        content_type="multipart/form-data",
+    )
+    mocker.patch("app.routes.load_user", return_value=other)
+    other_user = client.post(
+        "/api/claims",
+        data=claim_form(("IMG_0001.jpg", jpeg(b"photo"))),
+        headers=headers,
+        content_type="multipart/form-data",
+    )
+    result = app.test_cli_runner().invoke(args=["storage-stats"])
+
+    # Assert
+    assert first.get_json()["deduplicated"] == 0
+    assert second.get_json()["deduplicated"] == 1
+    assert second.get_json()["bytes_saved"] == 8
+    # Content another user uploaded is reused without telling the caller.
+    assert other_user.get_json()["deduplicated"] == 0
+    assert other_user.get_json()["bytes_saved"] == 0
+    assert [call.args[0] for call in upload.call_args_list] == [
+        f"{sha256(jpeg(b'photo'))}.jpg",
+        f"{sha256(jpeg(b'other'))}.jpg",
+    ]
+    assert Image.query.filter_by(content_hash=sha256(jpeg(b"photo"))).count() == 4
+    assert storage_stats() == {
+        "images": 5,
+        "objects": 2,
+        "referenced_bytes": 40,
+        "stored_bytes": 16,
+        "saved_bytes": 24,
+    }
+    assert "saved_bytes: 24" in result.output
+
+
+class CountingStream(io.BytesIO):
+    def __init__(self, data):
+        super().__init__(data)
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        chunk = super().read(size)
+        self.bytes_read += len(chunk)
+        return chunk
+
+    def readline(self, size=-1):
+        line = super().readline(size)
+        self.bytes_read += len(line)
+        return line
+
+
+def multipart_request(data):
+    environ = EnvironBuilder(
+        data=data, content_type="multipart/form-data"
+    ).get_environ()
+    body = environ["wsgi.input"].read()
+    return CountingStream(body), environ["CONTENT_TYPE"], len(body)
+
+
+def test_create_claim_rejects_large_file_while_streaming(mocker, client):
+    client, app = client
+    # Arrange
+    app.config["MAX_UPLOAD_FILE_SIZE"] = 64 * 1024
+    user = User(email="test@example.com")
+    db.session.add(user)
+    db.session.commit()
+    mocker.patch("app.routes.load_user", return_value=user)
+    upload = mocker.spy(storage.backend, "upload")
+    headers = {"Authorization": f"Bearer {create_access_token(identity=user.email)}"}
+    stream, content_type, content_length = multipart_request(
+        claim_form(("big.jpg", jpeg(b"x" * 8 * 1024 * 1024)))
+    )
+
+    # Act
+    response = client.post(
+        "/api/claims",
+        input_stream=stream,
+        headers=headers,
+        content_type=content_type,
+        content_length=content_length,
+    )
+
+    # Assert
+    assert response.status_code == 413
+    assert response.get_json()["error"] == "File too large"
+    assert stream.bytes_read < 256 * 1024
+    assert upload.call_count == 0
+    assert Claim.query.count() == 0
+
+
+def test_create_claim_rejects_content_that_is_not_an_image(mocker, client):
+    client, app = client
+    # Arrange
+    user = User(email="test@example.com")
+    db.session.add(user)
+    db.session.commit()
+    mocker.patch("app.routes.load_user", return_value=user)
+    headers = {"Authorization": f"Bearer {create_access_token(identity=user.email)}"}
+
+    # Act
+    response = client.post(
+        "/api/claims",
+        data=claim_form(("photo.jpg", b"GIF89a" + b"\x00" * 1024)),
+        headers=headers,
+        content_type="multipart/form-data",
+    )
+
+    # Assert
+    assert response.status_code == 400
+    assert response.get_json()["error"] == "File type not allowed"
+    assert Claim.query.count() == 0
+
+
+def test_create_claim_rejects_too_many_files(mocker, client):
+    client, app = client
+    # Arrange
+    app.config["MAX_UPLOAD_FILES"] = 2
+    user = User(email="test@example.com")
+    db.session.add(user)
+    db.session.commit()
+    mocker.patch("app.routes.load_user", return_value=user)
+    headers = {"Authorization": f"Bearer {create_access_token(identity=user.email)}"}
+
+    # Act
+    response = client.post(
+        "/api/claims",
+        data=claim_form(*[(f"{i}.jpg", jpeg(bytes([i]))) for i in range(3)]),
+        headers=headers,
+        content_type="multipart/form-data",
+    )
+
+    # Assert
+    assert response.status_code == 400
+    assert response.get_json()["error"] == "Too many files"
+
+
+def test_create_claim_rejects_oversized_request(mocker, client):
+    client, app = client
+    # Arrange
+    app.config["MAX_CONTENT_LENGTH"] = 1024
+    user = User(email="test@example.com")
+    db.session.add(user)
+    db.session.commit()
+    mocker.patch("app.routes.load_user", return_value=user)
+    headers = {"Authorization": f"Bearer {create_access_token(identity=user.email)}"}
+
+    # Act
+    response = client.post(
+        "/api/claims",
+        data=claim_form(("photo.jpg", jpeg(b"x" * 4096))),
+        headers=headers,
+        content_type="multipart/form-data",
+    )
+
+    # Assert
+    assert response.status_code == 413
+    assert "error" in response.get_json()
+
+
+def claim_row(**overrides):
+    return {
+        "policy_number": "policy",
+        "date_of_accident": "2024-03-24T22:00:00.000Z",
+        "accident_type": "Car accident",
+        "description": "description",
+        "injuries_reported": False,
+        "damage_details": "damage",
+        **overrides,
+    }
+
+
+def test_bulk_create_claims_ndjson_reports_row_errors(mocker, client):
+    client, app = client
+    # Arrange
+    app.config["INGEST_CHUNK_SIZE"] = 2
+    user = User(email="test@example.com")
+    db.session.add(user)
+    db.session.commit()
+    mocker.patch("app.routes.load_user", return_value=user)
+    headers = {"Authorization": f"Bearer {create_access_token(identity=user.email)}"}
+    lines = [
+        json.dumps(claim_row(policy_number="p1")),
+        json.dumps(claim_row(policy_number="p2", date_of_accident="yesterday")),
+        "{not json",
+        "",
+        json.dumps(claim_row(policy_number="x" * 65)),
+        json.dumps(claim_row(policy_number="p5", injuries_reported="yes")),
+    ]
+
+    # Act
+    with count_queries() as statements:
+        response = client.post(
+            "/api/claims/bulk",
+            data="\n".join(lines),
+            headers=headers,
+            content_type="application/x-ndjson",
+        )
+
+    # Assert
+    report = response.get_json()
+    assert response.status_code == 200
+    assert report["inserted"] == 2
+    assert report["failed"] == 3
+    assert [error["row"] for error in report["errors"]] == [2, 3, 5]
+    assert report["errors"][0]["errors"][0]["loc"] == ["date_of_accident"]
+    assert report["errors"][2]["errors"][0]["loc"] == ["policy_number"]
+    assert [c.policy_number for c in Claim.query.order_by(Claim.id)] == ["p1", "p5"]
+    assert Claim.query.filter_by(user_id=user.id).count() == 2
+    assert len([s for s in statements if s.startswith("INSERT INTO claim ")]) == 2
+
+
+def test_bulk_create_claims_csv(mocker, client):
+    client, app = client
+    # Arrange
+    user = User(email="test@example.com")
+    db.session.add(user)
+    db.session.commit()
+    mocker.patch("app.routes.load_user", return_value=user)
+    headers = {"Authorization": f"Bearer {create_access_token(identity=user.email)}"}
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=list(claim_row()))
+    writer.writeheader()
+    writer.writerows(
+        claim_row(policy_number=f"p{i}", injuries_reported=str(i % 2 == 0).lower())
+        for i in range(3)
+    )
+    writer.writerow(claim_row(injuries_reported="maybe"))
+
+    # Act
+    response = client.post(
+        "/api/claims/bulk",
+        data=buffer.getvalue(),
+        headers=headers,
+        content_type="text/csv",
+    )
+    unsupported = client.post("/api/claims/bulk?format=xml", data="", headers=headers)
+
+    # Assert
+    report = response.get_json()
+    assert response.status_code == 200
+    assert report["inserted"] == 3
+    assert report["errors"][0]["row"] == 5
+    assert report["errors"][0]["errors"][0]["loc"] == ["injuries_reported"]
+    assert Claim.query.filter_by(injuries_reported=True).count() == 2
+    assert unsupported.status_code == 400
+
+
+def test_bulk_create_claims_rejects_unknown_user(mocker, client):
+    client, app = client
+    # Arrange
+    admin = User(email="admin@example.com", is_admin=True)
+    db.session.add(admin)
+    db.session.commit()
+    mocker.patch("app.routes.load_user", return_value=admin)
+    headers = {"Authorization": f"Bearer {create_access_token(identity=admin.email)}"}
+
+    # Act
+    response = client.post(
+        "/api/claims/bulk?user_id=999",
+        data=json.dumps(claim_row()),
+        headers=headers,
+        content_type="application/x-ndjson",
+    )
+
+    # Assert
+    assert response.status_code == 400
+    assert Claim.query.count() == 0
+    assert ClaimStat.query.count() == 0
+
+
+def test_import_claims_command(client, tmp_path):
+    client, app = client
+    # Arrange
+    user = User(email="test@example.com")
+    db.session.add(user)
+    db.session.commit()
+    path = tmp_path / "claims.ndjson"
+    path.write_text(
+        "\n".join(
+            [json.dumps(claim_row(policy_number=f"p{i}")) for i in range(5)]
+            + [json.dumps(claim_row(description=None))]
+        )
+    )
+
+    # Act
+    result = app.test_cli_runner().invoke(
+        args=[
+            "import-claims",
+            str(path),
+            "--user",
+            user.email,
+            "--chunk-size",
+            "2",
+        ]
+    )
+
+    # Assert
+    assert result.exit_code == 0, result.output
+    assert "Inserted 5 claims, 1 failed" in result.output
+    assert '"row": 6' in result.output
+    assert Claim.query.filter_by(user_id=user.id).count() == 5
+
+
+def test_search_claims_ranked_and_paginated(mocker, client):
+    client, app = client
+    # Arrange
+    user = User(email="test@example.com")
+    other = User(email="other@example.com")
+    db.session.add_all([user, other])
+    db.session.commit()
+    mocker.patch("app.routes.load_user", return_value=user)
+    headers = {"Authorization": f"Bearer {create_access_token(identity=user.email)}"}
+    claims = create_claims(user, 4)
+    claims[0].description = "Rear bumper dented in parking lot"
+    claims[1].description = "Bumper scratched, bumper cover cracked"
+    claims[2].damage_details = "Cracked windshield"
+    claims[3].description = "Flooded engine"
+    create_claims(other, 1)[0].description = "Bumper fell off"
+    db.session.commit()
+
+    # Act
+    first = client.get("/api/claims/search?q=bumpers&per_page=1", headers=headers)
+    second = client.get(
+        "/api/claims/search?q=bumpers&per_page=1&page=2", headers=headers
+    )
+    cracked = client.get('/api/claims/search?q="cracked*', headers=headers)
+    missing = client.get("/api/claims/search?q=", headers=headers)
+
+    # Assert
+    assert first.status_code == 200
+    assert first.get_json()["total"] == 2
+    assert first.get_json()["pages"] == 2
+    assert [c["id"] for c in first.get_json()["claims"]] == [claims[1].id]
+    assert [c["id"] for c in second.get_json()["claims"]] == [claims[0].id]
+    assert sorted(c["id"] for c in cracked.get_json()["claims"]) == [
+        claims[1].id,
+        claims[2].id,
+    ]
+    assert missing.status_code == 400
+
+
+def test_get_claims_filter_and_sort(mocker, client):
+    client, app = client
+    # Arrange
+    user = User(email="test@example.com")
+    db.session.add(user)
+    db.session.commit()
+    mocker.patch("app.routes.load_user", return_value=user)
+    headers = {"Authorization": f"Bearer {create_access_token(identity=user.email)}"}
+    claims = create_claims(user, 6)
+    for i, claim in enumerate(claims):
+        claim.date_of_accident = datetime(2024, 1, 1 + i)
+        claim.accident_type = "Hail" if i < 3 else "Car accident"
+    # A date-only date_to covers the whole day.
+    claims[4].date_of_accident = datetime(2024, 1, 5, 15, 30)
+    db.session.commit()
+
+    # Act
+    hail = client.get(
+        "/api/claims?accident_type=Hail&sort=date_of_accident", headers=headers
+    )
+    ranged = client.get(
+        "/api/claims?date_from=2024-01-02T00:00:00Z&date_to=2024-01-05"
+        "&injuries_reported=true&sort=-date_of_accident",
+        headers=headers,
+    )
+    policy = client.get("/api/claims?policy_number=policy-5", headers=headers)
+    cursor = client.get(
+        "/api/claims?cursor=&per_page=2&accident_type=Car accident", headers=headers
+    )
+    until_noon = client.get(
+        "/api/claims?date_to=2024-01-05T12:00:00Z&date_from=2024-01-05",
+        headers=headers,
+    )
+    bad_sort = client.get("/api/claims?sort=description", headers=headers)
+    bad_date = client.get("/api/claims?date_from=yesterday", headers=headers)
+    bad_cursor_sort = client.get(
+        "/api/claims?cursor=&sort=policy_number", headers=headers
+    )
+
+    # Assert
+    def ids(response):
+        return [c["id"] for c in response.get_json()["claims"]]
+
+    assert ids(hail) == [claims[0].id, claims[1].id, claims[2].id]
+    assert ids(ranged) == [claims[4].id, claims[2].id]
+    assert ids(until_noon) == []
+    assert ids(policy) == [claims[5].id]
+    assert ids(cursor) == [claims[5].id, claims[4].id]
+    assert cursor.get_json()["next_cursor"] is not None
+    assert bad_sort.status_code == 400
+    assert bad_date.status_code == 400
+    assert bad_cursor_sort.status_code == 400
+
+
+def test_claim_filters_use_composite_indexes(client):
+    client, app = client
+    # Act
+    plans = {
+        column: " ".join(
+            str(row)
+            for row in db.session.execute(
+                text(
+                    "EXPLAIN QUERY PLAN SELECT * FROM claim "
+                    f"WHERE user_id = 1 AND {column} >= 'a' ORDER BY {column}"
+                )
+            )
+        )
+        for column in ("date_of_accident", "accident_type", "policy_number")
+    }
+
+    # Assert
+    for column, plan in plans.items():
+        assert f"ix_claim_user_id_{column}" in plan
+        assert "TEMP B-TREE" not in plan
+
+
+def test_get_claims_conditional_requests(mocker, client):
+    client, app = client
+    # Arrange
+    user = User(email="test@example.com")
+    db.session.add(user)
+    db.session.commit()
+    mocker.patch("app.routes.load_user", return_value=user)
+    headers = {"Authorization": f"Bearer {create_access_token(identity=user.email)}"}
+    client.post(
+        "/api/claims",
+        data=claim_form(("a.jpg", jpeg(b"a"))),
+        headers=headers,
+        content_type="multipart/form-data",
+    )
+    first = client.get("/api/claims", headers=headers)
+    etag = first.headers["ETag"]
+
+    # Act
+    with count_queries() as statements:
+        unchanged = client.get(
+            "/api/claims", headers={**headers, "If-None-Match": etag}
+        )
+    other_page = client.get(
+        "/api/claims?page=2", headers={**headers, "If-None-Match": etag}
+    )
+    since = client.get(
+        "/api/claims",
+        headers={**headers, "If-Modified-Since": first.headers["Last-Modified"]},
+    )
+    client.post(
+        "/api/claims",
+        data=claim_form(("b.jpg", jpeg(b"b"))),
+        headers=headers,
+        content_type="multipart/form-data",
+    )
+    changed = client.get("/api/claims", headers={**headers, "If-None-Match": etag})
+
+    # Assert
+    assert first.status_code == 200
+    assert "Last-Modified" in first.headers
+    assert "no-cache" in first.headers["Cache-Control"]
+    assert unchanged.status_code == 304
+    assert unchanged.data == b""
+    assert unchanged.headers["ETag"] == etag
+    assert len(statements) == 1
+    assert other_page.status_code == 200
+    assert since.status_code == 304
+    assert changed.status_code == 200
+    assert changed.headers["ETag"] != etag
+    assert len(changed.get_json()["claims"]) == 2
+
+
+def test_get_claim_conditional_requests(mocker, client):
+    client, app = client
+    # Arrange
+    user = User(email="test@example.com")
+    db.session.add(user)
+    db.session.commit()
+    mocker.patch("app.routes.load_user", return_value=user)
+    headers = {"Authorization": f"Bearer {create_access_token(identity=user.email)}"}
+    claim = create_claims(user, 1)[0]
+    first = client.get(f"/api/claims/{claim.id}", headers=headers)
+
+    # Act
+    unchanged = client.get(
+        f"/api/claims/{claim.id}",
+        headers={**headers, "If-None-Match": first.headers["ETag"]},
+    )
+    mocker.patch.object(storage, "url_mode", "signed")
+    signed = client.get(f"/api/claims/{claim.id}", headers=headers)
+
+    # Assert
+    assert first.status_code == 200
+    assert unchanged.status_code == 304
+    assert signed.status_code == 200
+    assert "ETag" not in signed.headers
+
+
+def test_json_providers_write_identical_utc_datetimes(client):
+    pytest.importorskip("orjson")
+    client, app = client
+    # Arrange
+    user = User(email="test@example.com")
+    db.session.add(user)
+    db.session.commit()
+    payload = {"claims": serialize_claims(create_claims(user, 3))}
+
+    # Act
+    stdlib = JSONProvider(app).dumps(payload, separators=(",", ":"))
+    fast = OrjsonProvider(app).dumps(payload)
+    response = OrjsonProvider(app).response(payload)
+
+    # Assert
+    assert fast == stdlib
+    assert json.loads(fast)["claims"][0]["date_of_accident"] == (
+        "2024-03-24T22:00:00+00:00"
+    )
+    assert response.get_data(as_text=True) == stdlib
+
+
+def test_get_claims_compressed(mocker, client):
+    client, app = client
+    # Arrange
+    user = User(email="test@example.com")
+    db.session.add(user)
+    db.session.commit()
+    mocker.patch("app.routes.load_user", return_value=user)
+    headers = {"Authorization": f"Bearer {create_access_token(identity=user.email)}"}
+    create_claims(user, 50)
+
+    # Act
+    plain = client.get("/api/claims?per_page=50", headers=headers)
+    gzipped = client.get(
+        "/api/claims?per_page=50", headers={**headers, "Accept-Encoding": "gzip"}
+    )
+    small = client.get(
+        "/api/claims?per_page=50&page=9",
+        headers={**headers, "Accept-Encoding": "gzip"},
+    )
+    revalidated = client.get(
+        "/api/claims?per_page=50",
+        headers={
+            **headers,
+            "Accept-Encoding": "gzip",
+            "If-None-Match": gzipped.headers["ETag"],
+        },
+    )
+
+    # Assert
+    assert "Content-Encoding" not in plain.headers
+    assert gzipped.headers["Content-Encoding"] == "gzip"
+    assert gzipped.headers["Vary"] == "Accept-Encoding"
+    assert len(gzipped.data) < len(plain.data) / 4
+    assert gzip.decompress(gzipped.data) == plain.data
+    assert gzipped.headers["ETag"] == plain.headers["ETag"][:-1] + '-gzip"'
+    assert "Content-Encoding" not in small.headers
+    assert revalidated.status_code == 304
+    assert revalidated.headers["ETag"] == gzipped.headers["ETag"]
+
+
+def test_get_claims_brotli(mocker, client):
+    brotli = pytest.importorskip("brotli")
+    client, app = client
+    # Arrange
+    user = User(email="test@example.com")
+    db.session.add(user)
+    db.session.commit()
+    mocker.patch("app.routes.load_user", return_value=user)
+    headers = {"Authorization": f"Bearer {create_access_token(identity=user.email)}"}
+    create_claims(user, 50)
+
+    # Act
+    response = client.get(
+        "/api/claims?per_page=50",
+        headers={**headers, "Accept-Encoding": "gzip, deflate, br"},
+    )
+
+    # Assert
+    assert response.headers["Content-Encoding"] == "br"
+    assert json.loads(brotli.decompress(response.data))["total"] == 50
+
+
+def test_claim_stats_maintained_on_create(mocker, client):
+    client, app = client
+    # Arrange
+    user = User(email="test@example.com")
+    admin = User(email="admin@example.com", is_admin=True)
+    db.session.add_all([user, admin])
+    db.session.commit()
+    load_user = mocker.patch("app.routes.load_user", return_value=user)
+    headers = {"Authorization": f"Bearer {create_access_token(identity=user.email)}"}
+    for accident_type, date_of_accident, injuries in [
+        ("Hail", "2024-03-24T22:00:00.000Z", "true"),
+        ("Hail", "2024-03-02T10:00:00.000Z", "false"),
+        ("Car accident", "2024-04-01T08:00:00.000Z", "true"),
+    ]:
+        data = claim_form(("a.jpg", jpeg(b"a")))
+        data.update(
+            accident_type=accident_type,
+            date_of_accident=date_of_accident,
+            injuries_reported=injuries,
+        )
+        client.post(
+            "/api/claims",
+            data=data,
+            headers=headers,
+            content_type="multipart/form-data",
+        )
+    client.post(
+        "/api/claims/bulk",
+        data=json.dumps(claim_row(accident_type="Hail", injuries_reported=False)),
+        headers=headers,
+        content_type="application/x-ndjson",
+    )
+
+    # Act
+    db.session.refresh(user)
+    with count_queries() as statements:
+        response = client.get("/api/claims/stats", headers=headers)
+    load_user.return_value = admin
+    overall = client.get("/api/claims/stats", headers=headers)
+    other = client.get(f"/api/claims/stats?user_id={admin.id}", headers=headers)
+
+    # Assert
+    assert response.get_json() == {
+        "total": 4,
+        "injuries": 2,
+        "injury_rate": 0.5,
+        "by_accident_type": {"Car accident": 1, "Hail": 3},
+        "by_month": {"2024-03": 3, "2024-04": 1},
+    }
+    assert len(statements) == 1
+    assert "FROM claim_stat" in statements[0]
+    assert overall.get_json()["total"] == 4
+    assert other.get_json()["total"] == 0
+    assert other.get_json()["injury_rate"] == 0.0
+
+
+def test_claims_with_an_offset_are_stored_in_utc(mocker, client):
+    client, app = client
+    # Arrange
+    user = User(email="test@example.com")
+    db.session.add(user)
+    db.session.commit()
+    mocker.patch("app.routes.load_user", return_value=user)
+    headers = {"Authorization": f"Bearer {create_access_token(identity=user.email)}"}
+    data = claim_form(("a.jpg", jpeg(b"a")))
+    data["date_of_accident"] = "2024-03-31T23:30:00-05:00"
+
+    # Act
+    created = client.post("/api/claims", data=data, headers=headers)
+    imported = client.post(
+        "/api/claims/bulk",
+        data=json.dumps(claim_row(date_of_accident="2024-03-31T23:30:00-05:00")),
+        headers=headers,
+        content_type="application/x-ndjson",
+    )
+    incremental = claim_stats(user.id)
+    app.test_cli_runner().invoke(args=["rebuild-claim-stats"])
+    listed = client.get("/api/claims?date_from=2024-04-01", headers=headers)
+
+    # Assert
+    assert created.status_code == 201
+    assert imported.get_json()["inserted"] == 1
+    assert [claim.date_of_accident for claim in Claim.query] == [
+        datetime(2024, 4, 1, 4, 30)
+    ] * 2
+    assert incremental["by_month"] == {"2024-04": 2}
+    assert claim_stats(user.id)["by_month"] == {"2024-04": 2}
+    assert [claim["date_of_accident"] for claim in listed.get_json()["claims"]] == [
+        "2024-04-01T04:30:00+00:00"
+    ] * 2
+
+
+def test_rebuild_claim_stats_command(client):
+    client, app = client
+    # Arrange
+    user = User(email="test@example.com")
+    db.session.add(user)
+    db.session.commit()
+    create_claims(user, 5)
+
+    # Act
+    result = app.test_cli_runner().invoke(args=["rebuild-claim-stats"])
+
+    # Assert
+    assert "Rebuilt 1 claim stat buckets" in result.output
+    assert claim_stats(user.id) == {
+        "total": 5,
+        "injuries": 3,
+        "injury_rate": 0.6,
+        "by_accident_type": {"Car accident": 5},
+        "by_month": {"2024-03": 5},
+    }
+
+
+def test_login_rehashes_outdated_password_hash(client):
+    client, app = client
+    # Arrange
+    user = User(
+        email="test@example.com",
+        password_hash=generate_password_hash("secret", "pbkdf2:sha256:500"),
+    )
+    db.session.add(user)
+    db.session.commit()
+    credentials = {"email": user.email, "password": "secret"}
+
+    # Act
+    first = client.post("/api/auth/login", json=credentials)
+    rehashed = user.password_hash
+    second = client.post("/api/auth/login", json=credentials)
+
+    # Assert
+    assert first.status_code == 200
+    assert rehashed.startswith("pbkdf2:sha256:1000$")
+    assert second.status_code == 200
+    assert user.password_hash == rehashed
+
+
+def test_login_rejected_when_password_hasher_busy(mocker, client):
+    client, app = client
+    # Arrange
+    client.post(
+        "/api/auth/register", json={"email": "test@example.com", "password": "x"}
+    )
+    mocker.patch.object(passwords, "slots", threading.BoundedSemaphore(1))
+    mocker.patch.object(passwords, "wait_timeout", 0)
+    passwords.slots.acquire()
+
+    # Act
+    response = client.post(
+        "/api/auth/login", json={"email": "test@example.com", "password": "x"}
+    )
+
+    # Assert
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+    assert "error" in response.get_json()
+
+
+def test_create_claim_idempotency_key_replays_response(mocker, client):
+    client, app = client
+    # Arrange
+    user = User(email="test@example.com")
+    db.session.add(user)
+    db.session.commit()
+    mocker.patch("app.routes.load_user", return_value=user)
+    upload = mocker.spy(storage.backend, "upload")
+    token = create_access_token(identity=user.email)
+    headers = {"Authorization": f"Bearer {token}", "Idempotency-Key": "abc"}
+
+    def post(policy_number="who", **extra_headers):
+        data = claim_form(("a.jpg", jpeg(b"a")))
+        data["policy_number"] = policy_number
+        return client.post(
+            "/api/claims", data=data, headers={**headers, **extra_headers}
+        )
+
+    # Act
+    first = post()
+    retry = post()
+    reused = post(policy_number="other")
+    other = post(**{"Idempotency-Key": "def"})
+
+    # Assert
+    assert first.status_code == 201
+    assert retry.status_code == 201
+    assert retry.get_json() == first.get_json()
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert reused.status_code == 422
+    assert other.status_code == 201
+    assert other.get_json()["claim_id"] != first.get_json()["claim_id"]
+    assert Claim.query.count() == 2
+    assert upload.call_count == 1
+
+
+def test_create_claim_idempotency_key_waits_for_in_flight_request(mocker, client):
+    client, app = client
+    # Arrange
+    user = User(email="test@example.com")
+    db.session.add(user)
+    db.session.commit()
+    mocker.patch("app.routes.load_user", return_value=user)
+    mocker.patch("app.idempotency.request_fingerprint", return_value="fp")
+    now = utcnow()
+    db.session.add(
+        IdempotencyKey(
+            user_id=user.id,
+            key="abc",
+            fingerprint="fp",
+            locked_at=now,
+            expires_at=now + timedelta(days=1),
+        )
+    )
+    db.session.commit()
+    token = create_access_token(identity=user.email)
+    headers = {"Authorization": f"Bearer {token}", "Idempotency-Key": "abc"}
+
+    def finish_first_request(seconds):
+        finish_key(db.session, user.id, "abc", 201, b'{"claim_id": 7}')
+
+    sleep = mocker.patch("app.idempotency.time.sleep", side_effect=finish_first_request)
+
+    # Act
+    joined = client.post("/api/claims", data=claim_form(), headers=headers)
+    db.session.execute(update(IdempotencyKey).values(status_code=None, response=None))
+    db.session.commit()
+    app.config["IDEMPOTENCY_WAIT_TIMEOUT"] = 0
+    busy = client.post("/api/claims", data=claim_form(), headers=headers)
+
+    # Assert
+    assert sleep.call_count == 1
+    assert joined.status_code == 201
+    assert joined.get_json() == {"claim_id": 7}
+    assert busy.status_code == 409
+    assert busy.headers["Retry-After"] == "1"
+    assert Claim.query.count() == 0
+
+
+def test_create_claim_idempotency_key_released_on_failure(mocker, client):
+    client, app = client
+    # Arrange
+    user = User(email="test@example.com")
+    db.session.add(user)
+    db.session.commit()
+    mocker.patch("app.routes.load_user", return_value=user)
+    token = create_access_token(identity=user.email)
+    headers = {"Authorization": f"Bearer {token}", "Idempotency-Key": "abc"}
+    invalid = claim_form(("a.jpg", jpeg(b"a")))
+    del invalid["policy_number"]
+
+    # Act
+    rejected = client.post("/api/claims", data=invalid, headers=headers)
+    created = client.post(
+        "/api/claims", data=claim_form(("a.jpg", jpeg(b"a"))), headers=headers
+    )
+
+    # Assert
+    assert rejected.status_code == 400
+    assert created.status_code == 201
+    assert IdempotencyKey.query.one().status_code == 201
+
+
+def test_create_claim_failed_upload_leaves_no_claim(mocker, client):
+    client, app = client
+    # Arrange
+    user = User(email="test@example.com")
+    db.session.add(user)
+    db.session.commit()
+    mocker.patch("app.routes.load_user", return_value=user)
+    mocker.patch(
+        "app.routes.upload_files", side_effect=RuntimeError("upload failed")
+    )
+    token = create_access_token(identity=user.email)
+    headers = {"Authorization": f"Bearer {token}", "Idempotency-Key": "abc"}
+
+    # Act
+    responses = [
+        client.post(
+            "/api/claims", data=claim_form(("a.jpg", jpeg(b"a"))), headers=headers
+        )
+        for _ in range(2)
+    ]
+
+    # Assert
+    assert [response.status_code for response in responses] == [500, 500]
+    assert Claim.query.count() == 0
+    assert ClaimStat.query.count() == 0
+    assert db.session.get(User, user.id).claims_version == 0
+    assert IdempotencyKey.query.count() == 0
+
+
+def pool_config(tmp_path, **settings):
+    return type(
+        "PoolTestConfig",
+        (TestConfig,),
+        {"SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'pool.db'}", **settings},
+    )
+
+
+def test_engine_pool_configured_from_settings(tmp_path):
+    # Arrange
+    app = create_app(pool_config(tmp_path, DB_POOL_SIZE=2, DB_MAX_OVERFLOW=1))
+    null_app = create_app(pool_config(tmp_path, DB_POOL_MODE="null"))
+
+    # Act
+    with app.app_context():
+        pool = db.engine.pool
+    with null_app.app_context():
+        null_pool = db.engine.pool
+
+    # Assert
+    assert isinstance(pool, QueuePool)
+    assert pool.size() == 2
+    assert pool._max_overflow == 1
+    assert pool._pre_ping
+    assert isinstance(null_pool, NullPool)
+
+
+def test_pool_stats_record_checkouts_and_timeouts(tmp_path):
+    # Arrange
+    app = create_app(
+        pool_config(tmp_path, DB_POOL_SIZE=1, DB_MAX_OVERFLOW=0, DB_POOL_TIMEOUT=0.1)
+    )
+
+    with app.app_context():
+        # Act
+        held = db.engine.connect()
+        with pytest.raises(exc.TimeoutError):
+            db.engine.connect()
+        busy = pool_stats.snapshot()["default"]
+        held.close()
+        stats = pool_stats.snapshot()["default"]
+
+    # Assert
+    assert busy["in_use"] == 1
+    assert busy["saturation"] == 1
+    assert stats["capacity"] == 1
+    assert stats["checkouts"] == 1
+    assert stats["timeouts"] == 1
+    assert stats["in_use"] == 0
+    assert stats["peak_saturation"] == 1
+
+
+def test_admin_metrics_report_pool_usage(tmp_path):
+    # Arrange
+    app = create_app(pool_config(tmp_path))
+    with app.app_context():
+        db.create_all()
+        admin = User(email="admin@example.com", is_admin=True)
+        user = User(email="test@example.com")
+        db.session.add_all([admin, user])
+        db.session.commit()
+        admin_headers = {
+            "Authorization": f"Bearer {create_access_token(identity=admin.email)}"
+        }
+        user_headers = {
+            "Authorization": f"Bearer {create_access_token(identity=user.email)}"
+        }
+    client = app.test_client()
+
+    # Act
+    response = client.get("/api/admin/metrics", headers=admin_headers)
+    forbidden = client.get("/api/admin/metrics", headers=user_headers)
+
+    # Assert
+    assert response.status_code == 200
+    pool = response.get_json()["db_pool"]["default"]
+    assert pool["capacity"] == 15
+    assert pool["checkouts"] >= 1
+    assert forbidden.status_code == 403
+
+
+def replica_config(tmp_path):
+    return type(
+        "ReplicaTestConfig",
+        (TestConfig,),
+        {
+            "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'primary.db'}",
+            "SQLALCHEMY_REPLICA_URI": f"sqlite:///{tmp_path / 'replica.db'}",
+        },
+    )
+
+
+def create_replicated_user(email):
+    # The replica has the user but lags behind on their claims.
+    db.metadata.create_all(replica.engine)
+    user = User(email=email)
+    db.session.add(user)
+    db.session.commit()
+    with replica.engine.begin() as connection:
+        connection.execute(
+            User.__table__.insert(), [{"id": user.id, "email": user.email}]
+        )
+    create_claims(user, 2)
+    return user
+
+
+def test_read_only_routes_use_replica_until_user_writes(mocker, tmp_path):
+    # Arrange
+    app = create_app(replica_config(tmp_path))
+    client = app.test_client()
+    with app.app_context():
+        db.create_all()
+        user = create_replicated_user("test@example.com")
+        headers = {
+            "Authorization": f"Bearer {create_access_token(identity=user.email)}"
+        }
+
+    # Act
+    lagging = client.get("/api/claims", headers=headers)
+    whoami = client.get("/api/auth/whoami", headers=headers)
+    created = client.post(
+        "/api/claims", data=claim_form(("a.jpg", jpeg(b"a"))), headers=headers
+    )
+    written = {"Authorization": f"Bearer {created.get_json()['access_token']}"}
+    stale = client.get("/api/claims", headers=headers)
+    sticky = client.get("/api/claims", headers=written)
+    stats = client.get("/api/claims/stats", headers=written)
+    imported = client.post(
+        "/api/claims/bulk",
+        data=json.dumps(claim_row()) + "\n",
+        headers=headers,
+    )
+    imported_headers = {
+        "Authorization": f"Bearer {imported.get_json()['access_token']}"
+    }
+    after_import = client.get("/api/claims", headers=imported_headers)
+    mocker.patch.object(replica, "timer", return_value=time.time() + 60)
+    expired = client.get("/api/claims", headers=written)
+
+    # Assert
+    assert lagging.get_json()["total"] == 0
+    assert whoami.get_json() == {"email": "test@example.com"}
+    assert created.status_code == 201
+    assert stale.get_json()["total"] == 0
+    assert sticky.get_json()["total"] == 3
+    assert stats.get_json()["total"] == 1
+    assert imported.get_json()["inserted"] == 1
+    assert after_import.get_json()["total"] == 4
+    assert expired.get_json()["total"] == 0
+
+
+def test_asgi_read_routes_use_replica_until_user_writes(tmp_path):
+    from app.asgi import create_asgi_app
+    from starlette.testclient import TestClient
+
+    # Arrange
+    asgi_app = create_asgi_app(replica_config(tmp_path))
+    app = asgi_app.state.flask_app
+    with app.app_context():
+        db.create_all()
+        user = create_replicated_user("test@example.com")
+        claim_id = db.session.scalar(select(Claim.id))
+        headers = {
+            "Authorization": f"Bearer {create_access_token(identity=user.email)}"
+        }
+    form = claim_form()
+    data = {key: str(value).lower() for key, value in form.items()}
+    files = {"images[0]": ("a.jpg", jpeg(b"a"), "image/jpeg")}
+
+    with TestClient(asgi_app) as client:
+        # Act
+        lagging = client.get("/api/claims", headers=headers)
+        missing = client.get(f"/api/claims/{claim_id}", headers=headers)
+        created = client.post(
+            "/api/claims", data=data, files=files, headers=headers
+        )
+        written = {"Authorization": f"Bearer {created.json()['access_token']}"}
+        sticky = client.get("/api/claims", headers=written)
+        found = client.get(f"/api/claims/{claim_id}", headers=written)
+
+    # Assert
+    assert lagging.json()["total"] == 0
+    assert missing.status_code == 404
+    assert created.status_code == 201
+    assert sticky.json()["total"] == 3
+    assert found.status_code == 200
+    assert "async_replica" in pool_stats.snapshot()
+
+
+@pytest.fixture
+def asgi_client(tmp_path):
+    from app.asgi import create_asgi_app
+    from starlette.testclient import TestClient
+
+    # The sync and async engines need to see the same database. Each server
+    # must build its own pages, not serve the other's from the claims cache.
+    config = type(
+        "AsyncTestConfig",
+        (TestConfig,),
+        {
+            "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'test.db'}",
+            "CLAIMS_CACHE_BACKEND": "none",
+        },
+    )
+    asgi_app = create_asgi_app(config)
+    flask_app = asgi_app.state.flask_app
+
+    with TestClient(asgi_app) as client:
+        with flask_app.app_context():
+            db.create_all()
+            yield client, flask_app
+            db.session.remove()
+            db.drop_all()
+            storage.empty()
+
+
+def test_asgi_claims_match_sync_routes(asgi_client):
+    client, app = asgi_client
+    # Arrange
+    user = User(email="test@example.com")
+    db.session.add(user)
+    db.session.commit()
+    token = create_access_token(
+        identity=user.email, additional_claims={"uid": user.id, "email": user.email}
+    )
+    headers = {"Authorization": f"Bearer {token}"}
+    form = claim_form(("a.jpg", jpeg(b"a")), ("b.jpg", jpeg(b"a")))
+    files = {
+        key: (value.filename, value.stream, value.content_type)
+        for key, value in form.items()
+        if isinstance(value, FileStorage)
+    }
+    data = {
+        key: str(value).lower()
+        for key, value in form.items()
+        if not isinstance(value, FileStorage)
+    }
+    sync_client = app.test_client()
+
+    # Act
+    created = client.post("/api/claims", data=data, files=files, headers=headers)
+    claim_id = created.json()["claim_id"]
+    claims = client.get("/api/claims?include_urls=true", headers=headers)
+    claim = client.get(f"/api/claims/{claim_id}", headers=headers)
+    unchanged = client.get(
+        f"/api/claims/{claim_id}",
+        headers={**headers, "If-None-Match": claim.headers["ETag"]},
+    )
+    sync_claims = sync_client.get("/api/claims?include_urls=true", headers=headers)
+    sync_claim = sync_client.get(f"/api/claims/{claim_id}", headers=headers)
+
+    # Assert
+    assert created.status_code == 201
+    assert created.json()["status"] == "complete"
+    assert storage.download(f"{sha256(jpeg(b'a'))}.jpg") == jpeg(b"a")
+    assert claims.status_code == 200
+    assert claims.json() == sync_claims.get_json()
+    # Both servers tag a page with the same ETag, suffixed by the encoding.
+    assert claims.headers["ETag"].startswith(sync_claims.headers["ETag"][:-1])
+    assert claim.json() == sync_claim.get_json()
+    assert len(claim.json()["images"]) == 2
+    assert unchanged.status_code == 304
+    assert ClaimStat.query.one().claims == 1
+
+
+def test_asgi_rejects_bad_requests_and_falls_back_to_flask(asgi_client):
+    client, app = asgi_client
+    # Arrange
+    user = User(email="test@example.com")
+    db.session.add(user)
+    db.session.commit()
+    headers = {"Authorization": f"Bearer {create_access_token(identity=user.email)}"}
+    refresh_headers = {
+        "Authorization": f"Bearer {create_refresh_token(identity=user.email)}"
+    }
+    data = {key: str(value) for key, value in claim_form().items()}
+
+    # Act
+    missing = client.get("/api/claims")
+    invalid = client.get("/api/claims", headers={"Authorization": "Bearer nope"})
+    refresh = client.get("/api/claims", headers=refresh_headers)
+    not_image = client.post(
+        "/api/claims",
+        data=data,
+        files={"images[0]": ("a.jpg", b"GIF89a", "image/jpeg")},
+        headers=headers,
+    )
+    anonymous_post = client.post(
+        "/api/claims",
+        data=data,
+        files={"images[0]": ("a.jpg", b"GIF89a", "image/jpeg")},
+    )
+    bad_length = client.post(
+        "/api/claims",
+        content=b"",
+        headers={**headers, "Content-Length": "abc"},
+    )
+    whoami = client.get("/api/auth/whoami", headers=headers)
+
+    # Assert
+    assert missing.status_code == 401
+    assert anonymous_post.status_code == 401
+    assert invalid.status_code == 401
+    assert invalid.json() == {"message": "Invalid token"}
+    assert refresh.status_code == 422
+    assert not_image.status_code == 400
+    assert not_image.json() == {"error": "File type not allowed"}
+    assert bad_length.status_code == 400
+    assert Claim.query.count() == 0
+    assert whoami.json() == {"email": "test@example.com"}
+
+
+def test_async_supabase_upload_streams_spooled_files(mocker):
+    # Arrange
+    storage = AsyncSupabaseStorage("http://supabase", "key", "bucket")
+    bucket = mocker.Mock(upload=mocker.AsyncMock())
+    mocker.patch.object(storage, "_bucket", return_value=bucket)
+    spooled = tempfile.SpooledTemporaryFile(max_size=1)
+    spooled.write(b"x" * 1024)
+    reader = upload_body(spooled)
+    reader.read(10)
+
+    # Act
+    asyncio.run(storage.upload("a.jpg", reader, "image/jpeg"))
+
+    # Assert
+    path, body, options = bucket.upload.call_args.args
+    assert isinstance(body, io.BufferedReader)
+    assert body.read() == b"x" * 1024
+    assert options == {"content-type": "image/jpeg"}
+
+
+def test_async_store_image_renders_off_the_event_loop(mocker, client):
+    client, app = client
+    # Arrange
+    threads = []
+
+    def render(*args):
+        threads.append(threading.get_ident())
+        return render_derivatives(*args)
+
+    mocker.patch("app.async_storage.render_derivatives", side_effect=render)
+    backend = mocker.Mock(upload=mocker.AsyncMock(), delete=mocker.AsyncMock())
+    async_storage = AsyncStorageClient()
+    async_storage.backend = backend
+
+    # Act
+    stored = asyncio.run(
+        async_storage.store_image(
+            app.config, "a.jpg", jpeg_bytes(800, 600), "image/jpeg", []
+        )
+    )
+
+    # Assert
+    assert app.config["IMAGE_DERIVATIVE_WORKERS"] == 0
+    assert threads and threads[0] != threading.get_ident()
+    assert set(stored) == {"image_file", "thumbnail_file", "display_file"}
+
+
+@pytest.mark.parametrize("url_mode", ["public", "signed"])
+def test_asgi_image_urls_with_local_storage(tmp_path, url_mode):
+    from app.asgi import create_asgi_app
+    from starlette.testclient import TestClient
+
+    # Arrange
+    config = type(
+        "LocalStorageTestConfig",
+        (TestConfig,),
+        {
+            "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'test.db'}",
+            "STORAGE_BACKEND": "local",
+            "UPLOAD_FOLDER": str(tmp_path / "uploads"),
+            "IMAGE_URL_MODE": url_mode,
+        },
+    )
+    asgi_app = create_asgi_app(config)
+    app = asgi_app.state.flask_app
+    with app.app_context():
+        db.create_all()
+        user = User(email="test@example.com")
+        db.session.add(user)
+        db.session.commit()
+        headers = {
+            "Authorization": f"Bearer {create_access_token(identity=user.email)}"
+        }
+    data = {key: str(value).lower() for key, value in claim_form().items()}
+    files = {"images[0]": ("a.jpg", jpeg(b"a"), "image/jpeg")}
+
+    with TestClient(asgi_app) as client:
+        # Act
+        claim_id = client.post(
+            "/api/claims", data=data, files=files, headers=headers
+        ).json()["claim_id"]
+        detail = client.get(f"/api/claims/{claim_id}", headers=headers)
+        listed = client.get("/api/claims?include_urls=true", headers=headers)
+        url = detail.json()["images"][0]
+        image = client.get(url)
+
+    # Assert
+    assert detail.status_code == 200
+    assert url.startswith(f"http://testserver/uploads/{sha256(jpeg(b'a'))}.jpg")
+    assert listed.json()["claims"][0]["images"][0]["url"] == url
+    assert image.content == jpeg(b"a")
+
+
+def test_asgi_uploads_wait_concurrently(mocker, asgi_client):
+    client, app = asgi_client
+    # Arrange
+    import asyncio
+
+    user = User(email="test@example.com")
+    db.session.add(user)
+    db.session.commit()
+    headers = {"Authorization": f"Bearer {create_access_token(identity=user.email)}"}
+    backend = client.app.state.storage.backend
+    upload = backend.upload
+
+    async def slow_upload(*args):
+        await asyncio.sleep(0.2)
+        await upload(*args)
+
+    mocker.patch.object(backend, "upload", slow_upload, create=True)
+    data = {key: str(value) for key, value in claim_form().items()}
+    files = {
+        f"images[{i}]": (f"{i}.jpg", jpeg(bytes([i])), "image/jpeg") for i in range(4)
+    }
+
+    # Act
+    start = time.perf_counter()
+    response = client.post("/api/claims", data=data, files=files, headers=headers)
+    elapsed = time.perf_counter() - start
+
+    # Assert
+    assert response.status_code == 201
+    assert elapsed < 0.6
+    assert Image.query.count() == 4
+
+
+# Cold starts are user facing latency, so building the app has a budget and
+# must not pull in modules that only some commands or requests need.
+def test_asgi_create_claim_idempotency_key(asgi_client):
+    client, app = asgi_client
+    # Arrange
+    user = User(email="test@example.com")
+    db.session.add(user)
+    db.session.commit()
+    token = create_access_token(identity=user.email)
+    headers = {"Authorization": f"Bearer {token}", "Idempotency-Key": "abc"}
+    data = {key: str(value).lower() for key, value in claim_form().items()}
+    files = {"images[0]": ("a.jpg", jpeg(b"a"), "image/jpeg")}
+    sync_client = app.test_client()
+
+    # Act
+    first = client.post("/api/claims", data=data, files=files, headers=headers)
+    retry = client.post("/api/claims", data=data, files=files, headers=headers)
+    sync_retry = sync_client.post(
+        "/api/claims",
+        data={**data, "images[0]": (io.BytesIO(jpeg(b"a")), "a.jpg", "image/jpeg")},
+        headers=headers,
+    )
+    reused = client.post(
+        "/api/claims",
+        data={**data, "policy_number": "other"},
+        files=files,
+        headers=headers,
+    )
+
+    # Assert
+    assert first.status_code == 201
+    assert retry.status_code == 201
+    assert retry.json() == first.json()
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    # Both servers fingerprint the request alike and share the stored response.
+    assert sync_retry.get_json() == first.json()
+    assert reused.status_code == 422
+    assert Claim.query.count() == 1
+
+
+def test_asgi_create_claim_failed_upload_leaves_no_claim(mocker, asgi_client):
+    client, app = asgi_client
+    # Arrange
+    user = User(email="test@example.com")
+    db.session.add(user)
+    db.session.commit()
+    mocker.patch.object(
+        AsyncStorageClient, "upload_files", side_effect=RuntimeError("upload failed")
+    )
+    token = create_access_token(identity=user.email)
+    headers = {"Authorization": f"Bearer {token}", "Idempotency-Key": "abc"}
+    data = {key: str(value).lower() for key, value in claim_form().items()}
+    files = {"images[0]": ("a.jpg", jpeg(b"a"), "image/jpeg")}
+
+    # Act
+    responses = [
+        client.post("/api/claims", data=data, files=files, headers=headers)
+        for _ in range(2)
+    ]
+
+    # Assert
+    assert [response.status_code for response in responses] == [500, 500]
+    assert Claim.query.count() == 0
+    assert ClaimStat.query.count() == 0
+    assert IdempotencyKey.query.count() == 0
+
+
+IMPORT_TIME_BUDGET_MS = 1000
+DEFERRED_MODULES = {
+    "alembic",
+    "asyncpg",
+    "flask_migrate",
+    "PIL",
+    "pyarrow",
+    "pydantic",
+    "starlette",
+    "storage3",
+    "supabase",
+}
+
+
+def test_create_app_import_time_budget():
+    # Arrange
+    code = "from app import create_app; create_app()"
+
+    # Act
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        check=True,
+    )
+    total_us = 0
+    imported = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        imported.add(name.strip().split(".")[0])
+        if not name[1:].startswith(" "):
+            total_us += int(cumulative)
+
+    # Assert
+    assert imported & DEFERRED_MODULES == set()
+    assert total_us / 1000 < IMPORT_TIME_BUDGET_MS
@@ -39,7 +39,7 @@ type UserAuthFormProps = React.HTMLAttributes<HTMLDivElement>;
 interface ClaimCreateSuccessResponse {
     claim_id: number;
     message: string;
-    token: string;
+    access_token: string;
 }
 
 export function CreateClaimForm({ className, ...props }: UserAuthFormProps) {
@@ -79,6 +79,8 @@ export function CreateClaimForm({ className, ...props }: UserAuthFormProps) {
                     )
                     .then((response) => {
                         toast.success(response.data.message);
+                        // Keeps this user's reads on the primary until the replica catches up.
+                        localStorage.setItem("jwt", response.data.access_token);
                     })
                     .catch(() => {
                         toast.error("Something went wrong");